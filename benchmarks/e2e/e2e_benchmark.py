@@ -0,0 +1,395 @@
+"""End-to-end benchmark of the packaging flow over a frozen corpus of projects.
+
+The projects in `corpus.csv` are packaged once for real with `record`. That stores
+the model exchanges (see cassette.py), the outcomes of all Nix operations (see
+nix_backend.py), and the project page and release data of every project in
+`recordings/<issue_number>/`. The project and nixpkgs sources that the model
+browses are archived in `recordings/sources/`, and added back to the Nix store
+at the same store paths before a run. `run` then packages the corpus again
+offline from these recordings. It reports the wall time per stage, the iterations, the model
+tokens and requests, the tool calls and the recorded build time of every project.
+Any regression against `baseline.json` beyond its thresholds makes `run` fail.
+
+    python benchmarks/e2e/e2e_benchmark.py record             # needs network and a configured model
+    python benchmarks/e2e/e2e_benchmark.py run
+    python benchmarks/e2e/e2e_benchmark.py run --update-baseline
+
+By default responses and builds are replayed without their recorded delays, so
+wall times measure the overhead of vibenix itself. Replay the recorded timing
+with `--replay-speed realtime --nix-time-scale 1`.
+
+`--beam-width` and `--fix-candidates` record and run the sessions with the
+beam search or several fix candidates, next to the recordings of the
+sequential loop. `compare-search` replays both with their recorded timing and
+compares their time to success:
+
+    python benchmarks/e2e/e2e_benchmark.py record --beam-width 3 --fix-candidates 2
+    python benchmarks/e2e/e2e_benchmark.py compare-search --beam-width 3 --fix-candidates 2
+"""
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src"))
+
+from vibenix.ccl_reader import read_sections, stage_times
+
+BENCH_DIR = Path(__file__).resolve().parent
+CORPUS_FILE = BENCH_DIR / "corpus.csv"
+RECORDINGS_DIR = BENCH_DIR / "recordings"
+BASELINE_FILE = BENCH_DIR / "baseline.json"
+
+MODEL_CASSETTE = "model.jsonl"
+NIX_CORPUS = "nix.jsonl"
+PROJECT_DATA = "project.json"
+# Shared by all projects, they all browse the same nixpkgs
+SOURCES_DIR = "sources"
+
+# Operations of the Nix backend that return the store path of a source browsed by the model
+SOURCE_OPERATIONS = ("source_store_path", "nixpkgs_source")
+
+# Allowed relative increase of each metric over the baseline, lower is better for all of them
+DEFAULT_THRESHOLDS = {
+    "wall_time": 0.25,
+    "analysis_time": 0.25,
+    "initial_build_time": 0.25,
+    "fix_loop_time": 0.25,
+    "iterations": 0.0,
+    "model_requests": 0.10,
+    "prompt_tokens": 0.10,
+    "completion_tokens": 0.10,
+    "tool_calls": 0.25,
+    "build_time": 0.10,
+}
+
+# Allowed absolute increase on top of the relative threshold, so timer noise in short runs is no regression
+ABSOLUTE_SLACK = {
+    "wall_time": 1.0,
+    "analysis_time": 0.5,
+    "initial_build_time": 0.5,
+    "fix_loop_time": 1.0,
+}
+
+def recording_dir_for(recordings: Path, issue_number: str, beam_width: int = 1, fix_candidates: int = 1) -> Path:
+    """The recordings of a project, sessions that search otherwise than the sequential loop are kept apart."""
+    if beam_width == 1 and fix_candidates == 1:
+        return recordings / issue_number
+    return recordings / f"{issue_number}-beam{beam_width}x{fix_candidates}"
+
+
+def read_corpus(corpus_file: Path = CORPUS_FILE) -> List[Dict[str, str]]:
+    with open(corpus_file, newline="") as f:
+        return [row for row in csv.DictReader(f) if row.get("repo_url")]
+
+
+def _package(session, project: Dict[str, str], output_dir: Path) -> Optional[str]:
+    from vibenix.packaging_flow.run import package_project
+    from vibenix.session import use_session
+    with use_session(session):
+        return package_project(output_dir=str(output_dir), project_url=project["repo_url"],
+                               revision=project.get("revision") or None)
+
+
+def recorded_sources(recording_dir: Path) -> List[str]:
+    """The store paths of the sources that the recorded session browsed."""
+    from vibenix.nix_backend import load_corpus
+    corpus = load_corpus([recording_dir / NIX_CORPUS])
+    return sorted({entry["stdout"].strip() for (operation, _), entry in corpus.items()
+                   if operation in SOURCE_OPERATIONS and entry["returncode"] == 0 and entry["stdout"].strip()})
+
+
+def _source_archive(sources_dir: Path, store_path: str) -> Path:
+    return sources_dir / f"{Path(store_path).name}.nar.zst"
+
+
+def export_sources(store_paths: List[str], sources_dir: Path):
+    """Archive the sources as compressed NARs, unless they are archived already."""
+    import zstandard
+    sources_dir.mkdir(parents=True, exist_ok=True)
+    for store_path in store_paths:
+        archive = _source_archive(sources_dir, store_path)
+        if archive.exists():
+            continue
+        if not Path(store_path).exists():
+            print(f"Cannot archive {store_path}: it is not in the store")
+            continue
+        partial = archive.with_suffix(".partial")
+        with subprocess.Popen(["nix-store", "--dump", store_path], stdout=subprocess.PIPE) as dump, \
+             open(partial, "wb") as f:
+            zstandard.ZstdCompressor().copy_stream(dump.stdout, f)
+        if dump.returncode != 0:
+            partial.unlink()
+            raise RuntimeError(f"nix-store --dump {store_path} failed")
+        partial.rename(archive)
+
+
+def import_sources(store_paths: List[str], sources_dir: Path):
+    """Add the archived sources that are missing to the Nix store, at the store paths they were recorded at.
+
+    Sources are content-addressed, so adding the unpacked tree under its name
+    with `nix-store --add-fixed --recursive` restores the same store path.
+    """
+    import zstandard
+    for store_path in store_paths:
+        archive = _source_archive(sources_dir, store_path)
+        if Path(store_path).exists():
+            continue
+        if not archive.exists():
+            print(f"Source {store_path} is neither in the store nor archived, the replay will diverge")
+            continue
+        # The store path is /nix/store/<hash>-<name>
+        name = Path(store_path).name.split("-", 1)[1]
+        with tempfile.TemporaryDirectory(prefix="vibenix-bench-source-") as tmp_dir:
+            tree = Path(tmp_dir) / name
+            with subprocess.Popen(["nix-store", "--restore", str(tree)], stdin=subprocess.PIPE) as restore, \
+                 open(archive, "rb") as f:
+                zstandard.ZstdDecompressor().copy_stream(f, restore.stdin)
+                restore.stdin.close()
+            if restore.returncode != 0:
+                raise RuntimeError(f"Restoring {archive} failed")
+            added = subprocess.run(["nix-store", "--add-fixed", "--recursive", "sha256", str(tree)],
+                                   capture_output=True, text=True, check=True).stdout.strip()
+        if added != store_path:
+            raise RuntimeError(f"{archive} was added as {added}, not as the recorded {store_path}")
+
+
+def record_project(project: Dict[str, str], recording_dir: Path, beam_width: int = 1, fix_candidates: int = 1):
+    """Package a project for real, recording everything `run_project` needs to repeat it offline."""
+    from vibenix.cassette import RecordingCassette, use_cassette
+    from vibenix.nix_backend import RecordingNixBackend
+    from vibenix.parsing import fetch_github_release_data, scrape_and_process
+    from vibenix.session import Session
+    from vibenix.ui.conversation import TerminalUIAdapter
+
+    shutil.rmtree(recording_dir, ignore_errors=True)
+    recording_dir.mkdir(parents=True)
+    session = Session(ui_adapter=TerminalUIAdapter(), nix_backend=RecordingNixBackend(recording_dir / NIX_CORPUS),
+                      beam_width=beam_width, fix_candidates=fix_candidates)
+    cassette = RecordingCassette(recording_dir / MODEL_CASSETTE)
+    use_cassette(session, cassette)
+    try:
+        with tempfile.TemporaryDirectory(prefix="vibenix-bench-") as output_dir:
+            _package(session, project, Path(output_dir))
+    finally:
+        cassette.close()
+        session.close()
+    # Both are memoized, so this does not fetch them again
+    project_data = {
+        "page": scrape_and_process(project["repo_url"]),
+        "release_data": fetch_github_release_data(project["repo_url"]),
+    }
+    (recording_dir / PROJECT_DATA).write_text(json.dumps(project_data, indent=2))
+    export_sources(recorded_sources(recording_dir), recording_dir.parent / SOURCES_DIR)
+
+
+def _seed_project_data(project: Dict[str, str], recording_dir: Path):
+    """Put the recorded project page and release data into the cache of the fetch functions."""
+    from vibenix.parsing import fetch_github_release_data, get_cache, scrape_and_process
+    project_data = json.loads((recording_dir / PROJECT_DATA).read_text())
+    cache = get_cache()
+    cache.set(scrape_and_process.__cache_key__(project["repo_url"]), project_data["page"])
+    cache.set(fetch_github_release_data.__cache_key__(project["repo_url"]), project_data["release_data"])
+
+
+def run_project(project: Dict[str, str], recording_dir: Path, replay_speed: str = "asap",
+                nix_time_scale: float = 0.0, beam_width: int = 1, fix_candidates: int = 1) -> Dict[str, float]:
+    """Package a project offline from its recordings and measure the session."""
+    from vibenix.cassette import Exchange, ReplayingCassette, ReplaySpeed, use_cassette
+    from vibenix.nix_backend import SimulatedNixBackend
+    from vibenix.session import Session
+    from vibenix.ui.conversation import TerminalUIAdapter
+
+    _seed_project_data(project, recording_dir)
+    import_sources(recorded_sources(recording_dir), recording_dir.parent / SOURCES_DIR)
+    with open(recording_dir / MODEL_CASSETTE) as f:
+        first_line = f.readline()
+    if first_line.strip():
+        # Route the requests through litellm with the recorded model, no API key is needed for replays
+        os.environ["MAGENTIC_BACKEND"] = "litellm"
+        os.environ["MAGENTIC_LITELLM_MODEL"] = Exchange.from_json(first_line).request["model"]
+
+    nix_backend = SimulatedNixBackend([recording_dir / NIX_CORPUS], time_scale=nix_time_scale)
+    cassette = ReplayingCassette(recording_dir / MODEL_CASSETTE, ReplaySpeed(replay_speed))
+    session = Session(ui_adapter=TerminalUIAdapter(), nix_backend=nix_backend, beam_width=beam_width,
+                      fix_candidates=fix_candidates)
+    use_cassette(session, cassette)
+    try:
+        with tempfile.TemporaryDirectory(prefix="vibenix-bench-") as output_dir:
+            start_time = time.monotonic()
+            code = _package(session, project, Path(output_dir))
+            wall_time = time.monotonic() - start_time
+            sections = read_sections(Path(output_dir) / "run.ccl")
+    finally:
+        cassette.close()
+        session.close()
+
+    usage = [exchange.usage() for exchange in cassette.served]
+    metrics = {
+        "success": code is not None,
+        "wall_time": wall_time,
+        "time_to_success": wall_time if code is not None else None,
+        "iterations": int(sections.get("session-end", {}).get("total_iterations", 0)),
+        "model_requests": len(cassette.served),
+        "prompt_tokens": sum(prompt_tokens for prompt_tokens, _ in usage),
+        "completion_tokens": sum(completion_tokens for _, completion_tokens in usage),
+        "tool_calls": sum(len(exchange.tool_calls()) for exchange in cassette.served),
+        "build_time": nix_backend.recorded_time.get("build", 0.0),
+        "cost": session.total_cost,
+        "unreplayed_exchanges": cassette.remaining,
+        "unrecorded_nix_operations": nix_backend.misses,
+    }
+    metrics.update(stage_times(sections))
+    return metrics
+
+
+def compare_to_baseline(results: Dict[str, dict], baseline: dict) -> List[str]:
+    """Describe every regression of the results against the baseline."""
+    thresholds = {**DEFAULT_THRESHOLDS, **baseline.get("thresholds", {})}
+    regressions = []
+    for issue_number, expected in baseline.get("projects", {}).items():
+        actual = results.get(issue_number)
+        if actual is None:
+            continue
+        if expected.get("success") and not actual.get("success"):
+            regressions.append(f"{issue_number}: no longer succeeds")
+        for metric, threshold in thresholds.items():
+            if metric not in expected or metric not in actual:
+                continue
+            limit = expected[metric] * (1 + threshold) + ABSOLUTE_SLACK.get(metric, 0.0)
+            if actual[metric] > limit:
+                regressions.append(f"{issue_number}: {metric} {actual[metric]:.3f} exceeds {limit:.3f} "
+                                   f"(baseline {expected[metric]:.3f}, threshold {threshold:.0%})")
+    return regressions
+
+
+def compare_search(sequential: Dict[str, dict], searched: Dict[str, dict]) -> Dict[str, dict]:
+    """Compare the time to success of the sequential loop and another search, by issue number.
+
+    The speedup is only defined when both succeed.
+    """
+    comparison = {}
+    for issue_number in sequential.keys() & searched.keys():
+        sequential_time = sequential[issue_number].get("time_to_success")
+        searched_time = searched[issue_number].get("time_to_success")
+        comparison[issue_number] = {
+            "sequential_time_to_success": sequential_time,
+            "search_time_to_success": searched_time,
+            "speedup": sequential_time / searched_time if sequential_time and searched_time else None,
+            "sequential_cost": sequential[issue_number].get("cost"),
+            "search_cost": searched[issue_number].get("cost"),
+        }
+    return dict(sorted(comparison.items()))
+
+
+def print_search_comparison(comparison: Dict[str, dict]):
+    columns = ["sequential_time_to_success", "search_time_to_success", "speedup", "sequential_cost", "search_cost"]
+    print("issue".ljust(8) + "".join(column.rjust(28) for column in columns))
+    for issue_number, row in comparison.items():
+        cells = ["failed" if row[column] is None else f"{row[column]:.2f}" for column in columns]
+        print(issue_number.ljust(8) + "".join(cell.rjust(28) for cell in cells))
+
+
+def print_report(results: Dict[str, dict], baseline: dict):
+    columns = ["success", "wall_time", "iterations", "model_requests", "prompt_tokens",
+               "completion_tokens", "tool_calls", "build_time"]
+    print("issue".ljust(8) + "".join(column.rjust(18) for column in columns))
+    for issue_number, metrics in results.items():
+        expected = baseline.get("projects", {}).get(issue_number, {})
+        cells = []
+        for column in columns:
+            value = metrics.get(column)
+            cell = f"{value:.2f}" if isinstance(value, float) else str(value)
+            if isinstance(value, (int, float)) and not isinstance(value, bool) and expected.get(column):
+                cell += f" ({(value - expected[column]) / expected[column]:+.0%})"
+            cells.append(cell.rjust(18))
+        print(issue_number.ljust(8) + "".join(cells))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of vibenix over a frozen project corpus")
+    parser.add_argument("mode", choices=["record", "run", "compare-search"])
+    parser.add_argument("--corpus", type=Path, default=CORPUS_FILE)
+    parser.add_argument("--recordings", type=Path, default=RECORDINGS_DIR)
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE)
+    parser.add_argument("--only", nargs="*", default=None, metavar="ISSUE", help="Only benchmark these issue numbers")
+    parser.add_argument("--replay-speed", choices=["realtime", "asap"], default=None,
+                        help="Default: asap, realtime for compare-search")
+    parser.add_argument("--nix-time-scale", type=float, default=None, help="Default: 0, 1 for compare-search")
+    parser.add_argument("--beam-width", type=int, default=1, help="Beam width of the sessions")
+    parser.add_argument("--fix-candidates", type=int, default=1, help="Fix candidates per iteration of the sessions")
+    parser.add_argument("--output", type=Path, default=None, help="Write the results as JSON")
+    parser.add_argument("--update-baseline", action="store_true", help="Store the results as the new baseline")
+    args = parser.parse_args(argv)
+
+    from vibenix.ui.logging_config import enable_console_logging
+    enable_console_logging()
+
+    projects = [project for project in read_corpus(args.corpus)
+                if args.only is None or project["issue_number"] in args.only]
+    search = {"beam_width": args.beam_width, "fix_candidates": args.fix_candidates}
+
+    if args.mode == "record":
+        from vibenix.ui.model_config import load_saved_configuration
+        if not load_saved_configuration():
+            print("No saved model configuration found. Please run vibenix interactively first to configure.")
+            return 1
+        for project in projects:
+            record_project(project, recording_dir_for(args.recordings, project["issue_number"], **search), **search)
+        return 0
+
+    def run_recorded(replay_speed: str, nix_time_scale: float, beam_width: int, fix_candidates: int) -> Dict[str, dict]:
+        results = {}
+        for project in projects:
+            recording_dir = recording_dir_for(args.recordings, project["issue_number"], beam_width, fix_candidates)
+            if not (recording_dir / MODEL_CASSETTE).exists():
+                print(f"Skipping {project['issue_number']}: not recorded, run 'record' first")
+                continue
+            results[project["issue_number"]] = run_project(project, recording_dir, replay_speed, nix_time_scale,
+                                                           beam_width, fix_candidates)
+        return results
+
+    if args.mode == "compare-search":
+        if search == {"beam_width": 1, "fix_candidates": 1}:
+            print("compare-search needs a --beam-width or --fix-candidates to compare the sequential loop with")
+            return 1
+        # Time to success only means something with the recorded response and build times
+        replay_speed = args.replay_speed or "realtime"
+        nix_time_scale = 1.0 if args.nix_time_scale is None else args.nix_time_scale
+        comparison = compare_search(run_recorded(replay_speed, nix_time_scale, 1, 1),
+                                    run_recorded(replay_speed, nix_time_scale, **search))
+        print_search_comparison(comparison)
+        if args.output:
+            args.output.write_text(json.dumps(comparison, indent=2))
+        return 0
+
+    results = run_recorded(args.replay_speed or "asap", args.nix_time_scale or 0.0, **search)
+
+    baseline = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+    print_report(results, baseline)
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2))
+    if args.update_baseline:
+        args.baseline.write_text(json.dumps({
+            "thresholds": baseline.get("thresholds", DEFAULT_THRESHOLDS),
+            "projects": {**baseline.get("projects", {}), **results},
+        }, indent=2) + "\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    regressions = compare_to_baseline(results, baseline)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
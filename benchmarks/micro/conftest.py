@@ -0,0 +1,69 @@
+"""Generated inputs for the microbenchmarks, sized like the largest ones seen in real sessions."""
+
+import json
+import random
+import sys
+from pathlib import Path
+
+import pytest
+
+# Add src directory to Python path for imports
+src_path = Path(__file__).parent.parent.parent / "src"
+sys.path.insert(0, str(src_path))
+
+LOG_LINES = 100_000
+SEARCH_RESULTS_BYTES = 5 * 1024 * 1024
+
+PACKAGE_SETS = ["python3Packages", "python312Packages", "haskellPackages", "perlPackages",
+                "nodePackages", "rubyPackages", "ocamlPackages", "luaPackages", "qt6", "libsForQt5"]
+
+
+def generate_build_log(lines: int, seed: int, failure: str) -> str:
+    """A C/C++ build log with compiler invocations and warnings, failing at the end."""
+    rng = random.Random(seed)
+    log = ["Running phase: unpackPhase", "unpacking source archive /nix/store/abc-source",
+           "Running phase: configurePhase", "-- The C compiler identification is GNU 13.2.0"]
+    while len(log) < lines - 3:
+        module = rng.choice(["core", "net", "ui", "util", "io"])
+        index = rng.randrange(2000)
+        log.append(f"[{len(log) * 100 // lines:3d}%] Building CXX object src/{module}/CMakeFiles/{module}.dir/file{index}.cpp.o")
+        if rng.random() < 0.05:
+            log.append(f"/build/source/src/{module}/file{index}.cpp:{rng.randrange(900)}:12: warning: unused variable 'tmp' [-Wunused-variable]")
+    log += [failure, "make[2]: *** [src/CMakeFiles/app.dir/build.make:76: src/app.o] Error 1",
+            "make: *** [Makefile:146: all] Error 2"]
+    return "\n".join(log)
+
+
+@pytest.fixture(scope="session")
+def build_log() -> str:
+    return generate_build_log(LOG_LINES, 1, "/build/source/src/app.cpp:12:10: fatal error: zlib.h: No such file or directory")
+
+
+@pytest.fixture(scope="session")
+def improved_build_log() -> str:
+    return generate_build_log(LOG_LINES, 2, "ld: cannot find -lssl: No such file or directory")
+
+
+@pytest.fixture(scope="session")
+def search_output() -> str:
+    """`nix search --json` output of a broad query, with the platform prefix already removed."""
+    rng = random.Random(3)
+    results = {}
+    size = 0
+    while size < SEARCH_RESULTS_BYTES:
+        index = len(results)
+        name = f"lib{index}" if rng.random() < 0.2 else f"{rng.choice(PACKAGE_SETS)}.lib{index}-bindings"
+        info = {"pname": f"lib{index}", "version": f"{rng.randrange(10)}.{rng.randrange(50)}.{rng.randrange(20)}",
+                "description": f"Library number {index} providing bindings for the lib query, with a long description"}
+        results[name] = info
+        size += len(name) + len(json.dumps(info)) + 4
+    return json.dumps(results)
+
+
+@pytest.fixture(scope="session")
+def model_reply() -> str:
+    """A long model reply with reasoning around the updated package."""
+    reasoning = "\n".join(f"The build fails in step {i} because of a missing dependency, so we add it." for i in range(2000))
+    package = "\n".join(["{ lib, stdenv, fetchFromGitHub, cmake, zlib }:", "", "stdenv.mkDerivation rec {"]
+                        + [f"  # comment {i}\n  buildInputs{i} = [ zlib ];" for i in range(1000)] + ["}"])
+    return f"{reasoning}\n\n```nix\n{package}\n```\n\n{reasoning}"
@@ -0,0 +1,63 @@
+"""Microbenchmarks of the pure functions that run on every iteration of the packaging loop.
+
+Run with `python -m pytest benchmarks/micro`, see the README for comparing against earlier runs.
+"""
+
+import json
+
+import pytest
+
+from vibenix import log_store
+from vibenix.errors import NixError, NixErrorKind
+from vibenix.function_calls import summarize_search_results
+from vibenix.nix import prepare_logs_for_comparison
+from vibenix.parsing import extract_src_attributes, extract_updated_code, substitute_src_attributes
+from vibenix.session import TEMPLATE_DIR
+
+SRC_ATTR = """fetchFromGitHub {
+  owner = "filiparag";
+  repo = "wikiman";
+  rev = "v2.14.1";
+  hash = "sha256-EvYMUHKFJhSFyoW85EEzI7q5OMGGe9c+A2JlkAoxt3o=";
+}"""
+
+
+@pytest.fixture
+def store(tmp_path):
+    previous_store = log_store._log_store
+    log_store.init_log_store(tmp_path / "logs")
+    yield
+    log_store._log_store = previous_store
+
+
+def test_prepare_logs_for_comparison(benchmark, build_log, improved_build_log):
+    comparison = benchmark(prepare_logs_for_comparison, build_log, improved_build_log)
+    assert comparison["initial_lines"] == build_log.count("\n") + 1
+
+
+def test_nix_error_truncated(benchmark, store, build_log):
+    error = NixError(type=NixErrorKind.BUILD_ERROR, error_message=build_log)
+    truncated = benchmark(error.truncated, 256)
+    assert truncated.endswith("Error 2")
+
+
+def test_extract_updated_code(benchmark, model_reply):
+    code = benchmark(extract_updated_code, model_reply)
+    assert code.startswith("{ lib, stdenv")
+
+
+def test_extract_src_attributes(benchmark):
+    version, repo, _, _ = benchmark(extract_src_attributes, SRC_ATTR)
+    assert (version, repo) == ("2.14.1", "wikiman")
+
+
+def test_substitute_src_attributes(benchmark):
+    template = (TEMPLATE_DIR / "package.nix").read_text()
+    version, repo, _, src_attr = extract_src_attributes(SRC_ATTR)
+    filled = benchmark(substitute_src_attributes, template, repo, version, src_attr)
+    assert 'pname = "wikiman"' in filled
+
+
+def test_summarize_search_results(benchmark, search_output):
+    summary = benchmark(lambda: summarize_search_results(json.loads(search_output), "lib"))
+    assert summary.startswith("Found")
@@ -0,0 +1,27 @@
+"""Benchmarks of the start-up latency of vibenix, each run in a fresh interpreter.
+
+Batch workers and `vibenix --help` pay for every module imported before a mode
+is chosen, so a regression here shows up with `--benchmark-compare-fail`.
+"""
+
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC_DIR = Path(__file__).parent.parent.parent / "src"
+
+
+def _run(*args: str):
+    subprocess.run([sys.executable, *args], cwd=SRC_DIR, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@pytest.mark.parametrize("module", ["vibenix.main", "vibenix.batch", "vibenix.packaging_flow.run"])
+def test_import_time(benchmark, module):
+    benchmark.pedantic(_run, args=("-c", f"import {module}"), rounds=5, warmup_rounds=1)
+
+
+def test_help(benchmark):
+    benchmark.pedantic(_run, args=("-m", "vibenix", "--help"), rounds=5, warmup_rounds=1)
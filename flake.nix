@@ -47,7 +47,7 @@
           inherit python;
         }).overrideScope overlay;
 
-        cli-dependencies = with pkgs; [ripgrep fzf jq nurl];
+        cli-dependencies = with pkgs; [ripgrep fzf jq nurl ccache];
       in
       {
         packages = {
@@ -0,0 +1,337 @@
+"""Package a whole dataset of projects in one local run.
+
+Reads packaging requests from the research CSVs (`issue_number,repo_url[,revision]`)
+or from the fetchers generated by `research/generate_nurl_fetches.py`, and runs one
+packaging session per request in a process pool. Every session runs in a new worker
+forked from a warm fork server, see worker_pool.py, so it neither re-imports the model
+libraries nor inherits the state of earlier sessions, and their builds share one
+build scheduler.
+
+Every finished session is appended to `results.jsonl` in the output directory, so an
+interrupted batch continues where it stopped when run again. A `results.csv` table is
+written alongside it. A session `succeeded`, `failed` to find a package, `stopped`
+when its budget ran out, or ended with an `error` when it raised or its worker died.
+Sessions with an error run again from their checkpoint with the next batch, and
+`--retry-failed` also runs failed sessions again from scratch and continues
+stopped ones.
+"""
+
+import argparse
+import csv
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import as_completed
+from contextlib import redirect_stderr, redirect_stdout
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from vibenix.ccl_reader import read_sections
+from vibenix.process import ProcessCancelled
+from vibenix.usage import Budget
+from vibenix.ui.logging_config import logger
+from vibenix.worker_pool import create_worker_pool
+
+RESULTS_FILE = "results.jsonl"
+RESULTS_TABLE = "results.csv"
+RESULT_FIELDS = ["issue_number", "repo_url", "success", "status", "package_name", "iterations", "cost", "elapsed",
+                 "error"]
+
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+STOPPED = "stopped"
+ERROR = "error"
+
+DEFAULT_INPUTS = [
+    Path("research/packaging_requests/used_during_implementation.csv"),
+]
+
+
+@dataclass
+class PackagingRequest:
+    """A project to package."""
+    issue_number: str
+    repo_url: str
+    revision: Optional[str] = None
+    fetcher: Optional[str] = None
+
+
+def _read_fetcher_request(path: Path) -> Optional[PackagingRequest]:
+    """Read a request from a fetcher file, which names its project in a `# URL:` comment."""
+    for line in path.read_text().splitlines():
+        if line.startswith("# URL:"):
+            return PackagingRequest(issue_number=path.stem, repo_url=line.removeprefix("# URL:").strip(),
+                                    fetcher=str(path))
+    logger.warning(f"Skipping {path}: no '# URL:' comment")
+    return None
+
+
+def read_requests(paths: List[Path]) -> List[PackagingRequest]:
+    """Read packaging requests from CSV files and directories of fetcher files, the first request per issue wins."""
+    requests: Dict[str, PackagingRequest] = {}
+    for path in paths:
+        if path.is_dir():
+            found = [_read_fetcher_request(nix_file) for nix_file in sorted(path.glob("*.nix"))]
+        else:
+            with open(path, newline="") as f:
+                found = [
+                    PackagingRequest(issue_number=row["issue_number"], repo_url=row["repo_url"],
+                                     revision=row.get("revision") or None)
+                    for row in csv.DictReader(f) if row.get("repo_url")
+                ]
+        for request in found:
+            if request is not None:
+                requests.setdefault(request.issue_number, request)
+    return list(requests.values())
+
+
+def load_results(results_file: Path) -> Dict[str, dict]:
+    """Load the results of finished sessions, by issue number."""
+    results = {}
+    if results_file.exists():
+        with open(results_file) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result["issue_number"]] = result
+    return results
+
+
+def result_status(result: dict) -> str:
+    """The status of a result, results of older batches only tell whether they succeeded."""
+    return result.get("status") or (SUCCEEDED if result.get("success") else FAILED)
+
+
+def order_by_predicted_cost(requests: List[PackagingRequest], history: Dict[str, dict]) -> List[PackagingRequest]:
+    """Order requests by their predicted run time, longest first.
+
+    The prediction is the run time of a previous session for the same project.
+    Projects without history are assumed to take the median time. Starting the
+    longest sessions first keeps a long one from running alone at the end of the batch.
+    """
+    elapsed = {result["repo_url"]: result["elapsed"] for result in history.values() if result.get("elapsed")}
+    default = statistics.median(elapsed.values()) if elapsed else 0.0
+    return sorted(requests, key=lambda request: elapsed.get(request.repo_url, default), reverse=True)
+
+
+def _read_session_end(ccl_file: Path) -> Dict[str, str]:
+    """Read the values of the session-end section of a CCL log."""
+    return read_sections(ccl_file).get("session-end", {})
+
+
+def _find_package_name(request_dir: Path) -> Optional[str]:
+    for package_file in request_dir.glob("*/package.nix"):
+        return package_file.parent.name
+    return None
+
+
+# Nix backend of the session of a worker process
+_worker_nix_backend = None
+
+
+def init_worker(scheduler, simulate_nix: Optional[List[Path]] = None, nix_time_scale: float = 1.0):
+    """Prepare a worker process for its session."""
+    global _worker_nix_backend
+    from vibenix.build_scheduler import init_build_scheduler
+    if scheduler is not None:
+        init_build_scheduler(scheduler)
+    if simulate_nix:
+        from vibenix.nix_backend import SimulatedNixBackend
+        _worker_nix_backend = SimulatedNixBackend(simulate_nix, time_scale=nix_time_scale)
+
+
+def run_request(request: PackagingRequest, output_dir: Path, budget: Optional[Budget] = None) -> dict:
+    """Run one packaging session, with its console output written to its own log file."""
+    from vibenix.session import Session, use_session
+    from vibenix.ui.conversation import TerminalUIAdapter
+    from vibenix.packaging_flow.run import package_project
+
+    # Fresh flake, error stack and cost for every session
+    session = Session(ui_adapter=TerminalUIAdapter(), nix_backend=_worker_nix_backend, budget=budget)
+    request_dir = output_dir / request.issue_number
+    request_dir.mkdir(parents=True, exist_ok=True)
+
+    code = error = None
+    raised = False
+    start_time = time.monotonic()
+    with open(request_dir / "vibenix.log", "a", buffering=1) as log_file, \
+         redirect_stdout(log_file), redirect_stderr(log_file):
+        handler_id = logger.add(log_file, format="{time:HH:mm:ss} | {level} | {message}", level="INFO")
+        try:
+            with use_session(session):
+                # Sessions that were interrupted with the batch continue from their checkpoint
+                code = package_project(output_dir=str(request_dir), project_url=request.repo_url,
+                                       revision=request.revision, fetcher=request.fetcher, resume=True)
+            if code is None:
+                error = "packaging failed"
+        except (ProcessCancelled, KeyboardInterrupt):
+            # Not a result, the session continues from its checkpoint when the batch runs again
+            logger.info(f"Session for {request.repo_url} was cancelled")
+            raise
+        except BaseException as e:
+            logger.exception(f"Session for {request.repo_url} failed")
+            error = f"{type(e).__name__}: {e}"
+            raised = True
+        finally:
+            logger.remove(handler_id)
+            session.close()
+
+    session_end = _read_session_end(request_dir / "run.ccl")
+    if error is None:
+        status = SUCCEEDED
+    elif raised:
+        status = ERROR
+    elif "stopped" in session_end:
+        # A session whose budget ran out saved its best solution, and can continue from its checkpoint
+        status = STOPPED
+        error = f"stopped: {session_end['stopped']}"
+    else:
+        status = FAILED
+    return {
+        "issue_number": request.issue_number,
+        "repo_url": request.repo_url,
+        "success": status == SUCCEEDED,
+        "status": status,
+        "package_name": _find_package_name(request_dir),
+        "iterations": int(session_end.get("total_iterations", 0)),
+        "cost": float(session_end.get("total_cost", 0.0)),
+        "elapsed": time.monotonic() - start_time,
+        "error": error,
+    }
+
+
+def write_results_table(results: Dict[str, dict], table_file: Path):
+    with open(table_file, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        for result in results.values():
+            writer.writerow({field: result.get(field) for field in RESULT_FIELDS})
+
+
+def pending_requests(requests: List[PackagingRequest], results: Dict[str, dict], output_dir: Path,
+                     retry_failed: bool = False) -> List[PackagingRequest]:
+    """The requests to run: those without a result, those that ended with an error and,
+    with `retry_failed`, the failed and stopped ones.
+
+    Failed sessions start from scratch, the others continue from their checkpoint.
+    """
+    retried = {ERROR, FAILED, STOPPED} if retry_failed else {ERROR}
+    pending = []
+    for request in requests:
+        result = results.get(request.issue_number)
+        if result is not None and result_status(result) not in retried:
+            continue
+        if result is not None and result_status(result) == FAILED:
+            from vibenix.packaging_flow.checkpoint import CHECKPOINT_FILE
+            # Resuming a failed session would only fail again at its iteration limit
+            (output_dir / request.issue_number / CHECKPOINT_FILE).unlink(missing_ok=True)
+        pending.append(request)
+    return pending
+
+
+def run_batch(requests: List[PackagingRequest], output_dir: Path, jobs: int,
+              history: Dict[str, dict], scheduler=None, simulate_nix: Optional[List[Path]] = None,
+              nix_time_scale: float = 1.0, budget: Optional[Budget] = None,
+              retry_failed: bool = False) -> Dict[str, dict]:
+    """Run all requests that have no result yet or are retried, and return the results of all requests."""
+    output_dir.mkdir(parents=True, exist_ok=True)
+    results_file = output_dir / RESULTS_FILE
+    results = load_results(results_file)
+    pending = pending_requests(requests, results, output_dir, retry_failed)
+    pending = order_by_predicted_cost(pending, {**history, **results})
+    retried = sum(1 for request in pending if request.issue_number in results)
+    logger.info(f"{len(results) - retried} requests already done, {len(pending)} to go "
+                f"({retried} retried) with {jobs} workers")
+
+    with create_worker_pool(jobs, initializer=init_worker,
+                            initargs=(scheduler, simulate_nix, nix_time_scale)) as executor, \
+         open(results_file, "a") as checkpoint:
+        futures = {executor.submit(run_request, request, output_dir, budget): request for request in pending}
+        try:
+            for future in as_completed(futures):
+                request = futures[future]
+                try:
+                    result = future.result()
+                except ProcessCancelled:
+                    logger.info(f"{request.issue_number} was cancelled, it runs again with the next batch")
+                    continue
+                except Exception as e:
+                    # The worker process died, e.g. it was OOM-killed
+                    result = {"issue_number": request.issue_number, "repo_url": request.repo_url,
+                              "success": False, "status": ERROR, "error": f"{type(e).__name__}: {e}"}
+                checkpoint.write(json.dumps(result) + "\n")
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+                results[request.issue_number] = result
+                write_results_table(results, output_dir / RESULTS_TABLE)
+                status = "✅" if result["success"] else "❌"
+                logger.info(f"{status} {request.issue_number} {request.repo_url} {result_status(result)} "
+                            f"({len(results)}/{len(requests)})")
+        except KeyboardInterrupt:
+            logger.info("Interrupted, finished sessions are saved, run again to resume")
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+    write_results_table(results, output_dir / RESULTS_TABLE)
+    return results
+
+
+def main(argv: Optional[List[str]] = None):
+    """Entry point of `vibenix batch`."""
+    parser = argparse.ArgumentParser(
+        prog="vibenix batch",
+        description="Package every project of a dataset with a local pool of sessions",
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        type=Path,
+        default=DEFAULT_INPUTS,
+        help="CSV files with issue_number,repo_url[,revision] columns, or directories of fetcher .nix files (default: research/packaging_requests/used_during_implementation.csv)"
+    )
+    parser.add_argument("--output-dir", type=Path, default=Path("batch-output"), help="Directory for the results and one subdirectory per session")
+    parser.add_argument("--jobs", type=int, default=2, help="Number of concurrent sessions (default: 2)")
+    parser.add_argument("--limit", type=int, default=None, help="Only package the first N requests")
+    parser.add_argument("--history", type=Path, nargs="*", default=[], help="results.jsonl files of previous batches, used to predict session run times")
+    parser.add_argument("--build-cores", type=int, default=None, help="Core budget shared by the builds of all sessions (default: all cores)")
+    parser.add_argument("--build-memory", type=int, default=None, help="Memory budget in MB shared by the builds of all sessions (default: all memory)")
+    parser.add_argument("--simulate-nix", type=Path, nargs="+", default=None, metavar="FILE", help="Replay Nix outcomes from corpus files recorded with 'vibenix --record-nix' instead of running Nix")
+    parser.add_argument("--nix-time-scale", type=float, default=1.0, metavar="FACTOR", help="Factor for the recorded durations of simulated Nix operations, 0 replays without delay (default: 1)")
+    parser.add_argument("--max-cost", type=float, default=None, metavar="USD", help="Stop each session once its model calls cost USD dollars")
+    parser.add_argument("--max-tokens", type=int, default=None, metavar="N", help="Stop each session once its model calls used N tokens")
+    parser.add_argument("--max-time", type=float, default=None, metavar="MINUTES", help="Stop each session after MINUTES of wall clock time")
+    parser.add_argument("--retry-failed", action="store_true", help="Run failed sessions again from scratch, and continue the ones stopped by their budget")
+    args = parser.parse_args(argv)
+
+    from vibenix.ui.logging_config import enable_console_logging
+    from vibenix.ui.model_config import load_saved_configuration
+    enable_console_logging()
+    if not load_saved_configuration():
+        logger.error("No saved model configuration found. Please run vibenix interactively first to configure.")
+        sys.exit(1)
+
+    requests = read_requests(args.inputs)[:args.limit]
+    history = {}
+    for history_file in args.history:
+        history.update(load_results(history_file))
+
+    from vibenix.build_scheduler import start_shared_build_scheduler
+    manager, scheduler = start_shared_build_scheduler(cores=args.build_cores, memory_mb=args.build_memory,
+                                                     expected_builds=args.jobs)
+    try:
+        results = run_batch(requests, args.output_dir, args.jobs, history, scheduler,
+                            simulate_nix=args.simulate_nix, nix_time_scale=args.nix_time_scale,
+                            budget=Budget(max_cost=args.max_cost, max_tokens=args.max_tokens,
+                                          max_time=args.max_time * 60 if args.max_time else None),
+                            retry_failed=args.retry_failed)
+    except KeyboardInterrupt:
+        sys.exit(130)
+    finally:
+        manager.shutdown()
+
+    succeeded = sum(1 for result in results.values() if result["success"])
+    total_cost = sum(result.get("cost") or 0.0 for result in results.values())
+    logger.info(f"Packaged {succeeded} of {len(results)} projects, total API cost ${total_cost:.6f}")
+    logger.info(f"Results written to {args.output_dir / RESULTS_TABLE}")
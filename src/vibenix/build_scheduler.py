@@ -0,0 +1,219 @@
+"""Machine-wide scheduling of nix builds.
+
+Without coordination every build runs with nix's default `cores`/`max-jobs`,
+so concurrent sessions oversubscribe the machine and every build gets slower.
+The build scheduler owns a budget of cores and memory. Every build acquires a
+slot before running, which tells it how many cores and jobs it may use.
+When the budget is used up, builds queue in arrival order.
+
+A scheduler can be shared between processes by serving it from a
+multiprocessing manager, see `start_shared_build_scheduler`. Every build names
+the process it runs for, so the slots and queue places of a process that died,
+e.g. a worker that was OOM-killed mid-build, are reclaimed by the waiting builds.
+"""
+
+import itertools
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from multiprocessing.managers import BaseManager
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+
+from vibenix.ccl_log import get_logger
+from vibenix.ui.logging_config import logger
+
+# Rough memory requirement of a compiler process
+DEFAULT_MEMORY_PER_CORE_MB = 1024
+
+# Seconds between two checks of a waiting build for slots of processes that died
+REAP_INTERVAL = 5.0
+
+
+def _total_memory_mb() -> int:
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+
+
+def _process_exists(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@dataclass
+class BuildSlot:
+    """Resources granted to one build."""
+    slot_id: int
+    cores: int
+    max_jobs: int
+    memory_mb: int
+    wait_time: float
+
+    def nix_options(self) -> List[str]:
+        # --cores is per job, so the jobs share the granted cores
+        return ["--max-jobs", str(self.max_jobs), "--cores", str(max(1, self.cores // self.max_jobs))]
+
+
+class BuildScheduler:
+    """Hands out cores and memory to builds, queueing them when the machine is saturated.
+
+    A build gets a fair share of the cores given the demand, so a lone build
+    can use the whole machine while concurrent builds split it. The demand is
+    at least `expected_builds`, the number of builds that usually run at the
+    same time, like the candidates of an iteration or the sessions of a batch.
+    Otherwise the first of them would get all cores and the others, arriving a
+    moment later, would wait for it to finish.
+    """
+
+    def __init__(self, cores: Optional[int] = None, memory_mb: Optional[int] = None,
+                 memory_per_core_mb: int = DEFAULT_MEMORY_PER_CORE_MB, expected_builds: int = 1):
+        self.cores = cores or os.cpu_count() or 1
+        self.memory_mb = memory_mb or _total_memory_mb()
+        self.memory_per_core_mb = memory_per_core_mb
+        self.expected_builds = max(1, expected_builds)
+        self._condition = threading.Condition()
+        self._queue: Deque[int] = deque()
+        self._running: Dict[int, BuildSlot] = {}
+        # Process of every queued and running build, if it named one
+        self._owners: Dict[int, int] = {}
+        self._tickets = itertools.count()
+        self._builds = 0
+        self._total_wait_time = 0.0
+        self._total_run_time = 0.0
+        self._max_wait_time = 0.0
+
+    def _grant(self, jobs: int) -> int:
+        """Number of cores the build at the head of the queue can get right now, 0 if it has to wait."""
+        free_cores = self.cores - sum(slot.cores for slot in self._running.values())
+        free_memory = self.memory_mb - sum(slot.memory_mb for slot in self._running.values())
+        demand = max(self.expected_builds, len(self._running) + len(self._queue))
+        share = max(jobs, self.cores // demand)
+        cores = min(share, free_cores, free_memory // self.memory_per_core_mb)
+        if cores < 1 and not self._running:
+            # Never block a build on an idle machine, even if the memory budget is too small
+            return 1
+        return max(0, cores)
+
+    def _reap(self):
+        """Drop the queued and running builds of processes that died."""
+        dead = [ticket for ticket, pid in self._owners.items() if not _process_exists(pid)]
+        for ticket in dead:
+            pid = self._owners.pop(ticket)
+            if ticket in self._running:
+                slot = self._running.pop(ticket)
+                logger.warning(f"Reclaimed the {slot.cores} cores of a build of process {pid}, which died")
+            else:
+                self._queue.remove(ticket)
+        if dead:
+            self._condition.notify_all()
+
+    def acquire(self, jobs: int = 1, pid: Optional[int] = None) -> BuildSlot:
+        """Wait for resources for a build of `jobs` derivations, run by process `pid`."""
+        start_time = time.monotonic()
+        with self._condition:
+            ticket = next(self._tickets)
+            self._queue.append(ticket)
+            if pid is not None:
+                self._owners[ticket] = pid
+            while True:
+                if ticket not in self._queue:
+                    # Reaped by another build, the process of this one died while it waited
+                    raise ProcessLookupError(f"Process {pid} of the build exited")
+                if self._queue[0] == ticket:
+                    cores = self._grant(jobs)
+                    if cores > 0:
+                        break
+                self._condition.wait(timeout=REAP_INTERVAL)
+                self._reap()
+            self._queue.popleft()
+            wait_time = time.monotonic() - start_time
+            slot = BuildSlot(
+                slot_id=ticket,
+                cores=cores,
+                max_jobs=max(1, min(jobs, cores)),
+                memory_mb=cores * self.memory_per_core_mb,
+                wait_time=wait_time
+            )
+            self._running[ticket] = slot
+            self._total_wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+            # The next build in the queue might fit as well
+            self._condition.notify_all()
+            return slot
+
+    def release(self, slot_id: int, run_time: float = 0.0):
+        """Return the resources of a finished build."""
+        with self._condition:
+            self._running.pop(slot_id, None)
+            self._owners.pop(slot_id, None)
+            self._builds += 1
+            self._total_run_time += run_time
+            self._condition.notify_all()
+
+    def stats(self) -> Dict[str, float]:
+        """Aggregated queue wait and run times of the finished builds."""
+        with self._condition:
+            return {
+                "builds": self._builds,
+                "running": len(self._running),
+                "queued": len(self._queue),
+                "total_wait_time": self._total_wait_time,
+                "max_wait_time": self._max_wait_time,
+                "total_run_time": self._total_run_time,
+            }
+
+
+class SchedulerManager(BaseManager):
+    """Serves a build scheduler to other processes."""
+
+
+SchedulerManager.register("BuildScheduler", BuildScheduler)
+
+
+def start_shared_build_scheduler(**kwargs) -> Tuple[SchedulerManager, BuildScheduler]:
+    """Start a manager process with a scheduler, its proxy can be passed to worker processes."""
+    manager = SchedulerManager()
+    manager.start()
+    return manager, manager.BuildScheduler(**kwargs)
+
+
+# Global scheduler instance, builds are not scheduled if unset
+_scheduler: Optional[BuildScheduler] = None
+
+
+def init_build_scheduler(scheduler: Optional[BuildScheduler] = None) -> BuildScheduler:
+    """Initialize the global build scheduler, or use an existing one like a proxy of a shared scheduler."""
+    global _scheduler
+    _scheduler = scheduler if scheduler is not None else BuildScheduler()
+    return _scheduler
+
+
+def get_build_scheduler() -> Optional[BuildScheduler]:
+    """Get the global build scheduler, if builds are scheduled."""
+    return _scheduler
+
+
+@contextmanager
+def scheduled_build(jobs: int = 1) -> Iterator[List[str]]:
+    """Wait for a build slot, and yield the nix options that limit the build to it."""
+    scheduler = get_build_scheduler()
+    if scheduler is None:
+        yield []
+        return
+
+    slot = scheduler.acquire(jobs, pid=os.getpid())
+    if slot.wait_time > 1:
+        logger.info(f"Build waited {slot.wait_time:.1f}s for {slot.cores} cores")
+    start_time = time.monotonic()
+    try:
+        yield slot.nix_options()
+    finally:
+        run_time = time.monotonic() - start_time
+        scheduler.release(slot.slot_id, run_time)
+        get_logger().log_build_schedule(slot.wait_time, run_time, slot.cores, slot.max_jobs)
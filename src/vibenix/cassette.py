@@ -0,0 +1,258 @@
+"""Recording and replaying model exchanges.
+
+A session can record every model request and the streamed response to a
+cassette, a JSON lines file with one exchange per line. This includes all
+tool call turns, since every turn is a request of its own. Replaying the
+cassette serves the recorded responses instead of calling the model, either
+with their original timing or as fast as possible, so end-to-end runs can be
+reproduced and profiled offline without paying for model calls.
+
+Both work by standing in for `litellm.completion`, which the chat model calls
+for every request. Requests of sessions without a cassette are passed through.
+"""
+
+import hashlib
+import json
+import threading
+import time
+import warnings
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+import litellm
+from litellm.types.utils import ModelResponseStream
+
+from vibenix.session import PROMPT_METADATA_KEY, ROUTED_METADATA_KEY, SESSION_ID_METADATA_KEY, Session, find_session, get_session
+from vibenix.ui.logging_config import logger
+from vibenix.usage import ModelCall
+
+CASSETTE_VERSION = 1
+
+
+class ReplaySpeed(Enum):
+    REALTIME = "realtime"
+    ASAP = "asap"
+
+
+class CassetteExhausted(RuntimeError):
+    """The replayed session made more model requests than were recorded."""
+
+
+def request_key(request: Dict[str, Any]) -> str:
+    """Identify a request by everything that influences the response."""
+    relevant = {name: request.get(name) for name in ("model", "messages", "tools", "tool_choice", "stop")}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+
+@dataclass
+class Exchange:
+    """A model request with its streamed response chunks."""
+    key: str
+    request: Dict[str, Any]
+    # Chunks with their time since the request was sent
+    chunks: List[Tuple[float, Dict[str, Any]]] = field(default_factory=list)
+    cost: float = 0.0
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "version": CASSETTE_VERSION,
+            "key": self.key,
+            "request": self.request,
+            "chunks": self.chunks,
+            "cost": self.cost,
+        }, default=str)
+
+    def tool_calls(self) -> List[str]:
+        """Names of the functions the model called in its response."""
+        names = []
+        for _, chunk in self.chunks:
+            for choice in chunk.get("choices") or []:
+                for tool_call in (choice.get("delta") or {}).get("tool_calls") or []:
+                    name = (tool_call.get("function") or {}).get("name")
+                    if name:
+                        names.append(name)
+        return names
+
+    def usage(self) -> Tuple[int, int]:
+        """Prompt and completion tokens, counted locally if the provider did not report them."""
+        for _, chunk in reversed(self.chunks):
+            usage = chunk.get("usage")
+            if usage and usage.get("prompt_tokens") is not None:
+                return usage["prompt_tokens"], usage.get("completion_tokens") or 0
+        model = self.request.get("model") or ""
+        text = "".join((choice.get("delta") or {}).get("content") or ""
+                       for _, chunk in self.chunks for choice in chunk.get("choices") or [])
+        return (litellm.token_counter(model=model, messages=self.request.get("messages") or []),
+                litellm.token_counter(model=model, text=text) if text else 0)
+
+    def cached_tokens(self) -> int:
+        """Prompt tokens the provider served from its prompt cache."""
+        for _, chunk in reversed(self.chunks):
+            usage = chunk.get("usage")
+            if usage:
+                return (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        return 0
+
+    @classmethod
+    def from_json(cls, line: str) -> "Exchange":
+        data = json.loads(line)
+        if data.get("version") != CASSETTE_VERSION:
+            raise ValueError(f"Unsupported cassette version {data.get('version')}")
+        return cls(key=data["key"], request=data["request"],
+                   chunks=[(delay, chunk) for delay, chunk in data["chunks"]], cost=data["cost"])
+
+
+def _recorded_request(kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: kwargs.get(name) for name in ("model", "messages", "tools", "tool_choice", "stop")}
+
+
+def _completion_cost(chunks: List[Any]) -> float:
+    try:
+        with warnings.catch_warnings():
+            # The rebuilt response does not match litellm's own serialization schema
+            warnings.simplefilter("ignore", UserWarning)
+            return litellm.completion_cost(completion_response=litellm.stream_chunk_builder(chunks)) or 0.0
+    except Exception:
+        # Unknown models have no price
+        return 0.0
+
+
+class Cassette(ABC):
+    """Where the model exchanges of a session come from or go to."""
+
+    @abstractmethod
+    def completion(self, session: Session, real_completion: Callable[..., Any], **kwargs) -> Iterator[Any]:
+        """Stream the chunks of a completion request of the session."""
+        pass
+
+    def close(self):
+        pass
+
+
+class RecordingCassette(Cassette):
+    """Passes requests on to the model and appends the exchanges to a cassette file."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "w", buffering=1)
+        self._lock = threading.Lock()
+
+    def completion(self, session: Session, real_completion: Callable[..., Any], **kwargs) -> Iterator[Any]:
+        start_time = time.monotonic()
+        stream = real_completion(**kwargs)
+        exchange = Exchange(key=request_key(kwargs), request=_recorded_request(kwargs))
+        chunks = []
+        # Iterating the whole litellm stream also runs its success callbacks, like the cost logger
+        for chunk in stream:
+            exchange.chunks.append((time.monotonic() - start_time, chunk.model_dump(mode="json")))
+            chunks.append(chunk)
+            yield chunk
+        exchange.cost = _completion_cost(chunks)
+        with self._lock:
+            self._file.write(exchange.to_json() + "\n")
+
+    def close(self):
+        self._file.close()
+
+
+class ReplayingCassette(Cassette):
+    """Serves recorded responses instead of calling the model.
+
+    Requests are matched by their content first. Requests that differ from the
+    recording, e.g. because a tool result contains a temporary path, get the
+    next unused response in recording order.
+    """
+
+    def __init__(self, path: Path, speed: ReplaySpeed = ReplaySpeed.REALTIME):
+        self.path = Path(path)
+        self.speed = speed
+        with open(self.path) as f:
+            self._exchanges = [Exchange.from_json(line) for line in f if line.strip()]
+        self._by_key: Dict[str, Deque[Exchange]] = {}
+        for exchange in self._exchanges:
+            self._by_key.setdefault(exchange.key, deque()).append(exchange)
+        self._used: set = set()
+        # Replayed exchanges, in the order they were served
+        self.served: List[Exchange] = []
+        self._lock = threading.Lock()
+        logger.info(f"Replaying {len(self._exchanges)} model exchanges from {self.path}")
+
+    def _next_exchange(self, key: str) -> Exchange:
+        with self._lock:
+            matches = self._by_key.get(key)
+            while matches:
+                exchange = matches.popleft()
+                if id(exchange) not in self._used:
+                    self._used.add(id(exchange))
+                    self.served.append(exchange)
+                    return exchange
+            for exchange in self._exchanges:
+                if id(exchange) not in self._used:
+                    logger.warning("Model request differs from the recording, replaying the next recorded response")
+                    self._used.add(id(exchange))
+                    self.served.append(exchange)
+                    return exchange
+        raise CassetteExhausted(f"All {len(self._exchanges)} recorded model exchanges of {self.path} were replayed")
+
+    def completion(self, session: Session, real_completion: Callable[..., Any], **kwargs) -> Iterator[Any]:
+        exchange = self._next_exchange(request_key(kwargs))
+        start_time = time.monotonic()
+        for delay, chunk in exchange.chunks:
+            if self.speed == ReplaySpeed.REALTIME:
+                time.sleep(max(0.0, start_time + delay - time.monotonic()))
+            yield ModelResponseStream(**chunk)
+        # litellm is bypassed, so its usage callback does not see replayed responses
+        prompt_tokens, completion_tokens = exchange.usage()
+        metadata = kwargs.get("metadata") or {}
+        session.record_model_call(ModelCall(
+            prompt=metadata.get(PROMPT_METADATA_KEY) or "unknown",
+            model=exchange.request.get("model") or "unknown",
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            cached_tokens=exchange.cached_tokens(),
+            time_to_first_token=exchange.chunks[0][0] if exchange.chunks else None,
+            latency=exchange.chunks[-1][0] if exchange.chunks else 0.0,
+            cost=exchange.cost,
+            routed=bool(metadata.get(ROUTED_METADATA_KEY)),
+        ))
+
+    @property
+    def remaining(self) -> int:
+        with self._lock:
+            return len(self._exchanges) - len(self._used)
+
+    def close(self):
+        if self.remaining:
+            logger.warning(f"{self.remaining} recorded model exchanges were not replayed")
+
+
+_real_completion: Optional[Callable[..., Any]] = None
+_install_lock = threading.Lock()
+
+
+def _completion(*args, **kwargs):
+    metadata = kwargs.get("metadata") or {}
+    session = find_session(metadata.get(SESSION_ID_METADATA_KEY)) or get_session()
+    if session.cassette is None or args or not kwargs.get("stream"):
+        return _real_completion(*args, **kwargs)
+    return session.cassette.completion(session, _real_completion, **kwargs)
+
+
+def install():
+    """Route litellm completions through the cassettes of the sessions."""
+    global _real_completion
+    with _install_lock:
+        if _real_completion is None:
+            _real_completion = litellm.completion
+            litellm.completion = _completion
+
+
+def use_cassette(session: Session, cassette: Cassette):
+    """Record or replay the model exchanges of a session."""
+    install()
+    session.cassette = cassette
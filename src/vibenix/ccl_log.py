@@ -4,15 +4,45 @@ Structured logging in CCL (Categorical Configuration Language) format for Vibeni
 Based on: https://chshersh.com/blog/2025-01-06-the-most-elegant-configuration-language.html
 """
 
+import contextvars
 import hashlib
+import itertools
+import threading
 import time
 from datetime import datetime
 from pathlib import Path
-from typing import Any, Dict, Optional, TextIO
+from typing import Any, Dict, Iterator, Optional, TextIO
 from dataclasses import dataclass, field
 from contextlib import contextmanager
 
 from .errors import NixBuildErrorDiff, NixBuildResult
+from .session import get_session
+from .usage import ModelCall, PromptUsage
+
+
+@dataclass
+class Span:
+    """A timed block of a session, nested in the span that was current when it started."""
+    name: str
+    span_id: int
+    parent: Optional['Span']
+    start: float
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    # Time spent in child spans, children on other threads can overlap
+    children_time: float = 0.0
+
+    def set(self, **attributes):
+        """Add attributes that are only known while the span runs, like an exit code."""
+        self.attributes.update(attributes)
+
+
+@dataclass
+class SpanTotals:
+    """Aggregated durations of the spans of one name."""
+    count: int = 0
+    total_time: float = 0.0
+    self_time: float = 0.0
+    max_time: float = 0.0
 
 
 @dataclass
@@ -23,24 +53,34 @@ class CCLLogger:
     """
     
     log_file: Path
+    # Continue the log of a resumed session instead of starting a new one
+    append: bool = False
     _file_handle: TextIO = field(init=False)
     _current_indent: int = field(default=0, init=False)
     _start_time: float = field(init=False)
+    # Builds running concurrently log from several threads
+    _lock: threading.RLock = field(default_factory=threading.RLock, init=False)
+    # Spans are written inside of the current iteration once the agentic loop started
+    _in_iterations: bool = field(default=False, init=False)
+    _span_totals: Dict[str, SpanTotals] = field(default_factory=dict, init=False)
     
     def __post_init__(self):
-        self._file_handle = open(self.log_file, 'w', buffering=1)
+        self._file_handle = open(self.log_file, 'a' if self.append else 'w', buffering=1)
         self._start_time = time.time()
         self._write_header()
     
     def _write_header(self):
         """Write header with metadata."""
         # TODO: add things like model version and a commit hash
-        self._write("start_time = " + datetime.now().isoformat(), 0)
+        if self.append:
+            self._write("resume_time = " + datetime.now().isoformat(), 0)
+        else:
+            self._write("start_time = " + datetime.now().isoformat(), 0)
         self._write("")
     
-    def _elapsed_time(self) -> str:
-        """Get elapsed time since start formatted as hh:mm:ss.mmm."""
-        elapsed = time.time() - self._start_time
+    def _elapsed_time(self, at: Optional[float] = None) -> str:
+        """Get elapsed time since start (or until `at`) formatted as hh:mm:ss.mmm."""
+        elapsed = (time.time() if at is None else at) - self._start_time
         hours = int(elapsed // 3600)
         minutes = int((elapsed % 3600) // 60)
         seconds = elapsed % 60
@@ -52,17 +92,18 @@ class CCLLogger:
     
     def _write(self, line: str, indent_level=None):
         """Write a line with current indentation."""
-        if not indent_level:
+        if indent_level is None:
             indent_level = self._current_indent
         self._file_handle.write("  " * indent_level + line + "\n")
 
     @contextmanager
     def _section_begin(self, section_head, indent_level):
         """Context manager for writing indented sections."""
-        self._write(section_head, indent_level)
-        self._current_indent = indent_level + 1
-        yield
-        self._current_indent = indent_level
+        with self._lock:
+            self._write(section_head, indent_level)
+            self._current_indent = indent_level + 1
+            yield
+            self._current_indent = indent_level
 
     def _section_content(self, indent_level):
         """Context manager for writing indented sections."""
@@ -77,14 +118,35 @@ class CCLLogger:
             self._write("elapsed = " + self._elapsed_time())
             self._write("project_url = " + project_url)
     
-    def log_session_end(self, success: bool, total_iterations: int, total_cost: float = None):
-        """Log the end of a packaging session."""
+    def log_session_resume(self, iteration: int):
+        """Log the resumption of a packaging session from a checkpoint."""
+        with self._section_begin("session-resume =", 0):
+            self._write("elapsed = " + self._elapsed_time())
+            self._write(f"iteration = {iteration}")
+
+    def log_session_end(self, success: bool, total_iterations: int, total_cost: float = None,
+                        stopped: Optional[str] = None):
+        """Log the end of a packaging session, with the time spent in each kind of span.
+
+        `stopped` is why a session that did not succeed stopped before it failed, e.g. its exhausted budget.
+        """
         with self._section_begin("session-end =", 0):
             self._write("elapsed = " + self._elapsed_time())
             self._write("success = " + ("true" if success else "false"))
+            if stopped is not None:
+                self._write("stopped = " + stopped)
             self._write("total_iterations = " + str(total_iterations))
             if total_cost is not None:
                 self._write(f"total_cost = {total_cost:.6f}")
+            if self._span_totals:
+                with self._section_begin("breakdown =", 1):
+                    for name, totals in sorted(self._span_totals.items(), key=lambda item: -item[1].total_time):
+                        with self._section_begin(f"{name} =", 2):
+                            self._write(f"count = {totals.count}")
+                            self._write(f"total_time = {totals.total_time:.3f}")
+                            self._write(f"self_time = {totals.self_time:.3f}")
+                            self._write(f"max_time = {totals.max_time:.3f}")
+        self._in_iterations = False
     
     def log_template_selected(self, template: str):
         """Log template selection."""
@@ -105,6 +167,7 @@ class CCLLogger:
     def log_before_iterations(self):
         """Log template selection."""
         self._write("iteration =", 0)
+        self._in_iterations = True
     
     def log_iteration_start(self, iteration: int):
         """Log the start of a build iteration."""
@@ -133,6 +196,106 @@ class CCLLogger:
             for key, value in kwargs.items():
                 self._write(f"{key} = {value}")
     
+    def log_candidates(self, iteration: int, count: int, selected: int, build_time: float):
+        """Log the fix candidates built in parallel during an iteration."""
+        with self._section_begin("candidates =", 2):
+            self._write("elapsed = " + self._elapsed_time())
+            self._write(f"count = {count}")
+            self._write(f"selected = {selected}")
+            self._write(f"build_time = {build_time:.3f}")
+
+    def log_beam(self, iteration: int, width: int, new_solutions: int, new_members: int, build_time: float):
+        """Log a round of beam search."""
+        with self._section_begin("beam =", 2):
+            self._write("elapsed = " + self._elapsed_time())
+            self._write(f"width = {width}")
+            self._write(f"new_solutions = {new_solutions}")
+            self._write(f"new_members = {new_members}")
+            self._write(f"build_time = {build_time:.3f}")
+
+    def log_build_schedule(self, wait_time: float, run_time: float, cores: int, max_jobs: int):
+        """Log the queue wait and run time of a scheduled build."""
+        with self._section_begin("build_schedule =", 2):
+            self._write("elapsed = " + self._elapsed_time())
+            self._write(f"wait_time = {wait_time:.3f}")
+            self._write(f"run_time = {run_time:.3f}")
+            self._write(f"cores = {cores}")
+            self._write(f"max_jobs = {max_jobs}")
+
+    def log_compiler_cache_stats(self, hits: int, misses: int):
+        """Log the compiler cache statistics of a build."""
+        with self._section_begin("compiler_cache =", 2):
+            self._write("elapsed = " + self._elapsed_time())
+            self._write(f"hits = {hits}")
+            self._write(f"misses = {misses}")
+
+    def log_process_stats(self, stats: Dict[str, Any]):
+        """Log the run time and exit statistics of the external commands of the session, by program."""
+        with self._section_begin("process-stats =", 0):
+            for program, program_stats in sorted(stats.items()):
+                with self._section_begin(f"{program} =", 1):
+                    self._write(f"calls = {program_stats.calls}")
+                    self._write(f"failures = {program_stats.failures}")
+                    self._write(f"timeouts = {program_stats.timeouts}")
+                    self._write(f"cancelled = {program_stats.cancelled}")
+                    self._write(f"total_time = {program_stats.total_time:.3f}")
+                    self._write(f"max_time = {program_stats.max_time:.3f}")
+
+    def log_model_call(self, call: ModelCall):
+        """Log a model request with its tokens, latency and cost."""
+        with self._section_begin("model_call =", 2 if self._in_iterations else 0):
+            self._write("elapsed = " + self._elapsed_time())
+            self._write("prompt = " + call.prompt)
+            self._write("model = " + call.model)
+            self._write(f"routed = {str(call.routed).lower()}")
+            self._write(f"prompt_tokens = {call.prompt_tokens}")
+            self._write(f"completion_tokens = {call.completion_tokens}")
+            self._write(f"cached_tokens = {call.cached_tokens}")
+            if call.time_to_first_token is not None:
+                self._write(f"time_to_first_token = {call.time_to_first_token:.3f}")
+            self._write(f"latency = {call.latency:.3f}")
+            self._write(f"cost = {call.cost:.6f}")
+
+    def log_model_usage(self, usage: Dict[str, PromptUsage]):
+        """Log the model usage of the session, by prompt."""
+        with self._section_begin("model-usage =", 0):
+            for prompt, prompt_usage in sorted(usage.items(), key=lambda item: -item[1].cost):
+                with self._section_begin(f"{prompt} =", 1):
+                    self._write("model = " + prompt_usage.model)
+                    self._write(f"calls = {prompt_usage.calls}")
+                    self._write(f"prompt_tokens = {prompt_usage.prompt_tokens}")
+                    self._write(f"completion_tokens = {prompt_usage.completion_tokens}")
+                    self._write(f"cached_tokens = {prompt_usage.cached_tokens}")
+                    self._write(f"cost = {prompt_usage.cost:.6f}")
+                    self._write(f"total_latency = {prompt_usage.total_latency:.3f}")
+                    self._write(f"max_latency = {prompt_usage.max_latency:.3f}")
+
+    def log_budget_exceeded(self, reason: str):
+        """Log that the session stopped early because its budget was exhausted."""
+        with self._section_begin("budget-exceeded =", 0):
+            self._write("elapsed = " + self._elapsed_time())
+            self._write("reason = " + reason)
+
+    def log_span(self, span: Span, duration: float):
+        """Log a finished span and add it to the breakdown of the session."""
+        self_time = max(0.0, duration - span.children_time)
+        with self._lock:
+            totals = self._span_totals.setdefault(span.name, SpanTotals())
+            totals.count += 1
+            totals.total_time += duration
+            totals.self_time += self_time
+            totals.max_time = max(totals.max_time, duration)
+            with self._section_begin("span =", 2 if self._in_iterations else 0):
+                self._write("name = " + span.name)
+                self._write(f"id = {span.span_id}")
+                if span.parent is not None:
+                    self._write(f"parent = {span.parent.span_id}")
+                self._write("start = " + self._elapsed_time(span.start))
+                self._write(f"duration = {duration:.3f}")
+                for key, value in span.attributes.items():
+                    if value is not None:
+                        self._write(f"{key} = {value}")
+
     def log_error(self, error_type: str, message: str, context: Optional[Dict[str, Any]] = None):
         """Log an error with context."""
         with self._section_begin("error =", 0):
@@ -145,27 +308,61 @@ class CCLLogger:
                         self._write(f"{key} = {value}")
 
 
-# Global logger instance
-_logger: CCLLogger = None
+_span_ids = itertools.count(1)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("vibenix_span", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span]:
+    """Time a block as a span in the CCL log of the current session.
+
+    Spans nest along the call stack, including into work submitted with
+    `submit_in_session`. Without a CCL logger the span is timed but not logged.
+    """
+    session = get_session()
+    parent = _current_span.get()
+    current = Span(name=name, span_id=next(_span_ids), parent=parent, start=time.time(), attributes=attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.attributes.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        duration = time.time() - current.start
+        if parent is not None:
+            with session.lock:
+                parent.children_time += duration
+        if session.ccl_logger is not None:
+            session.ccl_logger.log_span(current, duration)
+        if session.trace is not None:
+            session.trace.add_span(current, duration)
+
+
+def current_span() -> Optional[Span]:
+    """The innermost span of the current thread or task."""
+    return _current_span.get()
 
 
-def init_logger(log_file: Path) -> CCLLogger:
-    """Initialize the global CCL logger."""
-    global _logger
-    _logger = CCLLogger(log_file=log_file)
-    return _logger
+def init_logger(log_file: Path, append: bool = False) -> CCLLogger:
+    """Initialize the CCL logger of the current session."""
+    session = get_session()
+    session.ccl_logger = CCLLogger(log_file=log_file, append=append)
+    return session.ccl_logger
 
 
 def get_logger() -> CCLLogger:
-    """Get the global CCL logger instance."""
-    if _logger is None:
+    """Get the CCL logger of the current session."""
+    ccl_logger = get_session().ccl_logger
+    if ccl_logger is None:
         raise RuntimeError("CCL logger not initialized. Call init_logger() first.")
-    return _logger
+    return ccl_logger
 
 
 def close_logger():
-    """Close the global logger."""
-    global _logger
-    if _logger:
-        _logger.close()
-        _logger = None
+    """Close the logger of the current session."""
+    session = get_session()
+    if session.ccl_logger:
+        session.ccl_logger.close()
+        session.ccl_logger = None
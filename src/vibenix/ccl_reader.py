@@ -0,0 +1,149 @@
+"""
+Streaming reader for the CCL logs written by ccl_log.py.
+
+Logs are read line by line, so summarizing a session takes constant memory
+regardless of the size of its log. `iter_entries` yields the raw entries of a
+log with the sections they are nested in, `summarize_session` folds them into
+a `SessionSummary` of the metrics that are compared across runs.
+"""
+
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+# Top-level CCL sections that start each stage, in order
+STAGE_BOUNDARIES = [
+    ("analysis_time", "session-start", "template-selected"),
+    ("initial_build_time", "template-selected", "initial-build"),
+    ("fix_loop_time", "initial-build", "session-end"),
+]
+
+STAGES = [stage for stage, _, _ in STAGE_BOUNDARIES]
+
+
+@dataclass
+class CCLEntry:
+    """A `key = value` line of a CCL log, or a section head with a value of None."""
+    path: Tuple[str, ...]
+    key: str
+    value: Optional[str]
+
+
+def parse_elapsed(elapsed: str) -> float:
+    """Seconds of a CCL `elapsed` value formatted as hh:mm:ss.mmm."""
+    hours, minutes, seconds = elapsed.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def iter_entries(lines: Iterable[str]) -> Iterator[CCLEntry]:
+    """Parse CCL lines into entries, each with the heads of the sections it is nested in.
+
+    Iteration heads like `= 3 =` are sections named by their number. Lines that
+    are neither an entry nor a section head, like continuation lines of a
+    multi-line value, are skipped.
+    """
+    path = []
+    for line in lines:
+        stripped = line.strip()
+        if not stripped:
+            continue
+        depth = (len(line) - len(line.lstrip(" "))) // 2
+        del path[depth:]
+        key, separator, value = stripped.partition(" = ")
+        if separator:
+            yield CCLEntry(tuple(path), key, value)
+        elif stripped.endswith("="):
+            head = stripped.removesuffix("=").strip().removeprefix("= ")
+            yield CCLEntry(tuple(path), head, None)
+            # Keep the depth of sections that follow a skipped level, like spans before an iteration head
+            path += [""] * (depth - len(path)) + [head]
+
+
+def read_sections(ccl_file: Path) -> Dict[str, Dict[str, str]]:
+    """Read the values of the top-level sections of a CCL log, the last section of a name wins."""
+    sections: Dict[str, Dict[str, str]] = {}
+    if not ccl_file.exists():
+        return sections
+    with open(ccl_file) as f:
+        for entry in iter_entries(f):
+            if not entry.path and entry.value is None:
+                sections[entry.key] = {}
+            elif len(entry.path) == 1 and entry.value is not None:
+                sections.setdefault(entry.path[0], {})[entry.key] = entry.value
+    return sections
+
+
+def stage_times(sections: Dict[str, Dict[str, str]]) -> Dict[str, float]:
+    """Wall time of the stages of a session that reached them."""
+    times = {}
+    for stage, start, end in STAGE_BOUNDARIES:
+        if "elapsed" in sections.get(start, {}) and "elapsed" in sections.get(end, {}):
+            times[stage] = parse_elapsed(sections[end]["elapsed"]) - parse_elapsed(sections[start]["elapsed"])
+    return times
+
+
+@dataclass
+class SessionSummary:
+    """The metrics of one packaging session, from its CCL log."""
+    log_file: Path
+    project_url: Optional[str] = None
+    template: Optional[str] = None
+    initial_build: Optional[str] = None
+    # None if the session did not finish
+    success: Optional[bool] = None
+    iterations: Optional[int] = None
+    cost: Optional[float] = None
+    wall_time: Optional[float] = None
+    stage_times: Dict[str, float] = field(default_factory=dict)
+    tool_calls: Counter = field(default_factory=Counter)
+
+
+# Top-level sections whose values are needed for the summary
+_SUMMARY_SECTIONS = {"session-start", "template-selected", "initial-build", "session-end"}
+
+
+def summarize_session(ccl_file: Path) -> SessionSummary:
+    """Summarize a session in a single pass over its CCL log.
+
+    Tool calls are counted from the `tool` spans of the log. Logs written
+    before spans existed only have `function_call` sections, which are counted
+    instead.
+    """
+    summary = SessionSummary(log_file=ccl_file)
+    sections: Dict[str, Dict[str, str]] = {}
+    span_tools: Counter = Counter()
+    function_calls: Counter = Counter()
+    in_tool_span = False
+    with open(ccl_file) as f:
+        for entry in iter_entries(f):
+            if entry.value is None:
+                if not entry.path and entry.key in _SUMMARY_SECTIONS:
+                    sections[entry.key] = {}
+                in_tool_span = False
+                continue
+            if len(entry.path) == 1 and entry.path[0] in sections:
+                sections[entry.path[0]][entry.key] = entry.value
+            elif entry.path and entry.path[-1] == "function_call" and entry.key == "name":
+                function_calls[entry.value] += 1
+            elif entry.path and entry.path[-1] == "span":
+                if entry.key == "name":
+                    in_tool_span = entry.value == "tool"
+                elif entry.key == "function" and in_tool_span:
+                    span_tools[entry.value] += 1
+
+    summary.tool_calls = span_tools if span_tools else function_calls
+    summary.project_url = sections.get("session-start", {}).get("project_url")
+    summary.template = sections.get("template-selected", {}).get("name")
+    summary.initial_build = sections.get("initial-build", {}).get("result")
+    session_end = sections.get("session-end")
+    if session_end:
+        summary.success = session_end.get("success") == "true"
+        if "total_iterations" in session_end:
+            summary.iterations = int(session_end["total_iterations"])
+        if "total_cost" in session_end:
+            summary.cost = float(session_end["total_cost"])
+        if "elapsed" in session_end:
+            summary.wall_time = parse_elapsed(session_end["elapsed"])
+    summary.stage_times = stage_times(sections)
+    return summary
@@ -0,0 +1,137 @@
+"""Persistent compiler cache shared between the builds of a packaging session.
+
+When enabled, the template flake routes C/C++ compilation through ccache and
+Rust compilation through sccache, both storing their objects in a directory
+that is exposed to the build sandbox with `extra-sandbox-paths`.
+Only the translation units that changed since a previous attempt are recompiled.
+The `uncached` package output builds without the cache, and is used to verify
+successful builds.
+
+Every build writes its cache statistics to its own file in the `stats`
+directory, named after the output path of its derivation: ccache through
+`CCACHE_STATSLOG`, sccache with `sccache --show-stats --stats-format=json`
+at the end of the build, as its server only lives as long as the build.
+"""
+
+import json
+import os
+import re
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from vibenix import process
+from vibenix.session import get_session
+from vibenix.ui.logging_config import logger
+
+FLAKE_FILE = "compiler-cache.nix"
+UNCACHED_ATTR = "uncached"
+
+CCACHE_HIT_KEYS = ("direct_cache_hit", "preprocessed_cache_hit")
+CCACHE_MISS_KEYS = ("cache_miss",)
+
+STATS_DIR = "stats"
+
+
+def enabled() -> bool:
+    return get_session().compiler_cache_dir is not None
+
+
+def init_compiler_cache(cache_dir: Path):
+    """Create the cache directory, writable by the nix build users."""
+    for subdir in ("", "ccache", "sccache", STATS_DIR):
+        path = cache_dir / subdir
+        path.mkdir(parents=True, exist_ok=True)
+        try:
+            os.chmod(path, 0o777)
+        except PermissionError:
+            logger.warning(f"Could not make {path} writable for the nix build users")
+    get_session().compiler_cache_dir = cache_dir
+
+
+def write_flake_config(flake_dir: Path):
+    """Enable the compiler cache in the template flake."""
+    if not enabled():
+        return
+    (flake_dir / FLAKE_FILE).write_text(f'{{ dir = "{get_session().compiler_cache_dir}"; }}\n')
+
+
+def nix_options() -> List[str]:
+    """Extra `nix build` options to expose the cache directory to the sandbox.
+
+    Only honored for trusted users, otherwise the directory has to be
+    added to `extra-sandbox-paths` in nix.conf.
+    """
+    if not enabled():
+        return []
+    return ["--option", "extra-sandbox-paths", str(get_session().compiler_cache_dir)]
+
+
+def verification_attr() -> str:
+    """The flake package output that successful builds are verified with."""
+    return UNCACHED_ATTR if enabled() else "default"
+
+
+def _stats_files(derivation_path: str) -> Optional[Tuple[Path, Path]]:
+    """The ccache and sccache statistics files of the build of a derivation, None if its output is unknown."""
+    try:
+        derivation = Path(derivation_path).read_text()
+    except OSError:
+        return None
+    # The builder names the files after its $out, the first output named "out" in the derivation
+    match = re.search(r'\("out","(/nix/store/[^"]+)"', derivation)
+    if match is None:
+        return None
+    stats_dir = get_session().compiler_cache_dir / STATS_DIR
+    output_name = Path(match.group(1)).name
+    return stats_dir / f"{output_name}.ccache", stats_dir / f"{output_name}.sccache.json"
+
+
+def zero_stats(derivation_path: str):
+    """Remove the statistics of an earlier build of the derivation."""
+    files = _stats_files(derivation_path)
+    for stats_file in files or ():
+        stats_file.unlink(missing_ok=True)
+
+
+def _read_ccache_stats(stats_log: Path) -> Optional[Dict[str, int]]:
+    if not stats_log.exists() or shutil.which("ccache") is None:
+        return None
+    env = dict(os.environ, CCACHE_DIR=str(get_session().compiler_cache_dir / "ccache"), CCACHE_STATSLOG=str(stats_log))
+    result = process.run(["ccache", "--print-log-stats"], env=env, timeout=30)
+    if result.returncode != 0:
+        return None
+    stats = {}
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            stats[key] = int(value)
+    return {
+        "hits": sum(stats.get(key, 0) for key in CCACHE_HIT_KEYS),
+        "misses": sum(stats.get(key, 0) for key in CCACHE_MISS_KEYS),
+    }
+
+
+def _read_sccache_stats(stats_file: Path) -> Optional[Dict[str, int]]:
+    try:
+        stats = json.loads(stats_file.read_text())["stats"]
+    except (OSError, ValueError, KeyError):
+        return None
+    # Hits and misses are counted per language
+    return {
+        "hits": sum(stats.get("cache_hits", {}).get("counts", {}).values()),
+        "misses": sum(stats.get("cache_misses", {}).get("counts", {}).values()),
+    }
+
+
+def read_stats(derivation_path: str) -> Optional[Dict[str, int]]:
+    """Read the ccache and sccache hits and misses of the last build of the derivation."""
+    files = _stats_files(derivation_path)
+    if files is None:
+        return None
+    ccache_file, sccache_file = files
+    parts = [stats for stats in (_read_ccache_stats(ccache_file), _read_sccache_stats(sccache_file))
+             if stats is not None]
+    if not parts:
+        return None
+    return {key: sum(stats[key] for stats in parts) for key in ("hits", "misses")}
@@ -1,8 +1,43 @@
 """Error types for the vibenix build system."""
 
+import re
 from enum import Enum
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, model_validator
+from typing import Any, Optional
+
+from vibenix.log_store import get_log_store
+
+# Number of trailing lines kept in memory with every error
+SUMMARY_LINES = 8
+
+# The stdenv phases in the order they run, a build that failed in a later phase got further
+BUILD_PHASES = ("unpackPhase", "patchPhase", "configurePhase", "buildPhase", "checkPhase",
+                "installPhase", "fixupPhase", "installCheckPhase", "distPhase")
+
+# What older stdenvs print when a phase starts
+_LEGACY_PHASE_MESSAGES = {
+    "unpacking sources": "unpackPhase",
+    "patching sources": "patchPhase",
+    "configuring": "configurePhase",
+    "building": "buildPhase",
+    "running tests": "checkPhase",
+    "installing": "installPhase",
+    "post-installation fixup": "fixupPhase",
+}
+
+# Lines of `nix build` output are prefixed with the name of the derivation, those of `nix log` are not
+_PHASE_PATTERN = re.compile(
+    r"^(?:\S+> )?(?:Running phase: (\w+)|(" + "|".join(_LEGACY_PHASE_MESSAGES) + r"))\s*$", re.MULTILINE)
+
+
+def last_build_phase(log: str) -> Optional[str]:
+    """The last stdenv phase that the log of a build shows to have started, None if it shows none."""
+    phase = None
+    for match in _PHASE_PATTERN.finditer(log):
+        name = match.group(1) or _LEGACY_PHASE_MESSAGES[match.group(2)]
+        if name in BUILD_PHASES:
+            phase = name
+    return phase
 
 
 class NixBuildErrorDiff(Enum):
@@ -15,9 +50,37 @@ class NixErrorKind(Enum):
     HASH_MISMATCH = "HASH_MISMATCH"
 
 class NixError(BaseModel):
+    """A Nix error whose full message lives in the log store.
+
+    Only a reference to the stored log and a short summary are kept in memory.
+    The model can still be constructed with `error_message=...`, which is
+    written to the log store transparently.
+    """
     type: NixErrorKind
-    error_message: str
-    
+    log_ref: str
+    line_count: int
+    summary: str
+    # Last stdenv phase the build started, see BUILD_PHASES
+    phase: Optional[str] = None
+
+    @model_validator(mode="before")
+    @classmethod
+    def _store_error_message(cls, data: Any) -> Any:
+        if isinstance(data, dict) and "error_message" in data:
+            data = dict(data)
+            error_message = data.pop("error_message")
+            lines = error_message.split('\n')
+            data["log_ref"] = get_log_store().put(error_message)
+            data["line_count"] = len(lines)
+            data["summary"] = '\n'.join(lines[-SUMMARY_LINES:])
+            data["phase"] = last_build_phase(error_message)
+        return data
+
+    @property
+    def error_message(self) -> str:
+        """The full error message, loaded lazily from the log store."""
+        return get_log_store().get(self.log_ref)
+
     def truncated(self, max_lines: int = 256) -> str:
         """Return truncated version of error message, keeping the tail end.
         
@@ -27,11 +90,10 @@ class NixError(BaseModel):
         Returns:
             Truncated error message showing the last N lines
         """
-        lines = self.error_message.split('\n')
-        
-        if len(lines) <= max_lines:
+        if self.line_count <= max_lines:
             return self.error_message
-        
+
+        lines = self.error_message.split('\n')
         truncated_lines = lines[-max_lines:]
         truncated = f"... ({len(lines) - max_lines} lines omitted) ...\n\n"
         truncated += '\n'.join(truncated_lines)
@@ -43,4 +105,8 @@ class NixBuildResult(BaseModel):
     """Result of a Nix build operation."""
     success: bool
     is_src_attr_only: bool
-    error: Optional[NixError] = None
\ No newline at end of file
+    error: Optional[NixError] = None
+    # Build directory retained by `nix build --keep-failed`, if any
+    kept_build_dir: Optional[str] = None
+    # Store path of the built derivation, if evaluation succeeded
+    derivation_path: Optional[str] = None
\ No newline at end of file
@@ -1,36 +1,52 @@
 import shutil
 import os
-import git
+import tempfile
+from pathlib import Path
+from typing import Optional
 
-from vibenix import config
+from vibenix.session import get_session
+from vibenix.compiler_cache import write_flake_config
 from vibenix.ui.logging_config import logger
 
 
 def init_flake():
+    session = get_session()
+    flake_dir = session.flake_dir
 
-    logger.info(f"Creating flake at {config.flake_dir} from reference directory {config.template_dir}")
-    shutil.copytree(config.template_dir, config.flake_dir, dirs_exist_ok = True)
+    logger.info(f"Creating flake at {flake_dir} from reference directory {session.template_dir}")
+    shutil.copytree(session.template_dir, flake_dir, dirs_exist_ok = True)
 
     # Ensure the directory and all files have proper permissions
-    os.chmod(config.flake_dir, 0o755)
-    for root, dirs, files in os.walk(config.flake_dir):
+    os.chmod(flake_dir, 0o755)
+    for root, dirs, files in os.walk(flake_dir):
         for d in dirs:
             os.chmod(os.path.join(root, d), 0o755)
         for f in files:
             os.chmod(os.path.join(root, f), 0o644)
 
-    repo = git.Repo.init(config.flake_dir.as_posix())
+    write_flake_config(flake_dir)
+
+    import git
+    repo = git.Repo.init(flake_dir.as_posix())
     repo.git.add('-A')
     repo.index.commit("add empty template")
 
-def update_flake(new_content):
-    file_path = config.flake_dir / "package.nix"
+def copy_flake() -> Path:
+    """Copy the flake with its git history to a new temporary directory, to build alternatives side by side."""
+    flake_copy = Path(tempfile.mkdtemp(prefix="vibenix-flake-"))
+    shutil.copytree(get_session().flake_dir, flake_copy, symlinks=True, dirs_exist_ok=True)
+    return flake_copy
+
+def update_flake(new_content, flake_dir: Optional[Path] = None):
+    flake_dir = flake_dir or get_session().flake_dir
+    file_path = flake_dir / "package.nix"
 
     # Open the file in write mode and overwrite it with new_content
     with open(file_path, 'w') as file:
         file.write(new_content)
 
-    repo = git.Repo(config.flake_dir.as_posix())
+    import git
+    repo = git.Repo(flake_dir.as_posix())
     repo.git.add('-A')
     repo.index.commit("build step")
 
@@ -0,0 +1,105 @@
+import re
+from typing import Callable, List, Optional
+
+from vibenix.session import Session, get_session
+from vibenix.errors import NixBuildResult
+from vibenix.ccl_log import get_logger
+
+MAX_LINES_TO_READ = 200
+MAX_SEARCH_MATCHES = 50
+
+
+def _failed_builds(session: Session) -> List[NixBuildResult]:
+    """Failed builds on the error stack of a session, most recent first."""
+    return [result for result in reversed(session.error_stack) if result.error is not None]
+
+
+def _get_log_lines(session: Session, build: int) -> List[str]:
+    builds = _failed_builds(session)
+    if not 0 <= build < len(builds):
+        raise ValueError(f"Build {build} does not exist, there are {len(builds)} failed builds with logs (0 is the most recent)")
+    return builds[build].error.error_message.splitlines()
+
+
+def create_build_log_function_calls(session: Optional[Session] = None) -> List[Callable]:
+    """Create a list of function calls for inspecting the full logs of previous builds of a session.
+
+    The model otherwise only sees the tail of the most recent build log.
+    Defaults to the current session.
+    """
+    session = session or get_session()
+
+    def list_build_logs() -> str:
+        """List the logs of the failed builds so far, with their error type and length. Build 0 is the most recent one."""
+        print("📞 Function called: list_build_logs")
+        get_logger().log_function_call("list_build_logs")
+        builds = _failed_builds(session)
+        if not builds:
+            return "No build logs available yet."
+        lines = []
+        for i, result in enumerate(builds):
+            target = "src only" if result.is_src_attr_only else "package"
+            lines.append(f"build {i}: {result.error.type.value} ({target}), {result.error.line_count} lines")
+        return "\n".join(lines)
+
+    def search_build_log(pattern: str, build: int = 0, context_lines: int = 2) -> str:
+        """Search the full log of a previous build for a regular expression and return matching lines with their line numbers.
+
+        Args:
+            pattern: Python regular expression to search for (case insensitive)
+            build: Which build log to search, 0 is the most recent build, 1 the one before, and so on
+            context_lines: Number of lines to show before and after each match
+        """
+        print(f"📞 Function called: search_build_log with pattern: '{pattern}', build: {build}")
+        get_logger().log_function_call("search_build_log", pattern=pattern, build=build, context_lines=context_lines)
+        try:
+            lines = _get_log_lines(session, build)
+            regex = re.compile(pattern, re.IGNORECASE)
+            context_lines = min(max(0, context_lines), 10)
+
+            matches = [i for i, line in enumerate(lines) if regex.search(line)]
+            if not matches:
+                return f"No matches found for pattern '{pattern}' in build {build} ({len(lines)} lines)"
+
+            output = []
+            last_printed = -1
+            for i in matches[:MAX_SEARCH_MATCHES]:
+                start = max(last_printed + 1, i - context_lines)
+                end = min(len(lines), i + context_lines + 1)
+                if output and start > last_printed + 1:
+                    output.append("--")
+                for j in range(start, end):
+                    separator = ":" if j == i else "-"
+                    output.append(f"{j + 1:6d}{separator} {lines[j]}")
+                last_printed = end - 1
+
+            if len(matches) > MAX_SEARCH_MATCHES:
+                output.append(f"... (showing first {MAX_SEARCH_MATCHES} of {len(matches)} matches)")
+            return "\n".join(output)
+        except re.error as e:
+            return f"Invalid regular expression '{pattern}': {str(e)}"
+        except Exception as e:
+            return f"Error searching build log: {str(e)}"
+
+    def read_build_log(start_line: int, number_lines_to_read: int = MAX_LINES_TO_READ, build: int = 0) -> str:
+        """Read a window of the full log of a previous build, starting at the given line number (1-based).
+
+        Args:
+            start_line: First line to read, as shown by search_build_log
+            number_lines_to_read: Number of lines to read
+            build: Which build log to read, 0 is the most recent build, 1 the one before, and so on
+        """
+        print(f"📞 Function called: read_build_log with start_line: {start_line}, build: {build}")
+        get_logger().log_function_call("read_build_log", start_line=start_line, number_lines_to_read=number_lines_to_read, build=build)
+        try:
+            lines = _get_log_lines(session, build)
+            number_lines_to_read = min(max(1, number_lines_to_read), MAX_LINES_TO_READ)
+            start = max(1, start_line)
+            if start > len(lines):
+                return f"Build {build} only has {len(lines)} lines"
+            window = lines[start - 1:start - 1 + number_lines_to_read]
+            return "\n".join(f"{i:6d}: {line}" for i, line in enumerate(window, start=start))
+        except Exception as e:
+            return f"Error reading build log: {str(e)}"
+
+    return [list_build_logs, search_build_log, read_build_log]
@@ -1,14 +1,22 @@
 from typing import List, Callable, Any
 from pathlib import Path
-import subprocess
 import shlex
 import os
-from magika import Magika
+from functools import lru_cache
 from itertools import islice
+from vibenix import process
 from vibenix.ccl_log import get_logger
 
 MAX_LINES_TO_READ = 200
 
+
+@lru_cache(maxsize=None)
+def _magika():
+    """The file type detector, whose model is loaded once on first use."""
+    from magika import Magika
+    return Magika()
+
+
 def create_source_function_calls(store_path: str, prefix: str = "") -> List[Callable]:
     """
     Create a list of source analysis related function calls.
@@ -42,8 +50,7 @@ def create_source_function_calls(store_path: str, prefix: str = "") -> List[Call
             # Directories are not text files, return False
             return False
         
-        magika = Magika()
-        result = magika.identify_path(path)
+        result = _magika().identify_path(path)
         return result.output.is_text
 
     # Create the function names with prefix
@@ -56,8 +63,7 @@ def create_source_function_calls(store_path: str, prefix: str = "") -> List[Call
         try:
             _validate_path(relative_path)
             # Use command ls -lha to list directory contents
-            cmd = f'ls -lha {store_path}/{relative_path}'
-            result = subprocess.run(cmd, shell=True, text=True, capture_output=True)
+            result = process.run(["ls", "-lha", f"{store_path}/{relative_path}"], timeout=process.TOOL_TIMEOUT)
             if result.returncode == 0 and result.stdout.strip():
                 return str(result.stdout)
             else:
@@ -90,8 +96,7 @@ def create_source_function_calls(store_path: str, prefix: str = "") -> List[Call
             if not path.exists():
                 return f"File '{relative_path}' does not exist"
             
-            magika = Magika()
-            result = magika.identify_path(path)
+            result = _magika().identify_path(path)
             
             if path.is_file():
                 # Get file size
@@ -159,7 +164,7 @@ def create_source_function_calls(store_path: str, prefix: str = "") -> List[Call
                 # --max-filesize=10M: Skip files larger than 10MB
                 cmd = ["rg", "-n", "-H", "--color=never", "-m", "5", "--max-filesize=10M", "--", pattern, relative_path]
             
-            result = subprocess.run(cmd, text=True, capture_output=True, cwd=root_dir)
+            result = process.run(cmd, cwd=root_dir, timeout=process.TOOL_TIMEOUT)
             
             if result.returncode == 0 and result.stdout.strip():
                 # Limit total output to 50 lines
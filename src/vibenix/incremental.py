@@ -0,0 +1,351 @@
+"""Phase-resumable incremental builds for the agentic loop.
+
+Instead of building the package in the Nix sandbox from scratch every iteration,
+the build environment of the derivation is obtained with `nix print-dev-env` and
+the stdenv phases are run one by one on a persistent build tree. After every
+successful phase the build tree and the shell state are snapshotted. The trees
+are reflinked where the file system supports it, otherwise only the newest tree
+is kept, so the snapshots never take more than one extra copy of the build tree.
+
+On the next build, each phase gets a fingerprint over the environment variables
+that influence it and all phases before it. The build is resumed from the
+snapshot taken before the first phase whose fingerprint changed, so changing
+`postInstall` does not recompile the whole project.
+
+These builds run outside of the sandbox, so a successful incremental build has
+to be verified with a real `nix build`.
+"""
+
+import hashlib
+import json
+import shlex
+import shutil
+import subprocess
+import tempfile
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from vibenix import process
+from vibenix.session import get_session
+from vibenix.errors import NixBuildResult, NixError, NixErrorKind
+from vibenix.ui.logging_config import logger
+
+
+# Variables `nix develop` does not carry over from the build environment either
+IGNORED_VARIABLES = {
+    "BASHOPTS", "HOME", "NIX_BUILD_TOP", "NIX_ENFORCE_PURITY", "NIX_LOG_FD",
+    "NIX_REMOTE", "PPID", "SHELLOPTS", "SSL_CERT_FILE", "TEMP", "TEMPDIR",
+    "TERM", "TMP", "TMPDIR", "TZ", "UID",
+}
+
+# Variables that only influence a specific phase, on top of the generic
+# <phase>Phase, pre<Phase>, post<Phase>, <phase>Flags, dont<Phase> and do<Phase>
+PHASE_VARIABLES = {
+    "unpackPhase": {"src", "srcs", "sourceRoot", "setSourceRoot", "unpackCmd"},
+    "patchPhase": {"patches"},
+    "configurePhase": {"configureScript", "cmakeFlags", "mesonFlags", "configurePlatforms"},
+    "buildPhase": {"makeFlags", "makefile", "enableParallelBuilding"},
+    "checkPhase": {"checkTarget", "checkInputs", "enableParallelChecking"},
+    "installPhase": {"installTargets"},
+    "installCheckPhase": {"installCheckTarget", "installCheckInputs"},
+}
+
+RUNNER_SCRIPT = r'''
+if [[ -n "${VIBENIX_RESTORE:-}" ]]; then
+    source "$VIBENIX_RESTORE/vars.sh" 2> /dev/null || true
+    source "$VIBENIX_RESTORE/funcs.sh" 2> /dev/null || true
+fi
+# The environment of the current derivation takes precedence over the restored shell state
+source "$VIBENIX_ENV"
+set -eo pipefail
+
+export NIX_BUILD_TOP="$VIBENIX_TOP"
+export TMPDIR="$NIX_BUILD_TOP/tmp" TEMPDIR="$NIX_BUILD_TOP/tmp" TMP="$NIX_BUILD_TOP/tmp" TEMP="$NIX_BUILD_TOP/tmp"
+export HOME="$NIX_BUILD_TOP/home"
+mkdir -p "$TMPDIR" "$HOME"
+# Outputs cannot be written to the store, redirect them into the build tree like `nix develop` does
+for __output in ${outputs:-out}; do
+    export "$__output=$NIX_BUILD_TOP/outputs/$__output"
+done
+
+if ! declare -F runPhase > /dev/null; then
+    echo "vibenix: stdenv does not provide runPhase, incremental builds are not supported" >&2
+    exit 2
+fi
+
+if [[ "$VIBENIX_MODE" == list-phases ]]; then
+    definePhases
+    echo ${phases[*]}
+    exit 0
+fi
+
+if [[ -n "${VIBENIX_RESTORE:-}" ]]; then
+    cd "$(cat "$VIBENIX_RESTORE/cwd")"
+else
+    cd "$NIX_BUILD_TOP"
+fi
+
+__index=$VIBENIX_FIRST_INDEX
+__previous="${VIBENIX_RESTORE:-}"
+for __phase in $VIBENIX_PHASES; do
+    runPhase "$__phase"
+    __snapshot="$VIBENIX_SNAPSHOTS/$__index-$__phase"
+    mkdir -p "$__snapshot"
+    # Filtered by name, as values can span several lines. Readonly variables
+    # cannot be restored, and our own variables must not be
+    for __name in $(compgen -v); do
+        [[ "$__name" =~ ^(VIBENIX_[A-Z_]*|__[a-z]*)$ ]] && continue
+        __declaration=$(declare -p "$__name" 2> /dev/null) || continue
+        __flags=${__declaration#declare }
+        [[ "${__flags%% *}" == *r* ]] && continue
+        printf '%s\n' "$__declaration"
+    done > "$__snapshot/vars.sh"
+    declare -f > "$__snapshot/funcs.sh"
+    pwd > "$__snapshot/cwd"
+    # Builds never resume after the last phase, so its tree is not needed. Without
+    # copy-on-write every tree costs its full size, so only the newest one is kept
+    if [[ "$__index" -lt "$VIBENIX_LAST_INDEX" ]]; then
+        if [[ -z "${VIBENIX_KEEP_TREES:-}" && -n "$__previous" ]]; then
+            rm -rf "$__previous/tree"
+        fi
+        cp -a --reflink=auto "$NIX_BUILD_TOP" "$__snapshot/tree"
+        __previous="$__snapshot"
+    fi
+    echo "$__phase" >> "$VIBENIX_COMPLETED"
+    __index=$((__index + 1))
+done
+'''
+
+
+@dataclass
+class PhaseSnapshot:
+    """State of the build tree after a successfully completed phase."""
+    phase: str
+    fingerprint: str
+    path: Path
+
+
+def _phase_variable_names(phase: str) -> set:
+    """Names of the variables that influence the given phase."""
+    names = set(PHASE_VARIABLES.get(phase, set()))
+    if phase.endswith("Phase"):
+        stem = phase[:-len("Phase")]
+        capitalized = stem[:1].upper() + stem[1:]
+        names |= {phase, f"pre{capitalized}", f"post{capitalized}", f"{stem}Flags", f"{stem}FlagsArray",
+                  f"dont{capitalized}", f"do{capitalized}"}
+    return names
+
+
+def phase_fingerprints(dev_env: dict, phases: List[str]) -> List[str]:
+    """Compute a cumulative fingerprint for every phase.
+
+    The fingerprint of a phase covers all variables that are not specific to any phase,
+    the phase's own variables and the fingerprint of the previous phase.
+    """
+    variables: Dict[str, dict] = dev_env.get("variables", {})
+    functions: Dict[str, str] = dev_env.get("bashFunctions", {})
+
+    # Output paths change with every change to the derivation, but we redirect them anyway
+    outputs_value = variables.get("outputs", {}).get("value", "out")
+    outputs = set(outputs_value) if isinstance(outputs_value, dict) else set(outputs_value.split())
+    phase_names = {phase: _phase_variable_names(phase) for phase in phases}
+    all_phase_names = set().union(*phase_names.values()) if phase_names else set()
+
+    def digest(names) -> str:
+        h = hashlib.sha256()
+        for name in sorted(names):
+            if name in variables:
+                h.update(f"{name}={json.dumps(variables[name], sort_keys=True)}\n".encode())
+        return h.hexdigest()
+
+    global_names = set(variables) - all_phase_names - outputs - IGNORED_VARIABLES
+    h = hashlib.sha256(digest(global_names).encode())
+    h.update(json.dumps(functions, sort_keys=True).encode())
+    previous = h.hexdigest()
+
+    fingerprints = []
+    for phase in phases:
+        previous = hashlib.sha256(f"{previous}:{phase}:{digest(phase_names[phase])}".encode()).hexdigest()
+        fingerprints.append(previous)
+    return fingerprints
+
+
+def render_env_script(dev_env: dict) -> str:
+    """Render the JSON output of `nix print-dev-env --json` as a bash script, like `nix develop` does."""
+    lines = []
+    for name, variable in dev_env.get("variables", {}).items():
+        if name in IGNORED_VARIABLES:
+            continue
+        kind, value = variable["type"], variable["value"]
+        if kind == "exported":
+            lines.append(f"export {name}={shlex.quote(value)}")
+        elif kind == "var":
+            lines.append(f"{name}={shlex.quote(value)}")
+        elif kind == "array":
+            lines.append(f"declare -a {name}=({' '.join(shlex.quote(v) for v in value)})")
+        elif kind == "associative":
+            entries = ' '.join(f"[{shlex.quote(k)}]={shlex.quote(v)}" for k, v in value.items())
+            lines.append(f"declare -A {name}=({entries})")
+    for name, body in dev_env.get("bashFunctions", {}).items():
+        lines.append(f"{name} ()\n{{\n{body}}}")
+    return "\n".join(lines) + "\n"
+
+
+class IncrementalBuilder:
+    """Runs stdenv phases on a persistent build tree and resumes from phase snapshots."""
+
+    def __init__(self, work_dir: Optional[Path] = None):
+        if work_dir is None:
+            work_dir = Path(tempfile.mkdtemp(prefix="vibenix-incremental-"))
+        self.work_dir = Path(work_dir)
+        self.top = self.work_dir / "top"
+        self.snapshots_dir = self.work_dir / "snapshots"
+        self.snapshots: List[PhaseSnapshot] = []
+        self._copy_on_write: Optional[bool] = None
+
+    def cleanup(self):
+        """Remove the build tree and all snapshots."""
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        self.snapshots = []
+
+    def supports_copy_on_write(self) -> bool:
+        """Whether the build tree can be snapshotted with reflinks, which only copy the blocks that change."""
+        if self._copy_on_write is None:
+            self.work_dir.mkdir(parents=True, exist_ok=True)
+            probe = self.work_dir / "reflink-probe"
+            probe.write_text("")
+            result = subprocess.run(["cp", "--reflink=always", str(probe), f"{probe}.copy"], capture_output=True)
+            self._copy_on_write = result.returncode == 0
+            probe.unlink()
+            Path(f"{probe}.copy").unlink(missing_ok=True)
+        return self._copy_on_write
+
+    def _run_runner(self, dev_env: dict, env: Dict[str, str], timeout: Optional[int] = None) -> process.ProcessResult:
+        variables = dev_env.get("variables", {})
+        shell = (variables.get("SHELL") or variables.get("shell") or {}).get("value", "bash")
+        runner_path = self.work_dir / "runner.sh"
+        runner_path.write_text(RUNNER_SCRIPT)
+        base_env = {
+            "PATH": "/usr/bin:/bin",
+            "VIBENIX_ENV": str(self.work_dir / "env.sh"),
+            "VIBENIX_TOP": str(self.top),
+            "VIBENIX_SNAPSHOTS": str(self.snapshots_dir),
+        }
+        return process.run(
+            [shell, str(runner_path)],
+            env={**base_env, **env},
+            merge_stderr=True,
+            timeout=timeout,
+        )
+
+    def _get_dev_env(self, target_attr: str, is_src_attr_only: bool) -> Tuple[Optional[dict], Optional[NixBuildResult]]:
+        try:
+            # Like an evaluation, this can build the dependencies of the build environment
+            result = process.run(["nix", "print-dev-env", "--json", target_attr],
+                                 timeout=int(get_session().build_timeout))
+        except subprocess.TimeoutExpired:
+            return None, NixBuildResult(
+                success=False,
+                is_src_attr_only=is_src_attr_only,
+                error=NixError(type=NixErrorKind.EVAL_ERROR,
+                               error_message=f"error: getting the build environment timed out after "
+                                             f"{get_session().build_timeout} seconds")
+            )
+        if result.returncode == 0:
+            return json.loads(result.stdout), None
+        if "hash mismatch in fixed-output derivation" in result.stderr:
+            kind = NixErrorKind.HASH_MISMATCH
+        elif "error: builder for" in result.stderr or "Cannot build" in result.stderr:
+            # A dependency of the build environment failed to build
+            kind = NixErrorKind.BUILD_ERROR
+        else:
+            kind = NixErrorKind.EVAL_ERROR
+        return None, NixBuildResult(
+            success=False,
+            is_src_attr_only=is_src_attr_only,
+            error=NixError(type=kind, error_message=result.stderr)
+        )
+
+    def _restore(self, resume_index: int):
+        """Reset the build tree to the state after phase `resume_index - 1`."""
+        for snapshot in self.snapshots[resume_index:]:
+            shutil.rmtree(snapshot.path, ignore_errors=True)
+        self.snapshots = self.snapshots[:resume_index]
+
+        shutil.rmtree(self.top, ignore_errors=True)
+        if resume_index == 0:
+            self.top.mkdir(parents=True)
+        else:
+            process.run(
+                ["cp", "-a", "--reflink=auto", str(self.snapshots[-1].path / "tree"), str(self.top)],
+                check=True
+            )
+
+    def build(self, target_attr: str) -> NixBuildResult:
+        """Build the given flake attribute, resuming from the last unchanged phase."""
+        dev_env, error_result = self._get_dev_env(target_attr, is_src_attr_only=False)
+        if error_result is not None:
+            return error_result
+
+        self.work_dir.mkdir(parents=True, exist_ok=True)
+        (self.work_dir / "env.sh").write_text(render_env_script(dev_env))
+
+        listing = self._run_runner(dev_env, {"VIBENIX_MODE": "list-phases"}, timeout=60)
+        if listing.returncode != 0:
+            raise RuntimeError(f"Failed to determine build phases: {listing.stdout}")
+        phases = listing.stdout.split()
+        fingerprints = phase_fingerprints(dev_env, phases)
+
+        resume_index = 0
+        for snapshot, phase, fingerprint in zip(self.snapshots, phases, fingerprints):
+            if snapshot.phase != phase or snapshot.fingerprint != fingerprint:
+                break
+            resume_index += 1
+        if resume_index == len(phases):
+            # Nothing changed, but rerun the last phase to reproduce its result
+            resume_index -= 1
+        # Resume from the newest snapshot that still has its tree
+        while resume_index > 0 and not (self.snapshots[resume_index - 1].path / "tree").is_dir():
+            resume_index -= 1
+        self._restore(resume_index)
+
+        logger.info(f"Incremental build resuming from {phases[resume_index]} "
+                    f"(skipping {resume_index} of {len(phases)} phases)")
+
+        completed_file = self.work_dir / "completed"
+        completed_file.write_text("")
+        env = {
+            "VIBENIX_MODE": "build",
+            "VIBENIX_PHASES": " ".join(phases[resume_index:]),
+            "VIBENIX_FIRST_INDEX": str(resume_index),
+            "VIBENIX_LAST_INDEX": str(len(phases) - 1),
+            "VIBENIX_COMPLETED": str(completed_file),
+        }
+        if resume_index > 0:
+            env["VIBENIX_RESTORE"] = str(self.snapshots[-1].path)
+        if self.supports_copy_on_write():
+            env["VIBENIX_KEEP_TREES"] = "1"
+
+        try:
+            result = self._run_runner(dev_env, env, timeout=int(get_session().build_timeout))
+            returncode, log = result.returncode, result.stdout
+        except subprocess.TimeoutExpired as e:
+            # The log of the phases that ran until the timeout
+            output = e.output.decode(errors="replace") if e.output else ""
+            returncode, log = 1, output + f"\nerror: build timed out after {get_session().build_timeout} seconds"
+
+        for index, phase in enumerate(completed_file.read_text().split(), start=resume_index):
+            self.snapshots.append(PhaseSnapshot(
+                phase=phase,
+                fingerprint=fingerprints[index],
+                path=self.snapshots_dir / f"{index}-{phase}"
+            ))
+
+        if returncode == 0:
+            return NixBuildResult(success=True, is_src_attr_only=False)
+        return NixBuildResult(
+            success=False,
+            is_src_attr_only=False,
+            error=NixError(type=NixErrorKind.BUILD_ERROR, error_message=log)
+        )
@@ -0,0 +1,141 @@
+"""Content-addressed, zstd-compressed on-disk store for build logs.
+
+Build logs can be several megabytes each and a session produces dozens of them.
+Instead of keeping them in memory, every log is written once to a shared store,
+keyed by the SHA-256 of its content, and only the key is kept around.
+
+The store is shared by all sessions, so it is garbage collected when a session
+ends: logs that were not used for `DEFAULT_MAX_AGE` are removed, and then the
+least recently used ones until the store fits in `DEFAULT_MAX_SIZE`.
+"""
+
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import zstandard
+
+from vibenix.ui.logging_config import logger
+
+
+DEFAULT_LOG_STORE_DIR = Path(os.path.expanduser("~/.cache/vibenix/logs"))
+# Long enough to --resume a session from its checkpoint, which only keeps the keys of its logs
+DEFAULT_MAX_AGE = 30 * 24 * 60 * 60
+DEFAULT_MAX_SIZE = 1024 ** 3
+
+
+class LogStore:
+    """Stores build logs compressed on disk, addressed by their content hash."""
+
+    def __init__(self, root: Path, compression_level: int = 10, cache_size: int = 4):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.compression_level = compression_level
+        # Keep the most recently read logs decompressed, since a single
+        # iteration usually looks at the same one or two logs repeatedly.
+        self._cache: OrderedDict[str, str] = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def _path_for(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key[2:]}.zst"
+
+    @staticmethod
+    def _touch(path: Path):
+        """Mark a log as used, the garbage collection removes the least recently used logs first."""
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def put(self, text: str) -> str:
+        """Store a log and return its key. Storing the same log twice is a no-op."""
+        data = text.encode("utf-8")
+        key = hashlib.sha256(data).hexdigest()
+        path = self._path_for(key)
+        if path.exists():
+            self._touch(path)
+        else:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            compressed = zstandard.ZstdCompressor(level=self.compression_level).compress(data)
+            # Write to a temporary file first so concurrent sessions never see partial logs
+            fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(compressed)
+                os.replace(tmp_name, path)
+            except BaseException:
+                os.unlink(tmp_name)
+                raise
+            logger.debug(f"Stored build log {key[:12]} ({len(data)} bytes, {len(compressed)} compressed)")
+        return key
+
+    def get(self, key: str) -> str:
+        """Load a log by key."""
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        path = self._path_for(key)
+        if not path.exists():
+            raise KeyError(f"Build log {key} not found in log store at {self.root}")
+        text = zstandard.ZstdDecompressor().decompress(path.read_bytes()).decode("utf-8")
+        self._touch(path)
+
+        with self._lock:
+            self._cache[key] = text
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return text
+
+    def __contains__(self, key: str) -> bool:
+        return self._path_for(key).exists()
+
+    def collect_garbage(self, max_age: float = DEFAULT_MAX_AGE, max_size: int = DEFAULT_MAX_SIZE) -> int:
+        """Remove the logs that were not used for `max_age` seconds, and the least recently used
+        logs beyond `max_size` bytes. Returns the number of removed logs."""
+        logs = []
+        for path in self.root.glob("*/*.zst"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                # Removed by the garbage collection of a concurrent session
+                continue
+            logs.append((stat.st_mtime, stat.st_size, path))
+
+        now = time.time()
+        kept_size = removed = 0
+        for mtime, size, path in sorted(logs, reverse=True):
+            kept_size += size
+            if now - mtime > max_age or kept_size > max_size:
+                path.unlink(missing_ok=True)
+                removed += 1
+        if removed:
+            logger.info(f"Removed {removed} of {len(logs)} build logs from the log store at {self.root}")
+        return removed
+
+
+# Global log store instance
+_log_store: Optional[LogStore] = None
+
+
+def init_log_store(root: Optional[Path] = None) -> LogStore:
+    """Initialize the global log store, defaulting to $VIBENIX_LOG_STORE or ~/.cache/vibenix/logs."""
+    global _log_store
+    if root is None:
+        root = Path(os.environ.get("VIBENIX_LOG_STORE", DEFAULT_LOG_STORE_DIR))
+    _log_store = LogStore(root)
+    return _log_store
+
+
+def get_log_store() -> LogStore:
+    """Get the global log store, initializing it with the default location on first use."""
+    if _log_store is None:
+        return init_log_store()
+    return _log_store
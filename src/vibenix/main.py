@@ -2,29 +2,21 @@
 """Vibenix - AI-powered Nix package builder.
 
 Main entry point that supports both terminal and textual UI modes.
+
+Importing this module only pulls in the standard library and the logger, so
+`vibenix --help` and the `batch` and `stats` subcommands start quickly. The
+model libraries, the UIs and the on-disk cache are loaded once a mode is chosen.
 """
 
 import argparse
 import os
 import sys
-from pydantic import BaseModel
 
 from vibenix.ui.logging_config import logger  # Import logger first to ensure it's initialized
-from vibenix import config
-import litellm
-from typing import Optional
 from functools import wraps
 import hashlib
 import json
 
-config.init()
-
-from vibenix.parsing import cache
-
-# Check which backend we're using
-magentic_backend = os.environ.get("MAGENTIC_BACKEND", "litellm")
-logger.info(f"Using magentic backend: {magentic_backend}")
-
 # Global variable to track if we're in UI mode
 _ui_mode = False
 
@@ -33,21 +25,21 @@ def set_ui_mode(ui_mode: bool):
     global _ui_mode
     _ui_mode = ui_mode
 
-import logging
-if "OLLAMA_HOST" in os.environ:
-    logger.info(f"OLLAMA_HOST is set to: {os.environ['OLLAMA_HOST']}")
-else:
-    logger.warning("OLLAMA_HOST environment variable is not set")
 
-#litellm.set_verbose=True
-# litellm.set_verbose=True
+def log_model_environment():
+    """Log the environment that selects the model backend."""
+    # Check which backend we're using
+    magentic_backend = os.environ.get("MAGENTIC_BACKEND", "litellm")
+    logger.info(f"Using magentic backend: {magentic_backend}")
 
-# Note: Do NOT set litellm.api_base globally as it affects all models
-# Instead, Ollama models should specify api_base per request
-# or use LITELLM_LOG=DEBUG to see endpoint selection
-if "OLLAMA_HOST" in os.environ:
-    logger.info(f"OLLAMA_HOST available at: {os.environ['OLLAMA_HOST']}")
-    logger.info("Note: api_base will be set per-model, not globally")
+    # Note: Do NOT set litellm.api_base globally as it affects all models
+    # Instead, Ollama models should specify api_base per request
+    # or use LITELLM_LOG=DEBUG to see endpoint selection
+    if "OLLAMA_HOST" in os.environ:
+        logger.info(f"OLLAMA_HOST is set to: {os.environ['OLLAMA_HOST']}")
+        logger.info("Note: api_base will be set per-model, not globally")
+    else:
+        logger.warning("OLLAMA_HOST environment variable is not set")
 
 def cache_streaming_response(func):
     """Decorator that caches streaming responses.
@@ -68,6 +60,8 @@ def cache_streaming_response(func):
         cache_key = hashlib.md5(key_str.encode()).hexdigest()
         
         # Check if we have a cached result
+        from vibenix.parsing import get_cache
+        cache = get_cache()
         cached_result = cache.get(cache_key)
         if cached_result is not None:
             logger.info(f"Using cached result for {func.__name__}")
@@ -96,18 +90,12 @@ def cache_streaming_response(func):
     
     return wrapper
 
-class Project(BaseModel):
-    name: str
-    latest_commit_sha1: str
-    version_tag : Optional[str]
-    dependencies: list[str]
-
 def mock_input (ask : str, reply: str):
     logger.info(ask)
     logger.info(reply + "\n")
     return reply
 
-def run_terminal_ui(output_dir=None, project_url=None, revision=None, fetcher=None):
+def run_terminal_ui(output_dir=None, project_url=None, revision=None, fetcher=None, resume=False):
     """Run the terminal-based interface."""
     from vibenix.ui.logging_config import enable_console_logging
     enable_console_logging()
@@ -118,12 +106,14 @@ def run_terminal_ui(output_dir=None, project_url=None, revision=None, fetcher=No
     from vibenix.ui.conversation import set_ui_adapter, TerminalUIAdapter
     from vibenix.packaging_flow.run import run_packaging_flow
     from vibenix.ui.raw_terminal.terminal_model_config import ensure_model_configured
+    from vibenix.process import ProcessCancelled
+    from vibenix.session import get_session
     
     # Set up terminal UI adapter
     set_ui_adapter(TerminalUIAdapter())
     
-    # If project URL is provided, skip interactive configuration
-    if project_url:
+    # If project URL is provided or a session is resumed, skip interactive configuration
+    if project_url or resume:
         from vibenix.ui.model_config import load_saved_configuration
         saved_config = load_saved_configuration()
         if not saved_config:
@@ -142,18 +132,25 @@ def run_terminal_ui(output_dir=None, project_url=None, revision=None, fetcher=No
     def run_coordinator():
         try:
             run_packaging_flow(output_dir=output_dir, project_url=project_url,
-                               revision=revision, fetcher=fetcher)
+                               revision=revision, fetcher=fetcher, resume=resume)
+        except ProcessCancelled:
+            logger.info("Packaging flow cancelled")
         except Exception as e:
             logger.error(f"Error in packaging flow: {e}")
             import traceback
             traceback.print_exc()
     
-    coordinator_thread = threading.Thread(target=run_coordinator)
+    coordinator_thread = threading.Thread(target=run_coordinator, name="coordinator")
     coordinator_thread.daemon = True
     coordinator_thread.start()
     
     # Wait for completion
-    coordinator_thread.join()
+    try:
+        coordinator_thread.join()
+    except KeyboardInterrupt:
+        # External commands run in their own process groups, so they do not see the interrupt
+        get_session().cancel()
+        raise
 
 
 def run_textual_ui():
@@ -164,6 +161,16 @@ def run_textual_ui():
 
 def main():
     """Main entry point for vibenix."""
+    if sys.argv[1:2] == ["batch"]:
+        from vibenix.batch import main as batch_main
+        return batch_main(sys.argv[2:])
+    if sys.argv[1:2] == ["stats"]:
+        from vibenix.stats import main as stats_main
+        return stats_main(sys.argv[2:])
+    if sys.argv[1:2] == ["serve"]:
+        from vibenix.serve import main as serve_main
+        return serve_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
         description="Vibenix - AI-powered Nix package builder",
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -172,6 +179,13 @@ def main():
   vibenix --raw                                   # Run with terminal-only interface
   vibenix --raw https://github.com/user/repo      # Package a specific repo
   vibenix --raw --output-dir out https://github.com/user/repo  # Save output
+  vibenix --raw --output-dir out --resume         # Continue an interrupted session
+  vibenix --raw --record run.jsonl https://github.com/user/repo               # Record the model exchanges
+  vibenix --raw --replay run.jsonl --replay-speed asap https://github.com/user/repo  # Replay them offline
+  vibenix --raw --trace trace.json https://github.com/user/repo   # Timeline for Perfetto
+  vibenix batch --jobs 4 research/packaging_requests/*.csv     # Package a whole dataset
+  vibenix stats --csv stats batch-output          # Aggregate the CCL logs of many sessions
+  vibenix serve --workers 4                       # Package projects submitted over HTTP
   vibenix --help                                  # Show this help
 """
     )
@@ -207,6 +221,146 @@ def main():
         help="Path to .nix file with fetcher for the project source code (only works with --raw)."
     )
     
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue the session checkpointed in --output-dir after its last completed iteration (only works with --raw)."
+    )
+
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Resume builds from the first changed phase during the fix loop, successful builds are verified with a regular build."
+    )
+
+    parser.add_argument(
+        "--compiler-cache",
+        metavar="DIR",
+        default=None,
+        help="Persistent ccache/sccache directory shared between builds, exposed to the sandbox with extra-sandbox-paths (requires a trusted nix user). Successful builds are verified without the cache."
+    )
+
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of alternative fixes to request and build in parallel per iteration (default: 1)."
+    )
+
+    parser.add_argument(
+        "--beam-width",
+        type=int,
+        default=1,
+        metavar="K",
+        help="Keep the K best solutions and expand them in parallel instead of a single best one (default: 1). Each solution is expanded into --candidates fixes per iteration."
+    )
+
+    parser.add_argument(
+        "--batch-builds",
+        action="store_true",
+        help="Build all candidates of an iteration with a single nix build, instead of building each one as soon as it is proposed."
+    )
+
+    parser.add_argument(
+        "--build-cores",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Schedule builds within a budget of N cores, assigning --cores and --max-jobs per build (default: all cores when --build-memory is set)."
+    )
+
+    parser.add_argument(
+        "--build-memory",
+        type=int,
+        default=None,
+        metavar="MB",
+        help="Schedule builds within a budget of MB megabytes of memory (default: all memory when --build-cores is set)."
+    )
+
+    nix_group = parser.add_mutually_exclusive_group()
+    nix_group.add_argument(
+        "--record-nix",
+        metavar="FILE",
+        default=None,
+        help="Append the outcome and duration of every Nix operation to a corpus file for --simulate-nix."
+    )
+
+    nix_group.add_argument(
+        "--simulate-nix",
+        metavar="FILE",
+        nargs="+",
+        default=None,
+        help="Replay Nix outcomes from recorded corpus files instead of running Nix."
+    )
+
+    parser.add_argument(
+        "--nix-time-scale",
+        type=float,
+        default=1.0,
+        metavar="FACTOR",
+        help="Factor for the recorded durations of simulated Nix operations, 0 replays without delay (default: 1)."
+    )
+
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument(
+        "--record",
+        metavar="FILE",
+        default=None,
+        help="Record every model request and response of the session to a cassette file."
+    )
+
+    cassette_group.add_argument(
+        "--replay",
+        metavar="FILE",
+        default=None,
+        help="Serve the model responses from a recorded cassette file instead of calling the model."
+    )
+
+    parser.add_argument(
+        "--replay-speed",
+        choices=["realtime", "asap"],
+        default="realtime",
+        help="Replay responses with their recorded timing or as fast as possible (default: realtime)."
+    )
+
+    parser.add_argument(
+        "--max-cost",
+        type=float,
+        default=None,
+        metavar="USD",
+        help="Stop the session with the best solution so far once its model calls cost USD dollars."
+    )
+
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Stop the session with the best solution so far once its model calls used N tokens."
+    )
+
+    parser.add_argument(
+        "--max-time",
+        type=float,
+        default=None,
+        metavar="MINUTES",
+        help="Stop the session with the best solution so far after MINUTES of wall clock time."
+    )
+
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        default=None,
+        help="Write a timeline of the session's threads, model calls, tool calls and subprocesses to FILE in the Chrome trace format, for Perfetto or chrome://tracing."
+    )
+
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the packaging flow with a sampling profiler and tracemalloc, the CPU profile and the top allocation sites are written next to run.ccl."
+    )
+
     parser.add_argument(
         "--version",
         action="version",
@@ -214,17 +368,61 @@ def main():
     )
     
     args = parser.parse_args()
+    if args.candidates < 1:
+        parser.error("--candidates must be at least 1")
+    if args.beam_width < 1:
+        parser.error("--beam-width must be at least 1")
+    log_model_environment()
+    from vibenix.session import Session, init_session
+    from vibenix.usage import Budget
+    session = init_session(Session(
+        incremental_builds=args.incremental,
+        fix_candidates=args.candidates,
+        beam_width=args.beam_width,
+        batch_builds=args.batch_builds,
+        profile=args.profile,
+        budget=Budget(max_cost=args.max_cost, max_tokens=args.max_tokens,
+                      max_time=args.max_time * 60 if args.max_time else None),
+    ))
+    if args.record_nix:
+        from vibenix.nix_backend import RecordingNixBackend
+        session.nix_backend = RecordingNixBackend(args.record_nix)
+    elif args.simulate_nix:
+        from vibenix.nix_backend import SimulatedNixBackend
+        session.nix_backend = SimulatedNixBackend(args.simulate_nix, time_scale=args.nix_time_scale)
+    if args.trace:
+        from vibenix.trace import TraceRecorder
+        session.trace = TraceRecorder()
+    if args.record or args.replay:
+        from vibenix.cassette import RecordingCassette, ReplayingCassette, ReplaySpeed, use_cassette
+        if args.record:
+            use_cassette(session, RecordingCassette(args.record))
+        else:
+            use_cassette(session, ReplayingCassette(args.replay, ReplaySpeed(args.replay_speed)))
+    if args.build_cores or args.build_memory:
+        from vibenix.build_scheduler import BuildScheduler, init_build_scheduler
+        # Candidates of all solutions of the beam are built at the same time
+        init_build_scheduler(BuildScheduler(cores=args.build_cores, memory_mb=args.build_memory,
+                                            expected_builds=1 if args.batch_builds else args.candidates * args.beam_width))
+    if args.compiler_cache:
+        from pathlib import Path
+        from vibenix.compiler_cache import init_compiler_cache
+        init_compiler_cache(Path(args.compiler_cache).resolve())
     
     try:
         if args.raw:
             logger.info("Starting vibenix in terminal mode")
-            if args.output_dir and not args.project_url:
+            if args.resume and not args.output_dir:
+                parser.error("--resume requires the --output-dir of the session")
+            if args.output_dir and not args.project_url and not args.resume:
                 parser.error("--output-dir requires a project URL to be provided")
             run_terminal_ui(output_dir=args.output_dir, project_url=args.project_url,
-                            revision=args.revision, fetcher=args.fetcher)
+                            revision=args.revision, fetcher=args.fetcher, resume=args.resume)
         else:
             if args.output_dir:
                 parser.error("--output-dir only works with --raw mode")
+            if args.resume:
+                parser.error("--resume only works with --raw mode")
             if args.project_url:
                 parser.error("project URL argument only works with --raw mode")
             logger.info("Starting vibenix in textual UI mode")
@@ -235,6 +433,12 @@ def main():
     except Exception as e:
         logger.error(f"Fatal error: {e}")
         sys.exit(1)
+    finally:
+        if session.cassette is not None:
+            session.cassette.close()
+        if session.trace is not None:
+            session.trace.write(args.trace)
+            logger.info(f"Trace written to {args.trace}")
 
 
 if __name__ == "__main__":
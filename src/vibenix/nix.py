@@ -1,84 +1,244 @@
+import re
+import shutil
 import subprocess
+from pathlib import Path
 
-from vibenix import config
+from vibenix import compiler_cache
+from vibenix.nix_backend import get_nix_backend
+from vibenix.session import get_session
+from vibenix.ccl_log import get_logger, span
+from vibenix.build_scheduler import scheduled_build
 from vibenix.packaging_flow.model_prompts import evaluate_progress
 from vibenix.errors import NixBuildResult, NixError, NixErrorKind, NixBuildErrorDiff
 
-import git
-
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
 from vibenix.flake import update_flake
 from vibenix.ui.logging_config import logger
 
 
-def invoke_build(is_src_attr_only: bool) -> NixBuildResult:
-    if is_src_attr_only:
-        target_attr = f"{config.flake_dir}#default.src"
-    else:
-        target_attr = f"{config.flake_dir}#default"
-    # First, evaluate the flake to get the derivation path
-    # If this fails, it's an evaluation error
-    eval_result = subprocess.run(
-        ["nix", "path-info", "--derivation", target_attr],
-        text=True,
-        capture_output=True
-    )
+def _evaluate_derivation(target_attr: str, is_src_attr_only: bool) -> Tuple[Optional[str], Optional[NixBuildResult]]:
+    """Evaluate a flake attribute to its derivation path, or to the result of a failed evaluation."""
+    try:
+        with span("evaluate", attr=target_attr.partition("#")[2]) as eval_span:
+            eval_result = get_nix_backend().evaluate(target_attr, timeout=int(get_session().build_timeout))
+            eval_span.set(exit_code=eval_result.returncode)
+    except subprocess.TimeoutExpired:
+        return None, NixBuildResult(
+            success=False,
+            is_src_attr_only=is_src_attr_only,
+            error=NixError(type=NixErrorKind.EVAL_ERROR,
+                           error_message=f"error: evaluation timed out after {get_session().build_timeout} seconds")
+        )
     
     if eval_result.returncode != 0:
         if "hash mismatch in fixed-output derivation" in eval_result.stderr:
-            return NixBuildResult(
+            return None, NixBuildResult(
                 success=False,
                 is_src_attr_only=is_src_attr_only,
                 error=NixError(type=NixErrorKind.HASH_MISMATCH, error_message=eval_result.stderr)
             )
-        return NixBuildResult(
+        return None, NixBuildResult(
             success=False,
             is_src_attr_only=is_src_attr_only,
             error=NixError(type=NixErrorKind.EVAL_ERROR, error_message=eval_result.stderr)
         )
-    
-    derivation_path = eval_result.stdout.strip()
+    return eval_result.stdout.strip(), None
+
+
+def _fetch_log(derivation_path: str) -> Optional[str]:
+    """The build log of a derivation, None if nix has none or does not return it in time."""
+    try:
+        with span("log-fetch", drv=derivation_path) as log_span:
+            log_result = get_nix_backend().log(f"{derivation_path}^*")
+            log_span.set(exit_code=log_result.returncode, bytes=len(log_result.stdout))
+    except subprocess.TimeoutExpired:
+        logger.warning(f"Timed out fetching the build log of {derivation_path}")
+        return None
+    return log_result.stdout if log_result.returncode == 0 else None
+
+
+def _outputs_valid(derivation_path: str) -> bool:
+    """Whether the outputs of a derivation are in the store, False if nix does not answer in time."""
+    try:
+        return get_nix_backend().outputs_valid(f"{derivation_path}^*")
+    except subprocess.TimeoutExpired:
+        logger.warning(f"Timed out checking the outputs of {derivation_path}")
+        return False
+
+
+def invoke_build(is_src_attr_only: bool, attr: str = "default", flake_dir: Optional[Path] = None) -> NixBuildResult:
+    with span("build", attr=attr, src_only=is_src_attr_only) as build_span:
+        result = _invoke_build(is_src_attr_only, attr, flake_dir)
+        build_span.set(drv=result.derivation_path, success=result.success,
+                       error=result.error.type.value if result.error else None)
+        return result
+
+
+def _invoke_build(is_src_attr_only: bool, attr: str, flake_dir: Optional[Path]) -> NixBuildResult:
+    flake_dir = flake_dir or get_session().flake_dir
+    if is_src_attr_only:
+        target_attr = f"{flake_dir}#{attr}.src"
+    else:
+        target_attr = f"{flake_dir}#{attr}"
+    # First, evaluate the flake to get the derivation path
+    # If this fails, it's an evaluation error
+    derivation_path, eval_error = _evaluate_derivation(target_attr, is_src_attr_only)
+    if eval_error is not None:
+        return eval_error
     logger.info(f"Building derivation outputs: {derivation_path}^*")
 
+    # Every build writes its own statistics, so alternatives built concurrently do not mix them up
+    uses_compiler_cache = compiler_cache.enabled() and not is_src_attr_only and attr == "default"
+    if uses_compiler_cache:
+        compiler_cache.zero_stats(derivation_path)
+
     # Build the derivation outputs (not just the derivation file)
-    build_result = subprocess.run(
-        ["nix", "build", "--timeout", config.build_timeout, f"{derivation_path}^*", "--no-link"],
-        text=True,
-        capture_output=True
-    )
+    # Keep the build directory of failed builds around so the model can inspect it
+    with span("nix-build", drv=derivation_path) as nix_build_span:
+        with scheduled_build() as schedule_options:
+            build_result = get_nix_backend().build(
+                [f"{derivation_path}^*"], compiler_cache.nix_options() + schedule_options, keep_failed=True
+            )
+        nix_build_span.set(exit_code=build_result.returncode)
+
+        if uses_compiler_cache:
+            stats = compiler_cache.read_stats(derivation_path)
+            if stats is not None:
+                logger.info(f"Compiler cache: {stats['hits']} hits, {stats['misses']} misses")
+                get_logger().log_compiler_cache_stats(stats["hits"], stats["misses"])
+                nix_build_span.set(cache_hits=stats["hits"], cache_misses=stats["misses"])
 
     # If build succeeded, return success
     if build_result.returncode == 0:
-        return NixBuildResult(success=True, is_src_attr_only=is_src_attr_only)
+        return NixBuildResult(success=True, is_src_attr_only=is_src_attr_only, derivation_path=derivation_path)
+
+    kept_build_dir = _find_kept_build_dir(build_result.stderr)
 
     # Build failed, check if it's a hash mismatch before getting logs
     if "hash mismatch in fixed-output derivation" in build_result.stderr:
+        _remove_build_dir(kept_build_dir)
         return NixBuildResult(
             success=False,
             is_src_attr_only=is_src_attr_only,
-            error=NixError(type=NixErrorKind.HASH_MISMATCH, error_message=build_result.stderr)
+            error=NixError(type=NixErrorKind.HASH_MISMATCH, error_message=build_result.stderr),
+            derivation_path=derivation_path
         )
 
     # Not a hash mismatch, get logs for build error
-    log_result = subprocess.run(
-        ["nix", "log", f"{derivation_path}^*"],
-        text=True,
-        capture_output=True
-    )
-    
-    if log_result.returncode != 0:
-        # This is unexpected - we should always be able to get logs after a build
-        # Except if the build of a dependency failed
-        raise RuntimeError(f"Failed to retrieve build logs for {derivation_path}: {log_result.stderr}\n\nFull Error:{build_result.stderr}")
+    log = _fetch_log(derivation_path)
+    if log is None:
+        # Without a log, a dependency failed, which is only reported in the output of nix build,
+        # or nix log timed out
+        log = build_result.stderr
 
     return NixBuildResult(
         success=False,
         is_src_attr_only=is_src_attr_only,
-        error=NixError(type=NixErrorKind.BUILD_ERROR, error_message=log_result.stdout)
+        error=NixError(type=NixErrorKind.BUILD_ERROR, error_message=log),
+        kept_build_dir=kept_build_dir,
+        derivation_path=derivation_path
     )
 
 
+def _build_derivations(derivation_paths: List[str], is_src_attr_only: bool) -> Dict[str, NixBuildResult]:
+    """Build several derivations with a single `nix build --keep-going` and one build slot."""
+    with span("nix-build", derivations=len(derivation_paths)) as nix_build_span:
+        with scheduled_build(jobs=len(derivation_paths)) as schedule_options:
+            build_result = get_nix_backend().build(
+                [f"{derivation_path}^*" for derivation_path in derivation_paths],
+                compiler_cache.nix_options() + schedule_options, keep_going=True
+            )
+        nix_build_span.set(exit_code=build_result.returncode)
+
+    results = {}
+    for derivation_path in derivation_paths:
+        # With --keep-going, the outputs of every derivation that could be built are valid
+        outputs_valid = build_result.returncode == 0 or _outputs_valid(derivation_path)
+        if outputs_valid:
+            results[derivation_path] = NixBuildResult(success=True, is_src_attr_only=is_src_attr_only,
+                                                      derivation_path=derivation_path)
+            continue
+
+        if f"hash mismatch in fixed-output derivation '{derivation_path}'" in build_result.stderr:
+            error = NixError(type=NixErrorKind.HASH_MISMATCH, error_message=build_result.stderr)
+        else:
+            # Without a log, a dependency failed, which is only reported in the output of nix build
+            log = _fetch_log(derivation_path) or build_result.stderr
+            error = NixError(type=NixErrorKind.BUILD_ERROR, error_message=log)
+        results[derivation_path] = NixBuildResult(success=False, is_src_attr_only=is_src_attr_only,
+                                                  error=error, derivation_path=derivation_path)
+    return results
+
+
+def invoke_batch_build(flake_dirs: List[Path]) -> List[NixBuildResult]:
+    """Build the packages of several flakes with one `nix build` for all sources and one for all packages.
+
+    Build directories of failed builds are not kept, since nix does not report
+    which derivation a kept directory belongs to.
+    """
+    results: List[Optional[NixBuildResult]] = [None] * len(flake_dirs)
+    pending = list(range(len(flake_dirs)))
+    for is_src_attr_only in (True, False):
+        derivation_paths = {}
+        for i in pending:
+            target_attr = f"{flake_dirs[i]}#default.src" if is_src_attr_only else f"{flake_dirs[i]}#default"
+            derivation_path, eval_error = _evaluate_derivation(target_attr, is_src_attr_only)
+            if eval_error is not None:
+                results[i] = eval_error
+            else:
+                derivation_paths[i] = derivation_path
+        if not derivation_paths:
+            break
+
+        logger.info(f"Building {len(set(derivation_paths.values()))} derivations in one batch")
+        built = _build_derivations(list(dict.fromkeys(derivation_paths.values())), is_src_attr_only)
+        pending = []
+        for i, derivation_path in derivation_paths.items():
+            results[i] = built[derivation_path]
+            if is_src_attr_only and results[i].success:
+                pending.append(i)
+
+    for i, result in enumerate(results):
+        if result.success and compiler_cache.enabled():
+            results[i] = invoke_build(False, attr=compiler_cache.verification_attr(), flake_dir=flake_dirs[i])
+    return results
+
+
+def _find_kept_build_dir(stderr: str) -> Optional[str]:
+    """Find the build directory that `nix build --keep-failed` reports to have kept."""
+    # nix reports e.g. "note: keeping build directory '/tmp/nix-build-foo.drv-0'"
+    matches = re.findall(r"keeping build directory '([^']+)'", stderr)
+    if not matches:
+        return None
+    # If a dependency failed as well, the last kept directory belongs to our derivation
+    for extra_dir in matches[:-1]:
+        _remove_build_dir(extra_dir)
+    return matches[-1]
+
+
+def _remove_build_dir(build_dir: Optional[str]):
+    if build_dir is None or not Path(build_dir).exists():
+        return
+    shutil.rmtree(build_dir, ignore_errors=True)
+    if Path(build_dir).exists():
+        # Files created by the nixbld users might not be deletable by us
+        logger.warning(f"Could not fully remove kept build directory {build_dir}")
+
+
+def cleanup_kept_build(result: NixBuildResult):
+    """Remove the build directory retained for a failed build."""
+    _remove_build_dir(result.kept_build_dir)
+    result.kept_build_dir = None
+
+
+def cleanup_kept_builds(keep: Optional[NixBuildResult] = None):
+    """Remove all retained build directories on the error stack, except the one of `keep`."""
+    for result in get_session().error_stack:
+        if result is not keep:
+            cleanup_kept_build(result)
+
+
 def prepare_logs_for_comparison(initial_error: str, attempted_improvement: str, max_lines: int = 260) -> dict:
     """Prepare logs for comparison by finding divergence point using sophisticated matching that handles reordered lines."""
     initial_lines_list = initial_error.splitlines()
@@ -137,7 +297,7 @@ def prepare_logs_for_comparison(initial_error: str, attempted_improvement: str,
 # "comiling ..." 
 def eval_initial_build() -> NixError:
     """Evaluate the initial build - look for hash mismatch which indicates progress."""
-    build_result = config.error_stack[-1]
+    build_result = get_session().error_stack[-1]
     error_message = build_result.error.error_message
     
     # Check if this is a hash mismatch error (indicates template was filled correctly)
@@ -159,7 +319,8 @@ def eval_progress(previous_result: NixBuildResult, current_result: NixBuildResul
     logger.info(f"previous error (last 50 lines): \n```\n{previous_result.error.truncated(50)}\n```\n")
     logger.info(f"new error (last 50 lines): \n```\n{current_result.error.truncated(50)}\n```\n")
 
-    repo = git.Repo(config.flake_dir.as_posix())
+    import git
+    repo = git.Repo(get_session().flake_dir.as_posix())
     logger.info(repo.commit().diff())
 
     if not current_result.is_src_attr_only and previous_result.is_src_attr_only:
@@ -186,11 +347,52 @@ def eval_progress(previous_result: NixBuildResult, current_result: NixBuildResul
     model_args = {k: v for k, v in log_comparison.items() if not k.startswith('_')}
     return evaluate_progress(**model_args)
 
+def invoke_incremental_build() -> NixBuildResult:
+    """Build the package incrementally, and verify a successful build with a real `nix build`."""
+    from vibenix.incremental import IncrementalBuilder
+    session = get_session()
+    if session.incremental_builder is None:
+        session.incremental_builder = IncrementalBuilder()
+
+    try:
+        with span("incremental-build") as incremental_span:
+            result = session.incremental_builder.build(f"{session.flake_dir}#default")
+            incremental_span.set(success=result.success)
+    except Exception as e:
+        logger.warning(f"Incremental build failed to run, falling back to a regular build: {e}")
+        return invoke_build(False)
+
+    if not result.success:
+        return result
+    logger.info("Incremental build succeeded, verifying with a regular build")
+    return invoke_build(False, attr=compiler_cache.verification_attr())
+
+
+def invoke_package_build(flake_dir: Optional[Path] = None) -> NixBuildResult:
+    """Build the package, and verify a successful build without the compiler cache."""
+    result = invoke_build(False, flake_dir=flake_dir)
+    if result.success and compiler_cache.enabled():
+        logger.info("Build with compiler cache succeeded, verifying without the cache")
+        result = invoke_build(False, attr=compiler_cache.verification_attr(), flake_dir=flake_dir)
+    return result
+
+
+def cleanup_incremental_builder():
+    """Remove the build tree and snapshots of incremental builds."""
+    session = get_session()
+    if session.incremental_builder is not None:
+        session.incremental_builder.cleanup()
+        session.incremental_builder = None
+
+
 def execute_build_and_add_to_stack(updated_code: str) -> NixBuildResult:
     """Update flake with new code, build it, and add result to error stack."""
     update_flake(updated_code)
     result = invoke_build(True)
     if result.success:
-        result = invoke_build(False)
-    config.error_stack.append(result)
+        if get_session().incremental_builds:
+            result = invoke_incremental_build()
+        else:
+            result = invoke_package_build()
+    get_session().error_stack.append(result)
     return result
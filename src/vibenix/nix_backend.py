@@ -0,0 +1,301 @@
+"""Backends for the Nix operations of a packaging session.
+
+Everything the packaging flow asks of Nix goes through a `NixBackend`:
+evaluating a flake attribute to a derivation, building derivations, fetching
+build logs, prefetching the hash of a project source and computing the store
+path of a source. `CliNixBackend` runs the Nix CLI and nurl.
+
+`RecordingNixBackend` wraps another backend and appends every outcome with its
+duration to a corpus file. `SimulatedNixBackend` replays a corpus without
+running anything, optionally with the recorded durations scaled down, so the
+coordinator, the build scheduler and the loop policies can be measured at many
+sessions per minute. Flakes are identified by the hash of their package.nix,
+so the same code gets the same outcome; code that is not in the corpus fails
+to build.
+
+Outcomes are returned as `ProcessResult`s, as if the command had run.
+"""
+
+import hashlib
+import json
+import subprocess
+import threading
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
+
+from vibenix import process
+from vibenix.process import ProcessCancelled, ProcessResult
+from vibenix.session import get_session
+from vibenix.ui.logging_config import logger
+
+# Queries of the local store, builds are limited by the `--timeout` of nix instead
+NIX_QUERY_TIMEOUT = 60
+
+# nurl queries the forge, which can hang on rate limits
+NURL_TIMEOUT = 120
+
+
+class NixBackend(ABC):
+    """The Nix operations of a packaging session."""
+
+    @abstractmethod
+    def evaluate(self, target_attr: str, timeout: Optional[float] = None) -> ProcessResult:
+        """Evaluate a flake attribute like `/path/to/flake#default` to its derivation path."""
+        pass
+
+    @abstractmethod
+    def build(self, installables: Sequence[str], options: Sequence[str] = (),
+              keep_going: bool = False, keep_failed: bool = False) -> ProcessResult:
+        """Build installables like `/nix/store/...drv^*` without linking their outputs."""
+        pass
+
+    @abstractmethod
+    def outputs_valid(self, installable: str) -> bool:
+        """Whether the outputs of an installable are in the store."""
+        pass
+
+    @abstractmethod
+    def log(self, installable: str) -> ProcessResult:
+        """Fetch the build log of an installable."""
+        pass
+
+    @abstractmethod
+    def prefetch(self, url: str, revision: Optional[str] = None) -> ProcessResult:
+        """Generate a fetcher expression with the hash of a project source."""
+        pass
+
+    @abstractmethod
+    def source_store_path(self, source_hash: str) -> str:
+        """The store path of a source with the given SRI hash."""
+        pass
+
+    @abstractmethod
+    def nixpkgs_source(self, template_dir: Path) -> ProcessResult:
+        """Realise the nixpkgs source of the template flake and print its path."""
+        pass
+
+
+class CliNixBackend(NixBackend):
+    """Runs the Nix CLI and nurl."""
+
+    def evaluate(self, target_attr: str, timeout: Optional[float] = None) -> ProcessResult:
+        return process.run(["nix", "path-info", "--derivation", target_attr], timeout=timeout)
+
+    def build(self, installables: Sequence[str], options: Sequence[str] = (),
+              keep_going: bool = False, keep_failed: bool = False) -> ProcessResult:
+        return process.run(
+            ["nix", "build"]
+            + (["--keep-going"] if keep_going else [])
+            + ["--timeout", get_session().build_timeout, "--no-link"]
+            + (["--keep-failed"] if keep_failed else [])
+            + list(installables) + list(options)
+        )
+
+    def outputs_valid(self, installable: str) -> bool:
+        return process.run(["nix", "path-info", installable], timeout=NIX_QUERY_TIMEOUT).returncode == 0
+
+    def log(self, installable: str) -> ProcessResult:
+        return process.run(["nix", "log", installable], timeout=NIX_QUERY_TIMEOUT)
+
+    def prefetch(self, url: str, revision: Optional[str] = None) -> ProcessResult:
+        return process.run(["nurl", url, revision] if revision else ["nurl", url], timeout=NURL_TIMEOUT)
+
+    def source_store_path(self, source_hash: str) -> str:
+        result = process.run(["nix-store", "--print-fixed-path", "sha256", "--recursive", source_hash, "source"],
+                             timeout=NIX_QUERY_TIMEOUT)
+        return result.stdout.strip()
+
+    def nixpkgs_source(self, template_dir: Path) -> ProcessResult:
+        return process.run(["nix", "build", ".#nixpkgs-src", "--no-link", "--print-out-paths"], cwd=template_dir)
+
+
+def flake_key(target_attr: str) -> str:
+    """Identify a flake attribute by the code of the flake's package and the attribute."""
+    flake_dir, _, attr = target_attr.partition("#")
+    package_file = Path(flake_dir) / "package.nix"
+    code = package_file.read_text() if package_file.exists() else ""
+    return hashlib.sha256(code.encode()).hexdigest() + "#" + attr
+
+
+def _build_key(installables: Sequence[str]) -> str:
+    return " ".join(sorted(installables))
+
+
+def _prefetch_key(url: str, revision: Optional[str]) -> str:
+    return f"{url} {revision}" if revision else url
+
+
+class RecordingNixBackend(NixBackend):
+    """Passes every operation on to another backend and appends its outcome to a corpus file."""
+
+    def __init__(self, corpus_file: Path, backend: Optional[NixBackend] = None):
+        self.backend = backend or CliNixBackend()
+        self.corpus_file = Path(corpus_file)
+        self.corpus_file.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _record(self, operation: str, key: str, duration: float, result: Optional[ProcessResult] = None,
+                timed_out: bool = False):
+        entry = {
+            "operation": operation,
+            "key": key,
+            "duration": duration,
+            "returncode": result.returncode if result is not None else None,
+            "stdout": result.stdout if result is not None else "",
+            "stderr": result.stderr if result is not None else "",
+            "timed_out": timed_out,
+        }
+        with self._lock, open(self.corpus_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def _run(self, operation: str, key: str, func, *args, **kwargs) -> ProcessResult:
+        start_time = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except subprocess.TimeoutExpired:
+            self._record(operation, key, time.monotonic() - start_time, timed_out=True)
+            raise
+        self._record(operation, key, time.monotonic() - start_time, result)
+        return result
+
+    def evaluate(self, target_attr: str, timeout: Optional[float] = None) -> ProcessResult:
+        return self._run("evaluate", flake_key(target_attr), self.backend.evaluate, target_attr, timeout=timeout)
+
+    def build(self, installables: Sequence[str], options: Sequence[str] = (),
+              keep_going: bool = False, keep_failed: bool = False) -> ProcessResult:
+        return self._run("build", _build_key(installables), self.backend.build, installables, options,
+                         keep_going=keep_going, keep_failed=keep_failed)
+
+    def outputs_valid(self, installable: str) -> bool:
+        start_time = time.monotonic()
+        valid = self.backend.outputs_valid(installable)
+        self._record("outputs_valid", installable, time.monotonic() - start_time,
+                     ProcessResult([], 0 if valid else 1, "", "", 0.0))
+        return valid
+
+    def log(self, installable: str) -> ProcessResult:
+        return self._run("log", installable, self.backend.log, installable)
+
+    def prefetch(self, url: str, revision: Optional[str] = None) -> ProcessResult:
+        return self._run("prefetch", _prefetch_key(url, revision), self.backend.prefetch, url, revision)
+
+    def source_store_path(self, source_hash: str) -> str:
+        start_time = time.monotonic()
+        store_path = self.backend.source_store_path(source_hash)
+        self._record("source_store_path", source_hash, time.monotonic() - start_time,
+                     ProcessResult([], 0, store_path, "", 0.0))
+        return store_path
+
+    def nixpkgs_source(self, template_dir: Path) -> ProcessResult:
+        return self._run("nixpkgs_source", "nixpkgs", self.backend.nixpkgs_source, template_dir)
+
+
+def load_corpus(corpus_files: Sequence[Path]) -> Dict[Tuple[str, str], dict]:
+    """Load recorded outcomes by operation and key, later recordings win."""
+    corpus = {}
+    for corpus_file in corpus_files:
+        with open(corpus_file) as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    corpus[(entry["operation"], entry["key"])] = entry
+    return corpus
+
+
+class SimulatedNixBackend(NixBackend):
+    """Replays recorded outcomes instead of running Nix.
+
+    Recorded durations are multiplied by `time_scale`, 0 replays without any delay.
+    Operations that were not recorded get a plausible outcome: flakes evaluate to a
+    made-up derivation, which fails to build.
+    """
+
+    def __init__(self, corpus_files: Sequence[Path], time_scale: float = 1.0):
+        self.corpus = load_corpus(corpus_files)
+        self.time_scale = time_scale
+        self.misses = 0
+        # Recorded durations of the replayed operations, by operation
+        self.recorded_time: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        logger.info(f"Simulating Nix with {len(self.corpus)} recorded outcomes")
+
+    def _wait(self, duration: float):
+        session = get_session()
+        if self.time_scale > 0 and session.cancelled.wait(duration * self.time_scale):
+            raise ProcessCancelled("Session cancelled during a simulated Nix operation")
+        if session.cancelled.is_set():
+            raise ProcessCancelled("Session cancelled before a simulated Nix operation")
+
+    def _replay(self, operation: str, key: str, timeout: Optional[float] = None) -> Optional[ProcessResult]:
+        entry = self.corpus.get((operation, key))
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            logger.debug(f"No recorded outcome for {operation} {key}")
+            return None
+        with self._lock:
+            self.recorded_time[operation] = self.recorded_time.get(operation, 0.0) + entry["duration"]
+        if entry["timed_out"] or (timeout is not None and entry["duration"] > timeout):
+            self._wait(entry["duration"] if timeout is None else min(entry["duration"], timeout))
+            raise subprocess.TimeoutExpired([operation, key], timeout)
+        self._wait(entry["duration"])
+        return ProcessResult([operation, key], entry["returncode"], entry["stdout"], entry["stderr"],
+                             entry["duration"] * self.time_scale)
+
+    def evaluate(self, target_attr: str, timeout: Optional[float] = None) -> ProcessResult:
+        key = flake_key(target_attr)
+        result = self._replay("evaluate", key, timeout)
+        if result is None:
+            digest = hashlib.sha256(key.encode()).hexdigest()[:32]
+            result = ProcessResult(["evaluate", key], 0, f"/nix/store/{digest}-simulated.drv\n", "", 0.0)
+        return result
+
+    def build(self, installables: Sequence[str], options: Sequence[str] = (),
+              keep_going: bool = False, keep_failed: bool = False) -> ProcessResult:
+        key = _build_key(installables)
+        result = self._replay("build", key)
+        if result is None:
+            stderr = "".join(f"error: builder for '{installable}' failed (not in the simulation corpus)\n"
+                             for installable in installables)
+            result = ProcessResult(["build", key], 1, "", stderr, 0.0)
+        return result
+
+    def outputs_valid(self, installable: str) -> bool:
+        result = self._replay("outputs_valid", installable)
+        return result is not None and result.returncode == 0
+
+    def log(self, installable: str) -> ProcessResult:
+        result = self._replay("log", installable)
+        if result is None:
+            result = ProcessResult(["log", installable], 0, f"no recorded build log for {installable}\n", "", 0.0)
+        return result
+
+    def prefetch(self, url: str, revision: Optional[str] = None) -> ProcessResult:
+        key = _prefetch_key(url, revision)
+        result = self._replay("prefetch", key)
+        if result is None:
+            result = ProcessResult(["prefetch", key], 1, "", f"no recorded fetcher for {key}\n", 0.0)
+        return result
+
+    def source_store_path(self, source_hash: str) -> str:
+        result = self._replay("source_store_path", source_hash)
+        if result is None:
+            digest = hashlib.sha256(source_hash.encode()).hexdigest()[:32]
+            return f"/nix/store/{digest}-source"
+        return result.stdout
+
+    def nixpkgs_source(self, template_dir: Path) -> ProcessResult:
+        result = self._replay("nixpkgs_source", "nixpkgs")
+        if result is None:
+            result = ProcessResult(["nixpkgs_source"], 1, "", "no recorded nixpkgs source\n", 0.0)
+        return result
+
+
+_cli_backend = CliNixBackend()
+
+
+def get_nix_backend() -> NixBackend:
+    """Get the Nix backend of the current session, the Nix CLI by default."""
+    return get_session().nix_backend or _cli_backend
@@ -0,0 +1,108 @@
+"""Beam search over solution candidates.
+
+The sequential loop keeps a single best solution and throws away every
+attempt that does not improve on it. The beam instead keeps the top-k
+solutions ranked by `progress_score`, so promising alternative branches
+survive a regression and do not have to be rediscovered later.
+Each round expands every beam member into new fixes, builds all of them
+concurrently, and the first solution that builds successfully wins.
+
+Unlike the sequential loop, the beam does not ask the model with `eval_progress`
+whether a build got further. That judgement compares one attempt with the one
+best solution. Ranking a beam needs a consistent order over the solutions of
+all branches, which pairwise model verdicts do not give, and it would cost a
+model call per comparison on every round. `progress_score` compares the stdenv
+phase a build failed in instead, which is what the model mostly judges by too.
+"""
+
+import hashlib
+import time
+from functools import partial
+from typing import Callable, Dict, List, Tuple
+
+from vibenix.session import get_session
+from vibenix.ccl_log import get_logger
+from vibenix.nix import cleanup_kept_build
+from vibenix.flake import update_flake
+from vibenix.packaging_flow.candidates import Solution, progress_score, propose_and_build
+from vibenix.ui.conversation import coordinator_message, coordinator_progress
+
+
+def solution_key(solution: Solution) -> str:
+    """Identify solutions by the derivation they build, falling back to their code if evaluation failed."""
+    result = solution.result
+    if result.derivation_path is not None and not result.is_src_attr_only:
+        return result.derivation_path
+    return hashlib.sha256(solution.code.encode()).hexdigest()
+
+
+def rank(solutions: List[Solution], width: int) -> Tuple[List[Solution], List[Solution]]:
+    """Split solutions into the `width` best ones and the rest, ties keep their order."""
+    ranked = sorted(solutions, key=lambda solution: progress_score(solution.result), reverse=True)
+    return ranked[:width], ranked[width:]
+
+
+def beam_search(initial: Solution, propose_fix: Callable[[Solution, List[str]], str],
+                width: int, branching: int, max_iterations: int,
+                max_rounds_without_progress: int) -> Tuple[Solution, int]:
+    """Search for a successful solution, starting from `initial`.
+
+    `propose_fix` proposes a fix for a beam member, given the fixes already tried for it.
+    Returns the first successful solution, or the best one found, with the number of rounds used.
+    """
+    ccl_logger = get_logger()
+    beam = [initial]
+    seen = {solution_key(initial)}
+    tried: Dict[str, List[str]] = {}
+    rounds_without_progress = 0
+
+    def propose_child(parent: Solution) -> str:
+        attempts = tried.setdefault(solution_key(parent), [])
+        code = propose_fix(parent, list(dict.fromkeys(attempts)))
+        attempts.append(code)
+        return code
+
+    iteration = 0
+    while iteration < max_iterations and rounds_without_progress < max_rounds_without_progress:
+        if beam[0].result.success:
+            break
+        budget_reason = get_session().budget_exceeded()
+        if budget_reason is not None:
+            coordinator_message(f"Stopping the beam search early: {budget_reason}")
+            ccl_logger.log_budget_exceeded(budget_reason)
+            break
+        coordinator_message(f"Iteration {iteration + 1}: expanding a beam of {len(beam)} solutions")
+        ccl_logger.log_iteration_start(iteration)
+        start_time = time.time()
+
+        proposers = [partial(propose_child, parent) for parent in beam for _ in range(branching)]
+        children = []
+        for child in propose_and_build(proposers):
+            key = solution_key(child)
+            if key in seen:
+                cleanup_kept_build(child.result)
+                continue
+            seen.add(key)
+            children.append(child)
+            get_session().error_stack.append(child.result)
+
+        beam, dropped = rank(beam + children, width)
+        for solution in dropped:
+            cleanup_kept_build(solution.result)
+
+        child_ids = {id(child) for child in children}
+        new_members = sum(1 for solution in beam if id(solution) in child_ids)
+        if new_members:
+            rounds_without_progress = 0
+        else:
+            rounds_without_progress += 1
+        coordinator_progress(f"Iteration {iteration + 1}: {len(children)} new solutions, {new_members} entered the beam")
+        ccl_logger.log_beam(iteration, len(beam), len(children), new_members, time.time() - start_time)
+        ccl_logger.log_iteration_end(iteration, beam[0].result)
+        iteration += 1
+
+    # Leave the main flake in the state of the solution we continue with
+    update_flake(beam[0].code)
+    for solution in beam[1:]:
+        cleanup_kept_build(solution.result)
+    return beam[0], iteration
@@ -0,0 +1,149 @@
+"""Speculative fix candidates for the packaging flow.
+
+Instead of one fix per iteration, several alternative fixes are requested from
+the model and built concurrently, each in its own copy of the flake.
+Builds start as soon as a candidate is proposed, so they overlap with
+the model proposing the next candidate.
+"""
+
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator, List, Tuple
+
+from pydantic import BaseModel
+
+from vibenix.session import get_session, submit_in_session
+from vibenix.ccl_log import get_logger
+from vibenix.errors import BUILD_PHASES, NixBuildResult, NixErrorKind
+from vibenix.flake import copy_flake, update_flake
+from vibenix.nix import invoke_build, invoke_batch_build, invoke_package_build, cleanup_kept_build
+from vibenix.ui.conversation import coordinator_message, coordinator_progress
+
+
+class Solution(BaseModel):
+    """Represents a solution candidate with its code and build result."""
+    code: str
+    result: NixBuildResult
+
+
+# Errors later in the pipeline indicate that the build got further
+ERROR_KIND_RANK = {
+    NixErrorKind.EVAL_ERROR: 0,
+    NixErrorKind.HASH_MISMATCH: 1,
+    NixErrorKind.BUILD_ERROR: 2,
+}
+
+
+def progress_score(result: NixBuildResult) -> Tuple[bool, bool, int, int, int]:
+    """Score how far a build got, higher is better.
+
+    A successful build beats everything, then a package build beats a build that
+    failed on the source, and among failures of the same kind the one that failed
+    in a later stdenv phase wins. The longer log only decides within the same phase,
+    since a verbose configure step says nothing about reaching the install phase.
+    """
+    if result.success:
+        return (True, True, len(ERROR_KIND_RANK), len(BUILD_PHASES), 0)
+    error = result.error
+    phase_rank = BUILD_PHASES.index(error.phase) if error.phase in BUILD_PHASES else -1
+    return (False, not result.is_src_attr_only, ERROR_KIND_RANK[error.type], phase_rank, error.line_count)
+
+
+def build_solution(code: str, flake_dir: Path) -> NixBuildResult:
+    """Build code in a flake copy, the same way `execute_build_and_add_to_stack` builds in the main flake."""
+    update_flake(code, flake_dir)
+    result = invoke_build(True, flake_dir=flake_dir)
+    if result.success:
+        result = invoke_package_build(flake_dir)
+    return result
+
+
+@contextmanager
+def flake_copies(count: int) -> Iterator[List[Path]]:
+    """Temporary copies of the flake, removed once the block is left."""
+    copies = [copy_flake() for _ in range(count)]
+    try:
+        yield copies
+    finally:
+        for flake_copy in copies:
+            shutil.rmtree(flake_copy, ignore_errors=True)
+
+
+def propose_and_build(proposers: List[Callable[[], str]]) -> List[Solution]:
+    """Call each proposer in turn and build its code as soon as it is proposed.
+
+    Identical code is only built once, the solutions are returned in the order they were first proposed.
+    """
+    if get_session().batch_builds:
+        return propose_and_build_batch(proposers)
+
+    codes = []
+    with flake_copies(len(proposers)) as flake_dirs, \
+         ThreadPoolExecutor(max_workers=min(len(proposers), os.cpu_count() or 1)) as executor:
+        futures = {}
+        for proposer, flake_dir in zip(proposers, flake_dirs):
+            coordinator_progress(f"Proposing fix candidate {len(codes) + 1} of {len(proposers)}...")
+            code = proposer()
+            codes.append(code)
+            if code not in futures:
+                futures[code] = submit_in_session(executor, build_solution, code, flake_dir)
+        coordinator_progress(f"Waiting for {len(futures)} candidate builds...")
+        results = {code: future.result() for code, future in futures.items()}
+    return [Solution(code=code, result=results[code]) for code in futures]
+
+
+def propose_and_build_batch(proposers: List[Callable[[], str]]) -> List[Solution]:
+    """Call all proposers first, and build the proposed code with a single `nix build` per stage."""
+    codes = []
+    for proposer in proposers:
+        coordinator_progress(f"Proposing fix candidate {len(codes) + 1} of {len(proposers)}...")
+        codes.append(proposer())
+    unique_codes = list(dict.fromkeys(codes))
+    coordinator_progress(f"Building {len(unique_codes)} candidates in one batch...")
+    with flake_copies(len(unique_codes)) as flake_dirs:
+        for code, flake_dir in zip(unique_codes, flake_dirs):
+            update_flake(code, flake_dir)
+        results = invoke_batch_build(flake_dirs)
+    return [Solution(code=code, result=result) for code, result in zip(unique_codes, results)]
+
+
+def propose_and_build_candidates(propose_fix: Callable[[List[str]], str], count: int) -> List[Solution]:
+    """Ask for `count` alternative fixes and build each one as soon as it is proposed.
+
+    `propose_fix` receives the candidates proposed so far, to steer the model towards different approaches.
+    """
+    proposed = []
+
+    def propose() -> str:
+        code = propose_fix(list(dict.fromkeys(proposed)))
+        proposed.append(code)
+        return code
+
+    return propose_and_build([propose] * count)
+
+
+def select_candidate(iteration: int, candidates: List[Solution], build_time: float) -> Solution:
+    """Keep the candidate that got furthest, make it the state of the main flake and put it on the error stack."""
+    best_index = max(range(len(candidates)), key=lambda i: progress_score(candidates[i].result))
+    best = candidates[best_index]
+    for i, candidate in enumerate(candidates):
+        outcome = "success" if candidate.result.success else candidate.result.error.type.value
+        coordinator_message(f"Candidate {i + 1}: {outcome}" + (" (selected)" if i == best_index else ""))
+        if i != best_index:
+            cleanup_kept_build(candidate.result)
+
+    update_flake(best.code)
+    get_session().error_stack.append(best.result)
+    get_logger().log_candidates(iteration, len(candidates), best_index, build_time)
+    return best
+
+
+def fix_with_candidates(iteration: int, propose_fix: Callable[[List[str]], str], count: int) -> Solution:
+    """Propose and build `count` candidate fixes, and return the best one."""
+    start_time = time.time()
+    candidates = propose_and_build_candidates(propose_fix, count)
+    return select_candidate(iteration, candidates, time.time() - start_time)
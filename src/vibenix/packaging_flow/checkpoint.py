@@ -0,0 +1,76 @@
+"""Checkpoints of the packaging flow, to resume a session that was interrupted.
+
+After the initial build and after every iteration, the state of the agentic
+loop is written to `checkpoint.json` in the output directory. Build results
+are stored with references into the log store, so checkpoints stay small.
+A resumed session continues with the next iteration, without repeating the
+model calls and builds that led to the checkpoint.
+"""
+
+import os
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+from pydantic import BaseModel, ValidationError
+
+from vibenix.errors import NixBuildResult
+from vibenix.packaging_flow.candidates import Solution
+from vibenix.ui.logging_config import logger
+
+CHECKPOINT_FILE = "checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+
+class SessionCheckpoint(BaseModel):
+    """State of a packaging session at the end of an iteration."""
+    version: int = CHECKPOINT_VERSION
+    project_url: str
+    summary: str
+    release_data: Optional[dict] = None
+    template_type: str
+    template_notes: Optional[str] = None
+    # Store path of the project source, browsed by the model's source functions
+    # None if the store path of the source could not be computed
+    store_path: Optional[str]
+    best: Solution
+    candidate: Solution
+    error_stack: List[NixBuildResult] = []
+    iteration: int = 0
+    consecutive_rebuilds_without_progress: int = 0
+    consecutive_non_build_errors: int = 0
+    total_cost: float = 0.0
+    # Spent before the checkpoint, so the budget of a resumed session does not start over
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    elapsed_time: float = 0.0
+
+
+def save_checkpoint(checkpoint: SessionCheckpoint, path: Path):
+    """Write a checkpoint, replacing the previous one atomically so a crash never leaves a partial file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(checkpoint.model_dump_json(indent=2))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+
+
+def load_checkpoint(path: Path) -> Optional[SessionCheckpoint]:
+    """Load a checkpoint, or None if there is no usable one."""
+    if not path.exists():
+        return None
+    try:
+        checkpoint = SessionCheckpoint.model_validate_json(path.read_text())
+    except ValidationError as e:
+        logger.warning(f"Ignoring unreadable checkpoint {path}: {e}")
+        return None
+    if checkpoint.version != CHECKPOINT_VERSION:
+        logger.warning(f"Ignoring checkpoint {path} of version {checkpoint.version}")
+        return None
+    return checkpoint
@@ -5,10 +5,13 @@ This module contains all functions decorated with @ask_model that interact with
 
 from magentic import StreamedStr
 from vibenix.template.template_types import TemplateType
-from vibenix.ui.conversation import _retry_with_rate_limit, ask_model, ask_model_enum, handle_model_chat
+from vibenix.ui.conversation import ask_model, ask_model_enum, handle_model_chat
 from vibenix.errors import NixBuildErrorDiff
 from magentic import Chat, UserMessage, StreamedResponse
 from vibenix.function_calls import search_nixpkgs_for_package, search_nix_functions
+from vibenix.session import PROMPT_METADATA_KEY, ROUTED_METADATA_KEY, SESSION_ID_METADATA_KEY, find_session, get_session, use_prompt
+from vibenix.ui.logging_config import logger
+from vibenix.usage import ModelCall
 
 from litellm.integrations.custom_logger import CustomLogger
 from litellm.files.main import ModelResponse
@@ -19,36 +22,50 @@ import sys
 
 
 class EndStreamLogger(CustomLogger):
-    """A custom callback handler to log usage and cost at the end of a successful call."""
+    """A custom callback handler to record usage, latency and cost at the end of a successful call.
+
+    Calls are recorded in the ledger of the session that made the request, `total_cost` sums up all sessions.
+    """
     def __init__(self):
         super().__init__()
         self.total_cost = 0.0
-        
+
+    def _metadata(self, kwargs) -> dict:
+        return (kwargs.get("litellm_params") or {}).get("metadata") or {}
+
+    def _session(self, kwargs):
+        return find_session(self._metadata(kwargs).get(SESSION_ID_METADATA_KEY)) or get_session()
+
     def log_success_event(self, kwargs, response_obj: ModelResponse, start_time, end_time):
-        print("\n--- STREAM COMPLETE (Callback Triggered) ---")
         try:
             # response_obj is the final, aggregated response.
             # For streaming, the usage is available in the final chunk's response_obj.
-            if response_obj and hasattr(response_obj, 'usage'):
-                usage = response_obj.usage
-                print(f"Final Prompt Tokens: {usage.prompt_tokens}")
-                print(f"Final Completion Tokens: {usage.completion_tokens}")
-                print(f"Final Total Tokens: {usage.total_tokens}")
-
-                # Calculate cost from the final aggregated response
+            usage = getattr(response_obj, "usage", None)
+            try:
                 cost = litellm.completion_cost(completion_response=response_obj)
-                print(f"Total Stream Cost: ${cost:.6f}")
-                self.total_cost += cost
-            else:
-                if kwargs.get("response_cost") is not None:
-                     cost = kwargs['response_cost']
-                     print(f"Total Stream Cost (from kwargs): ${cost:.6f}")
-                     self.total_cost += cost
-
+            except Exception:
+                # Unknown models have no price
+                cost = kwargs.get("response_cost") or 0.0
+            prompt_details = getattr(usage, "prompt_tokens_details", None)
+            completion_start_time = kwargs.get("completion_start_time")
+            call = ModelCall(
+                prompt=self._metadata(kwargs).get(PROMPT_METADATA_KEY) or "unknown",
+                model=kwargs.get("model") or getattr(response_obj, "model", None) or "unknown",
+                prompt_tokens=getattr(usage, "prompt_tokens", None) or 0,
+                completion_tokens=getattr(usage, "completion_tokens", None) or 0,
+                cached_tokens=getattr(prompt_details, "cached_tokens", None) or 0,
+                time_to_first_token=(completion_start_time - start_time).total_seconds()
+                                    if kwargs.get("stream") and completion_start_time else None,
+                latency=(end_time - start_time).total_seconds(),
+                cost=cost,
+                routed=bool(self._metadata(kwargs).get(ROUTED_METADATA_KEY)),
+            )
+            self.total_cost += cost
+            self._session(kwargs).record_model_call(call)
+            logger.debug(f"Model call for {call.prompt} to {call.model}: {call.prompt_tokens} prompt and "
+                         f"{call.completion_tokens} completion tokens in {call.latency:.1f}s, ${cost:.6f}")
         except Exception as e:
-            print(f"Error in success_callback: {e}")
-        finally:
-            print("------------------------------------------\n")
+            logger.warning(f"Could not record the usage of a model call: {e}")
 
 
 class TokenLimitEnforcer(CustomLogger):
@@ -98,6 +115,7 @@ end_stream_logger = EndStreamLogger()
 litellm.callbacks = [token_limit_enforcer, end_stream_logger]
 
 
+@use_prompt("set_up_project")
 def set_up_project(code_template: str, project_page: str, release_data: dict = None, template_notes: str = None) -> StreamedStr:
     """Initial setup of a Nix package from a GitHub project."""
 
@@ -148,7 +166,6 @@ Note: Even though the provided template uses the mkDerivation function, this is
         functions=[search_nixpkgs_for_package, search_nix_functions],
         output_types=[StreamedResponse],
     )
-    chat = _retry_with_rate_limit(chat.submit)
 
     return handle_model_chat(chat)
 
@@ -219,6 +236,7 @@ Here is the previous Nix code:
 def evaluate_code(code: str, previous_code: str, feedback: str = None) -> RefinementExit:
     ...
 
+@use_prompt("get_feedback")
 def get_feedback(code: str, log: str, project_page: str = None, release_data: dict = None, template_notes: str = None, additional_functions: list = []) -> StreamedStr:
     """Refine a nix package to remove unnecessary snippets, add missing code, and improve style."""
     prompt = """You are software packaging expert who can build any project using the Nix programming language.
@@ -308,11 +326,11 @@ And some relevant metadata of the latest release:
         functions=[search_nixpkgs_for_package, search_nix_functions]+additional_functions,
         output_types=[StreamedResponse],
     )
-    chat = _retry_with_rate_limit(chat.submit)
 
     return handle_model_chat(chat)
 
 
+@use_prompt("refine_code")
 def refine_code(code: str, feedback: str, project_page: str = None, release_data: dict = None, template_notes: str = None, additional_functions: list = []) -> StreamedStr:
     """Refine a nix package to remove unnecessary snippets, add missing code, and improve style."""
     prompt = """You are software packaging expert who can build any project using the Nix programming language.
@@ -383,11 +401,11 @@ And some relevant metadata of the latest release:
         output_types=[StreamedResponse],
     )
 
-    chat = _retry_with_rate_limit(chat.submit)
     return handle_model_chat(chat)
 
 
-def fix_build_error(code: str, error: str, project_page: str = None, release_data: dict = None, template_notes: str = None, additional_functions: list = []) -> StreamedStr:
+@use_prompt("fix_build_error")
+def fix_build_error(code: str, error: str, project_page: str = None, release_data: dict = None, template_notes: str = None, additional_functions: list = [], other_attempts: list = []) -> StreamedStr:
     """Fix a build error in Nix code."""
     prompt = """You are software packaging expert who can build any project using the Nix programming language.
 
@@ -406,8 +424,14 @@ Error:
 
 {template_notes_section}
 
+{other_attempts_section}
+
 If the error message does not give you enough information to make progress, and to verify your actions, look at relevant files in the proejct directory,
 and try to compare your approach with similar packages in nixpkgs.
+The error above only shows the end of the build log. If the actual cause might be reported earlier, search and read the full build log
+of this and previous builds with the build log tools instead of guessing.
+If the build_ tools are available, they let you browse the build directory that the failed build left behind,
+including generated files and logs like `config.log`, `CMakeFiles/CMakeError.log` or `meson-logs/meson-log.txt`.
 
 Known errors:
 - `error: evaluation aborted with the following error message: 'lib.customisation.callPackageWith: Function called without required argument "package_name" at /nix/store/[...]`:
@@ -449,6 +473,16 @@ And some relevant metadata of the latest release:
 ```
 {template_notes}
 ```
+"""
+
+    # Include the fixes that are already being tried for this error
+    other_attempts_section = ""
+    if other_attempts:
+        other_attempts_section = "The following fixes for this error are already being tried, propose a different approach:\n"
+        for attempt in other_attempts:
+            other_attempts_section += f"""```nix
+{attempt}
+```
 """
 
     chat = Chat(
@@ -456,12 +490,12 @@ And some relevant metadata of the latest release:
             code=code,
             error=error,
             project_info_section=project_info_section,
-            template_notes_section=template_notes_section
+            template_notes_section=template_notes_section,
+            other_attempts_section=other_attempts_section
         ))],
         functions=[search_nixpkgs_for_package, search_nix_functions]+additional_functions,
         output_types=[StreamedResponse],
     )
-    chat = _retry_with_rate_limit(chat.submit)
 
     return handle_model_chat(chat)
 
@@ -1,42 +1,66 @@
 """Business logic for vibenix using the coordinator pattern."""
 
 import subprocess
+import time
+from contextlib import contextmanager, nullcontext
 from pathlib import Path
-from pydantic import BaseModel
+from typing import Optional
 
 from vibenix.ui.conversation import ask_user,  coordinator_message, coordinator_error, coordinator_progress
 from vibenix.parsing import scrape_and_process, extract_updated_code, fetch_combined_project_data, fill_src_attributes
-from vibenix.flake import init_flake
-from vibenix.nix import eval_progress, execute_build_and_add_to_stack
+from vibenix.flake import init_flake, update_flake
+from vibenix.nix import eval_progress, execute_build_and_add_to_stack, cleanup_kept_builds, cleanup_incremental_builder
 from vibenix.packaging_flow.model_prompts import pick_template, set_up_project, summarize_github, fix_build_error, fix_hash_mismatch, evaluate_code, refine_code, get_feedback, RefinementExit
 from vibenix.packaging_flow.user_prompts import get_project_url
-from vibenix import config
+from vibenix.session import get_session
 from vibenix.errors import NixBuildErrorDiff, NixErrorKind, NixBuildResult
 from vibenix.function_calls_source import create_source_function_calls
-from vibenix.ccl_log import init_logger, get_logger, close_logger
-
-class Solution(BaseModel):
-    """Represents a solution candidate with its code and build result."""
-    code: str
-    result: NixBuildResult
+from vibenix.function_calls_build_log import create_build_log_function_calls
+from vibenix.ccl_log import init_logger, get_logger, close_logger, span
+from vibenix.log_store import get_log_store
+from vibenix.packaging_flow.candidates import Solution, fix_with_candidates
+from vibenix.packaging_flow.beam import beam_search
+from vibenix.packaging_flow.checkpoint import CHECKPOINT_FILE, SessionCheckpoint, load_checkpoint, save_checkpoint
+from vibenix.nix_backend import get_nix_backend
+from vibenix.profiling import profile_session
+from vibenix.ui.logging_config import logger
 
 
 def get_nixpkgs_source_path() -> str:
     """Get the nixpkgs source path from the template flake."""
     try:
-        result = subprocess.run(
-            ["nix", "build", ".#nixpkgs-src", "--no-link", "--print-out-paths"],
-            cwd=config.template_dir,
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        result = get_nix_backend().nixpkgs_source(get_session().template_dir)
+        result.check_returncode()
         return result.stdout.strip()
     except subprocess.CalledProcessError as e:
         coordinator_error(f"Failed to get nixpkgs source path: {e}")
         raise
 
 
+def source_function_calls(store_path: Optional[str], prefix: str) -> list:
+    """The source functions of a store path, none if the path is unknown or not in the store."""
+    if not store_path or not Path(store_path).is_dir():
+        logger.warning(f"Source {store_path} is not available, continuing without the {prefix}source functions")
+        return []
+    return create_source_function_calls(store_path, prefix)
+
+
+
+@contextmanager
+def kept_build_functions(result: NixBuildResult):
+    """Expose the kept build directory of a failed build as `build_` source functions.
+
+    The directory stays while its build is the best one, so later fixes of the
+    same build can browse it too. `cleanup_kept_builds` removes it once the
+    loop continues from another build.
+    """
+    build_dir = result.kept_build_dir
+    if build_dir is None or not Path(build_dir).is_dir():
+        yield []
+        return
+    coordinator_message(f"Build directory of the failed build is available at {build_dir}")
+    yield create_source_function_calls(build_dir, "build_")
+
 
 def analyze_project(project_page: str, release_data: dict = None) -> str:
     """Analyze the project using the model."""
@@ -54,13 +78,8 @@ def create_initial_package(template: str, project_page: str, release_data: dict
 def run_nurl(url, rev=None):
     """Run nurl command and return the output."""
     try:
-        cmd = ['nurl', url, rev] if rev else ['nurl', url]
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
-        )
+        result = get_nix_backend().prefetch(url, rev)
+        result.check_returncode()
         return result.stdout.strip()
     except subprocess.CalledProcessError as e:
         error_output = e.stderr.lower()
@@ -70,6 +89,9 @@ def run_nurl(url, rev=None):
             return "RATE_LIMITED"
         print(f"Error running nurl for {url}: {e.stderr}")
         return None
+    except subprocess.TimeoutExpired:
+        print(f"Error: nurl timed out for {url}")
+        return None
     except FileNotFoundError:
         print("Error: nurl command not found. Please ensure nurl is installed.")
         return None
@@ -97,6 +119,12 @@ def refine_package(curr: Solution, project_page: str):
     max_iterations = 3
 
     for iteration in range(max_iterations):
+        budget_reason = get_session().budget_exceeded()
+        if budget_reason is not None:
+            coordinator_message(f"Stopping the refinement early: {budget_reason}")
+            get_logger().log_budget_exceeded(budget_reason)
+            return curr, RefinementExit.INCOMPLETE
+
         # Get feedback
         # TODO BUILD LOG IS NOT BEING PASSED!
         feedback = get_feedback(curr.code, "", project_page)
@@ -131,12 +159,12 @@ def refine_package(curr: Solution, project_page: str):
     return curr, RefinementExit.INCOMPLETE
 
 
-def package_project(output_dir=None, project_url=None, revision=None, fetcher=None):
-    """Main coordinator function for packaging a project."""
-    # Initialize CCL logger
-    log_file = Path(output_dir) / "run.ccl" if output_dir else Path("run.ccl")
-    ccl_logger = init_logger(log_file)
-    
+def start_session(ccl_logger, project_url=None, revision=None, fetcher=None) -> Optional[SessionCheckpoint]:
+    """Analyze the project, fill the template and run the initial build.
+
+    Returns the state the agentic loop starts from, or None if the project page could not be fetched.
+    """
+    session = get_session()
     # Step 1: Get project URL (includes welcome message)
     if project_url is None:
         project_url = get_project_url()
@@ -155,22 +183,25 @@ def package_project(output_dir=None, project_url=None, revision=None, fetcher=No
             coordinator_error("Ignoring revision parameter in favor of provided fetcher.")
     else:
         coordinator_progress("Obtaining project fetcher from the provided URL")
-        fetcher = run_nurl(project_url, revision)
+        with span("prefetch-source"):
+            fetcher = run_nurl(project_url, revision)
 
     coordinator_progress(f"Fetching project information from {project_url}")
     
     # Step 2: Scrape project page
     try:
-        project_page = scrape_and_process(project_url)
+        with span("fetch-project-page"):
+            project_page = scrape_and_process(project_url)
     except Exception as e:
         coordinator_error(f"Failed to fetch project page: {e}")
-        return
+        return None
     
     # Step 2b: Fetch release data from GitHub API
     release_data = None
     try:
         from vibenix.parsing import fetch_github_release_data
-        release_data = fetch_github_release_data(project_url)
+        with span("fetch-release-data"):
+            release_data = fetch_github_release_data(project_url)
         if release_data:
             coordinator_message("Found GitHub release information via API")
     except Exception as e:
@@ -178,94 +209,201 @@ def package_project(output_dir=None, project_url=None, revision=None, fetcher=No
     
     # Step 3: Analyze project
     coordinator_message("I found the project information. Let me analyze it.")
-    summary = analyze_project(project_page, release_data)
+    with span("analyze-project"):
+        summary = analyze_project(project_page, release_data)
 
     # Step 4: Initialize flake
     coordinator_progress("Setting up a temporary Nix flake for packaging")
-    init_flake()
-    coordinator_message(f"Working on temporary flake at {config.flake_dir}")
+    with span("init-flake"):
+        init_flake()
+    coordinator_message(f"Working on temporary flake at {session.flake_dir}")
     
     # Step 5: Load template
-    template_type = pick_template(summary)
+    with span("pick-template") as template_span:
+        template_type = pick_template(summary)
+        template_span.set(template=template_type.value)
     coordinator_message(f"Selected template: {template_type.value}")
     ccl_logger.log_template_selected(template_type.value)
     template_filename = f"{template_type.value}.nix"
-    template_path = config.template_dir / template_filename
+    template_path = session.template_dir / template_filename
     starting_template = template_path.read_text()
     
     # Load optional notes file
     notes_filename = f"{template_type.value}.notes"
-    notes_path = config.template_dir / notes_filename
+    notes_path = session.template_dir / notes_filename
     template_notes = notes_path.read_text() if notes_path.exists() else None
 
     # Step 6.a: Manual src setup
     coordinator_message("Setting up the src attribute in the template...")
-    initial_code, store_path = fill_src_attributes(starting_template, fetcher)
+    with span("fill-template"):
+        initial_code, store_path = fill_src_attributes(starting_template, fetcher)
+
+    # Step 7: Initial build
+    coordinator_progress("Testing the initial build...")
+    with span("initial-build"):
+        initial_result = execute_build_and_add_to_stack(initial_code)
+    initial = Solution(code=initial_code, result=initial_result)
+    return SessionCheckpoint(
+        project_url=project_url,
+        summary=summary,
+        release_data=release_data,
+        template_type=template_type.value,
+        template_notes=template_notes,
+        store_path=store_path,
+        best=initial,
+        candidate=initial,
+        error_stack=list(session.error_stack),
+        total_cost=session.total_cost,
+        prompt_tokens=session.prompt_tokens,
+        completion_tokens=session.completion_tokens,
+        elapsed_time=time.monotonic() - session.start_time,
+    )
+
+
+def resume_session(ccl_logger, checkpoint: SessionCheckpoint):
+    """Restore the flake, error stack and cost of a session from its checkpoint."""
+    session = get_session()
+    coordinator_message(f"Resuming the session for {checkpoint.project_url} at iteration {checkpoint.iteration + 1}")
+    ccl_logger.log_session_resume(checkpoint.iteration)
+    init_flake()
+    update_flake(checkpoint.candidate.code)
+    coordinator_message(f"Working on temporary flake at {session.flake_dir}")
+    session.error_stack.clear()
+    session.error_stack.extend(checkpoint.error_stack)
+    session.total_cost = checkpoint.total_cost
+    # The budget of a resumed session counts what was spent before the interruption
+    session.prompt_tokens = checkpoint.prompt_tokens
+    session.completion_tokens = checkpoint.completion_tokens
+    session.start_time = time.monotonic() - checkpoint.elapsed_time
+
+
+def package_project(output_dir=None, project_url=None, revision=None, fetcher=None, resume=False):
+    """Main coordinator function for packaging a project, in the current session.
+
+    With `resume`, the session continues from the checkpoint in the output directory, if there is one.
+    """
+    session = get_session()
+    checkpoint_file = Path(output_dir or ".") / CHECKPOINT_FILE
+    checkpoint = load_checkpoint(checkpoint_file) if resume else None
+    if resume and checkpoint is None:
+        coordinator_message(f"No checkpoint found at {checkpoint_file}, starting a new session")
+
+    # Initialize CCL logger
+    log_file = Path(output_dir) / "run.ccl" if output_dir else Path("run.ccl")
+    ccl_logger = init_logger(log_file, append=checkpoint is not None)
+
+    if checkpoint is None:
+        checkpoint = start_session(ccl_logger, project_url, revision, fetcher)
+        if checkpoint is None:
+            return None
+        save_checkpoint(checkpoint, checkpoint_file)
+    else:
+        resume_session(ccl_logger, checkpoint)
+    project_url = checkpoint.project_url
+    summary = checkpoint.summary
+    release_data = checkpoint.release_data
+    template_notes = checkpoint.template_notes
 
     # Create functions for both the project source and nixpkgs
-    project_functions = create_source_function_calls(store_path, "project_")
-    nixpkgs_path = get_nixpkgs_source_path()
+    project_functions = source_function_calls(checkpoint.store_path, "project_")
+    with span("nixpkgs-source"):
+        nixpkgs_path = get_nixpkgs_source_path()
     nixpkgs_functions = create_source_function_calls(nixpkgs_path, "nixpkgs_")
-    additional_functions = project_functions + nixpkgs_functions
-    
-    # Step 7: Agentic loop
-    coordinator_progress("Testing the initial build...")
-    initial_result = execute_build_and_add_to_stack(initial_code)
-    best = Solution(code=initial_code, result=initial_result)
+    build_log_functions = create_build_log_function_calls(session)
+    additional_functions = project_functions + nixpkgs_functions + build_log_functions
+
+    # Step 8: Agentic loop
+    best = checkpoint.best
     last_successful = None
 
     # Log that we're starting iterations
     ccl_logger.log_before_iterations()
     
-    iteration = 0
+    iteration = checkpoint.iteration
     MAX_ITERATIONS = 40
-    candidate = best
+    candidate = checkpoint.candidate
     MAX_CONSECUTIVE_REBUILDS_WITHOUT_PROGRESS = 5
-    consecutive_rebuilds_without_progress = 0
+    consecutive_rebuilds_without_progress = checkpoint.consecutive_rebuilds_without_progress
     MAX_CONSECUTIVE_NON_BUILD_ERRORS = 5
-    consecutive_non_build_errors = 0
+    consecutive_non_build_errors = checkpoint.consecutive_non_build_errors
+
+    def save_progress():
+        save_checkpoint(checkpoint.model_copy(update={
+            "best": best,
+            "candidate": candidate,
+            "error_stack": list(session.error_stack),
+            "iteration": iteration,
+            "consecutive_rebuilds_without_progress": consecutive_rebuilds_without_progress,
+            "consecutive_non_build_errors": consecutive_non_build_errors,
+            "total_cost": session.total_cost,
+            "prompt_tokens": session.prompt_tokens,
+            "completion_tokens": session.completion_tokens,
+            "elapsed_time": time.monotonic() - session.start_time,
+        }), checkpoint_file)
+
+    if session.beam_width > 1:
+        def propose_fix_for(solution: Solution, other_attempts: list) -> str:
+            if solution.result.error.type == NixErrorKind.HASH_MISMATCH:
+                fixed_response = fix_hash_mismatch(solution.code, solution.result.error.truncated())
+            else:
+                with kept_build_functions(solution.result) as build_functions:
+                    fixed_response = fix_build_error(solution.code, solution.result.error.truncated(), summary, release_data, template_notes, additional_functions + build_functions, other_attempts)
+            return extract_updated_code(fixed_response)
+
+        candidate, iteration = beam_search(best, propose_fix_for, session.beam_width, session.fix_candidates,
+                                           MAX_ITERATIONS, MAX_CONSECUTIVE_REBUILDS_WITHOUT_PROGRESS)
+        if candidate.result.success:
+            return finish_successful_session(candidate, summary, iteration, project_url, output_dir)
+        budget_reason = session.budget_exceeded()
+        if budget_reason is not None:
+            best = candidate
+            save_progress()
+            return finish_stopped_session(candidate, budget_reason, iteration, project_url, output_dir)
+        coordinator_error("Beam search did not find a successful build.")
+        finish_failed_session(iteration)
+        return None
     
+    budget_reason = None
     while iteration < MAX_ITERATIONS and consecutive_rebuilds_without_progress < MAX_CONSECUTIVE_REBUILDS_WITHOUT_PROGRESS:
+        if not candidate.result.success:
+            budget_reason = session.budget_exceeded()
+            if budget_reason is not None:
+                break
         coordinator_message(f"Iteration {iteration + 1}:")
         coordinator_message(f"```\n{candidate.result.error.truncated()}\n```")
         ccl_logger.log_iteration_start(iteration)
         
         # Fix the error based on type
         if candidate.result.success:
-            coordinator_message("Build succeeded! Refining package...")
-            refined_candidate, completed = refine_package(candidate, summary)
-            
-            if completed == RefinementExit.ERROR:
-                coordinator_error("Refinement encountered an error. Returning pre-refinement solution.")
-            elif completed == RefinementExit.INCOMPLETE:
-                coordinator_message("Refinement process reached max iterations.")
-            
-            # Always log success and return, regardless of refinement outcome
-            from vibenix.packaging_flow.model_prompts import end_stream_logger
-            ccl_logger.log_session_end(True, iteration, end_stream_logger.total_cost)
-            close_logger()
-            if output_dir:
-                # Use refined version if no error, otherwise use pre-refinement version
-                final_code = refined_candidate.code if completed != RefinementExit.ERROR else candidate.code
-                save_package_output(final_code, project_url, output_dir)
-            return refined_candidate.code if completed != RefinementExit.ERROR else candidate.code
+            return finish_successful_session(candidate, summary, iteration, project_url, output_dir)
         elif candidate.result.error.type == NixErrorKind.HASH_MISMATCH:
             coordinator_message("Hash mismatch detected, fixing...")
             coordinator_message(f"code:\n{candidate.code}\n")
             coordinator_message(f"error:\n{candidate.result.error.truncated()}\n")
             fixed_response = fix_hash_mismatch(candidate.code, candidate.result.error.truncated())
+            updated_code = extract_updated_code(fixed_response)
         else:
             coordinator_message("Other error detected, fixing...")
             coordinator_message(f"code:\n{candidate.code}\n")
             coordinator_message(f"error:\n{candidate.result.error.truncated()}\n")
-            fixed_response = fix_build_error(candidate.code, candidate.result.error.truncated(), summary, release_data, template_notes, additional_functions)
-        
-        updated_code = extract_updated_code(fixed_response)
-            
-        # Test the fix
-        coordinator_progress(f"Iteration {iteration}: Testing fix attempt {iteration} of {MAX_ITERATIONS}...")
-        new_result = execute_build_and_add_to_stack(updated_code)
-        candidate = Solution(code=updated_code, result=new_result)
+            with kept_build_functions(candidate.result) as build_functions:
+                def propose_fix(other_attempts: list) -> str:
+                    fixed_response = fix_build_error(candidate.code, candidate.result.error.truncated(), summary, release_data, template_notes, additional_functions + build_functions, other_attempts)
+                    return extract_updated_code(fixed_response)
+
+                if session.fix_candidates > 1:
+                    # Build several alternative fixes in parallel and continue with the one that got furthest
+                    coordinator_progress(f"Iteration {iteration}: Testing {session.fix_candidates} fix candidates...")
+                    candidate = fix_with_candidates(iteration, propose_fix, session.fix_candidates)
+                    updated_code = None
+                else:
+                    updated_code = propose_fix([])
+
+        if updated_code is not None:
+            # Test the fix
+            coordinator_progress(f"Iteration {iteration}: Testing fix attempt {iteration} of {MAX_ITERATIONS}...")
+            candidate = Solution(code=updated_code, result=execute_build_and_add_to_stack(updated_code))
+        new_result = candidate.result
         
         if not new_result.success and new_result.error.type == NixErrorKind.BUILD_ERROR:
             coordinator_message(f"Nix build result: {candidate.result.error.type}")
@@ -287,17 +425,80 @@ def package_project(output_dir=None, project_url=None, revision=None, fetcher=No
         if consecutive_non_build_errors < MAX_CONSECUTIVE_NON_BUILD_ERRORS:
             candidate = best
             consecutive_non_build_errors = 0
+        # Only the build directory of the build we continue from can still be useful
+        cleanup_kept_builds(keep=candidate.result)
         ccl_logger.log_iteration_end(iteration, new_result)
         iteration += 1
+        save_progress()
 
-    if consecutive_non_build_errors >= MAX_CONSECUTIVE_NON_BUILD_ERRORS:
+    if budget_reason is not None:
+        ccl_logger.log_budget_exceeded(budget_reason)
+        return finish_stopped_session(best, budget_reason, iteration, project_url, output_dir)
+    elif consecutive_non_build_errors >= MAX_CONSECUTIVE_NON_BUILD_ERRORS:
         coordinator_error(f"Aborted: {consecutive_rebuilds_without_progress} consecutive rebuilds without progress.")
 
     else:
         coordinator_error("Reached temporary build iteration limit.")
-    
-    from vibenix.packaging_flow.model_prompts import end_stream_logger
-    ccl_logger.log_session_end(False, iteration, end_stream_logger.total_cost)
+
+    finish_failed_session(iteration)
+    return None
+
+
+def finish_successful_session(candidate: Solution, summary: str, iteration: int, project_url: str, output_dir=None) -> str:
+    """Refine a successful solution, log the end of the session and return the final code."""
+    coordinator_message("Build succeeded! Refining package...")
+    with span("refine") as refine_span:
+        refined_candidate, completed = refine_package(candidate, summary)
+        refine_span.set(result=completed.value)
+
+    if completed == RefinementExit.ERROR:
+        coordinator_error("Refinement encountered an error. Returning pre-refinement solution.")
+    elif completed == RefinementExit.INCOMPLETE:
+        coordinator_message("Refinement process reached max iterations.")
+
+    cleanup_kept_builds()
+    cleanup_incremental_builder()
+    get_log_store().collect_garbage()
+    # Always log success and return, regardless of refinement outcome
+    session = get_session()
+    get_logger().log_model_usage(session.usage.by_prompt)
+    get_logger().log_process_stats(session.process_stats)
+    get_logger().log_session_end(True, iteration, session.total_cost)
+    close_logger()
+    # Use refined version if no error, otherwise use pre-refinement version
+    final_code = refined_candidate.code if completed != RefinementExit.ERROR else candidate.code
+    if output_dir:
+        save_package_output(final_code, project_url, output_dir)
+    return final_code
+
+
+def finish_failed_session(iteration: int):
+    """Clean up and log the end of a session that did not find a working package."""
+    cleanup_kept_builds()
+    cleanup_incremental_builder()
+    get_log_store().collect_garbage()
+    session = get_session()
+    get_logger().log_model_usage(session.usage.by_prompt)
+    get_logger().log_process_stats(session.process_stats)
+    get_logger().log_session_end(False, iteration, session.total_cost)
+    close_logger()
+
+
+def finish_stopped_session(best: Solution, reason: str, iteration: int, project_url: str, output_dir=None):
+    """Save the best solution of a session whose budget ran out, and log that it stopped rather than failed.
+
+    The session can continue from its checkpoint with --resume, the saved package does not build yet.
+    """
+    coordinator_error(f"Stopped early: {reason}. The best solution so far is checkpointed, continue it with --resume.")
+    cleanup_kept_builds()
+    cleanup_incremental_builder()
+    get_log_store().collect_garbage()
+    if output_dir:
+        save_package_output(best.code, project_url, output_dir)
+    session = get_session()
+    get_logger().log_model_usage(session.usage.by_prompt)
+    get_logger().log_process_stats(session.process_stats)
+    get_logger().log_session_end(False, iteration, session.total_cost, stopped=reason)
     close_logger()
     return None
 
@@ -327,24 +528,27 @@ def save_package_output(code: str, project_url: str, output_dir: str):
     coordinator_message(f"Saved package to: {package_file}")
 
 
-def run_packaging_flow(output_dir=None, project_url=None, revision=None, fetcher=None):
+def run_packaging_flow(output_dir=None, project_url=None, revision=None, fetcher=None, resume=False):
     """Run the complete packaging flow."""
     try:
-        result = package_project(output_dir=output_dir, project_url=project_url,
-                                revision=revision, fetcher=fetcher)
+        with profile_session(Path(output_dir or ".")) if get_session().profile else nullcontext():
+            result = package_project(output_dir=output_dir, project_url=project_url,
+                                     revision=revision, fetcher=fetcher, resume=resume)
         if result:
             coordinator_message("Packaging completed successfully!")
             coordinator_message(f"Final package code:\n```nix\n{result}\n```")
             # Print total API cost
-            from vibenix.packaging_flow.model_prompts import end_stream_logger
-            if end_stream_logger.total_cost > 0:
-                coordinator_message(f"\n💰 Total API cost: ${end_stream_logger.total_cost:.6f}")
+            total_cost = get_session().total_cost
+            if total_cost > 0:
+                coordinator_message(f"\n💰 Total API cost: ${total_cost:.6f}")
+        elif get_session().budget_exceeded() is not None:
+            coordinator_message("Packaging stopped when its budget ran out, continue it with --resume.")
         else:
             coordinator_message("Packaging failed. Please check the errors above.")
             # Print total API cost even on failure
-            from vibenix.packaging_flow.model_prompts import end_stream_logger
-            if end_stream_logger.total_cost > 0:
-                coordinator_message(f"\n💰 Total API cost: ${end_stream_logger.total_cost:.6f}")
+            total_cost = get_session().total_cost
+            if total_cost > 0:
+                coordinator_message(f"\n💰 Total API cost: ${total_cost:.6f}")
     except Exception as e:
         coordinator_error(f"Unexpected error: {e}")
         raise
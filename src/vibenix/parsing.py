@@ -1,19 +1,53 @@
 import re
 
-import requests
-from bs4 import BeautifulSoup
 import re
 import json
-from urllib.parse import urlparse
 import subprocess
+import threading
+from functools import wraps
+from urllib.parse import urlparse
 
-from diskcache import Cache
+from vibenix.nix_backend import get_nix_backend
 from vibenix.ui.logging_config import logger
 
-cache = Cache("cachedir")
+# On-disk cache of fetched project data, opened on first use, see `get_cache`
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """The on-disk cache of fetched project data, in ./cachedir."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            from diskcache import Cache
+            _cache = Cache("cachedir")
+        return _cache
+
+
+def memoize(func):
+    """`Cache.memoize` of the on-disk cache, which is opened when `func` is first called."""
+    memoized = None
+
+    def get_memoized():
+        nonlocal memoized
+        if memoized is None:
+            memoized = get_cache().memoize()(func)
+        return memoized
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        return get_memoized()(*args, **kwargs)
+
+    wrapper.__cache_key__ = lambda *args, **kwargs: get_memoized().__cache_key__(*args, **kwargs)
+    return wrapper
+
 
-@cache.memoize()
+@memoize
 def scrape_and_process(url):
+    import requests
+    from bs4 import BeautifulSoup
+
     # Fetch the webpage content
     response = requests.get(url)
     html = response.text
@@ -40,9 +74,11 @@ def scrape_and_process(url):
 
     return cleaned_text
 
-@cache.memoize()
+@memoize
 def fetch_github_release_data(url):
     """Fetch release data from GitHub API for the given repository URL."""
+    import requests
+
     # Parse the GitHub URL to extract owner and repo
     parsed_url = urlparse(url)
     if parsed_url.netloc != 'github.com':
@@ -136,11 +172,20 @@ def fill_src_attributes(template, src_attr):
     version, repo, hash, src_attr = extract_src_attributes(src_attr)
 
     # Get the store path
-    store_path = subprocess.run(["nix-store", "--print-fixed-path", "sha256",
-                                 "--recursive", hash, "source"],
-                                 capture_output=True, text=True)
-    store_path = str(store_path.stdout).strip()
+    try:
+        store_path = get_nix_backend().source_store_path(hash)
+    except subprocess.TimeoutExpired:
+        # The session continues without the tools that read the project source
+        logger.warning(f"Timed out computing the store path of the source with hash {hash}")
+        store_path = None
+
+    filled_template = substitute_src_attributes(template, repo, version, src_attr)
+    logger.info(f"Filled template: \n{filled_template}")
+    
+    return filled_template, store_path
 
+def substitute_src_attributes(template, repo, version, src_attr):
+    """Substitute the pname, version and src attributes of a template."""
     # Indent properly
     lines = src_attr.splitlines()
     src_attr = "\n".join("  " + line for line in lines)[2:]
@@ -151,10 +196,7 @@ def fill_src_attributes(template, src_attr):
 
     # Replace the src attribute in the template with the extracted src
     pattern = r"fetchFromGitHub\s*\{.*?\}"
-    filled_template = re.sub(pattern, src_attr, filled_template, flags=re.DOTALL)
-    logger.info(f"Filled template: \n{filled_template}")
-    
-    return filled_template, store_path
+    return re.sub(pattern, src_attr, filled_template, flags=re.DOTALL)
 
 def fetch_combined_project_data(url):
     """Fetch both HTML and API data for a GitHub project."""
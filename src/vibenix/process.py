@@ -0,0 +1,238 @@
+"""Running external tools.
+
+Every external command (nix, nurl, rg, fzf, jq, ...) goes through `run`, or
+`run_async` from asyncio code. Commands run in their own process group, so a
+timeout or a cancelled session kills the whole process tree instead of
+leaving orphaned processes behind. The run time and exit status of every
+command are recorded in the statistics of the current session.
+"""
+
+import asyncio
+import atexit
+import contextvars
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Mapping, Optional, Sequence, Union
+
+from vibenix.session import Session, get_session
+from vibenix.ui.logging_config import logger
+
+# Time a process gets to exit after SIGTERM before it is killed
+KILL_GRACE_PERIOD = 5
+
+# Timeout of the quick commands behind the model's tool functions
+TOOL_TIMEOUT = 30
+
+# Process groups of all running commands, killed when the interpreter exits
+_running_groups: Dict[int, Session] = {}
+_running_groups_lock = threading.Lock()
+
+
+class ProcessCancelled(BaseException):
+    """Raised when the session of a command was cancelled.
+
+    Like `asyncio.CancelledError`, this is not an `Exception`, so it is not
+    swallowed by the error handling of the model's tool functions.
+    """
+
+
+class ProcessResult(subprocess.CompletedProcess):
+    """A finished command, with its wall clock run time."""
+
+    def __init__(self, args, returncode: int, stdout: str, stderr: str, duration: float):
+        super().__init__(args, returncode, stdout, stderr)
+        self.duration = duration
+
+
+@dataclass
+class ProcessStats:
+    """Aggregated statistics of the commands of one program in a session."""
+    calls: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    cancelled: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+
+    def record(self, duration: float, returncode: Optional[int], timed_out: bool = False, cancelled: bool = False):
+        self.calls += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        if timed_out:
+            self.timeouts += 1
+        elif cancelled:
+            self.cancelled += 1
+        elif returncode != 0:
+            self.failures += 1
+
+
+def kill_process_group(pgid: int, sig: int = signal.SIGTERM):
+    try:
+        os.killpg(pgid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+@atexit.register
+def _kill_running_groups():
+    with _running_groups_lock:
+        groups = list(_running_groups)
+    for pgid in groups:
+        kill_process_group(pgid, signal.SIGKILL)
+
+
+def _register(session: Session, pgid: int):
+    with _running_groups_lock:
+        _running_groups[pgid] = session
+    session.process_groups.add(pgid)
+
+
+def _unregister(session: Session, pgid: int):
+    with _running_groups_lock:
+        _running_groups.pop(pgid, None)
+    session.process_groups.discard(pgid)
+
+
+async def _terminate(process: asyncio.subprocess.Process):
+    """Kill the process group of a command, politely first."""
+    kill_process_group(process.pid, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(process.wait(), KILL_GRACE_PERIOD)
+    except asyncio.TimeoutError:
+        kill_process_group(process.pid, signal.SIGKILL)
+        await process.wait()
+
+
+def _record(session: Session, program: str, duration: float, returncode: Optional[int], **kwargs):
+    with session.lock:
+        session.process_stats.setdefault(program, ProcessStats()).record(duration, returncode, **kwargs)
+
+
+async def _read(stream: asyncio.StreamReader, chunks: List[bytes]):
+    while True:
+        chunk = await stream.read(1 << 16)
+        if not chunk:
+            return
+        chunks.append(chunk)
+
+
+async def _write(stdin: asyncio.StreamWriter, data: bytes):
+    try:
+        stdin.write(data)
+        await stdin.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # The command exited without reading all of its input
+        pass
+    stdin.close()
+
+
+async def _communicate(process: asyncio.subprocess.Process, input: Optional[bytes],
+                       stdout_chunks: List[bytes], stderr_chunks: List[bytes]):
+    """Like `Process.communicate`, but the output read so far stays in the chunk lists when it is cancelled."""
+    tasks = [_read(process.stdout, stdout_chunks)]
+    if process.stderr is not None:
+        tasks.append(_read(process.stderr, stderr_chunks))
+    if input is not None:
+        tasks.append(_write(process.stdin, input))
+    await asyncio.gather(*tasks)
+    await process.wait()
+
+
+async def _read_rest(process: asyncio.subprocess.Process, stdout_chunks: List[bytes], stderr_chunks: List[bytes]):
+    """Read the output that is left in the pipes of a killed command."""
+    for stream, chunks in [(process.stdout, stdout_chunks), (process.stderr, stderr_chunks)]:
+        if stream is None:
+            continue
+        try:
+            chunks.append(await asyncio.wait_for(stream.read(), KILL_GRACE_PERIOD))
+        except asyncio.TimeoutError:
+            # A process outside of the command's process group still holds the pipe open
+            pass
+
+
+async def run_async(args: Sequence[Union[str, Path]], *, input: Optional[str] = None,
+                    cwd: Optional[Union[str, Path]] = None, env: Optional[Mapping[str, str]] = None,
+                    timeout: Optional[float] = None, check: bool = False,
+                    merge_stderr: bool = False) -> ProcessResult:
+    """Run a command in the current session and capture its output as text.
+
+    Raises `subprocess.TimeoutExpired` with the output captured until then when the command
+    does not finish within `timeout` seconds, `subprocess.CalledProcessError` for a failed
+    command if `check` is set, and `ProcessCancelled` when the session is cancelled. The
+    command is killed in all three cases.
+    """
+    session = get_session()
+    args = [str(arg) for arg in args]
+    program = os.path.basename(args[0])
+    if session.cancelled.is_set():
+        raise ProcessCancelled(f"Session cancelled before running {program}")
+
+    start_time = time.monotonic()
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE,
+        cwd=cwd,
+        env=dict(env) if env is not None else None,
+        start_new_session=True,
+    )
+    _register(session, process.pid)
+    if session.cancelled.is_set():
+        # Cancelled while the process was starting
+        kill_process_group(process.pid)
+    stdout_chunks: List[bytes] = []
+    stderr_chunks: List[bytes] = []
+    try:
+        try:
+            await asyncio.wait_for(_communicate(process, input.encode() if input is not None else None,
+                                                stdout_chunks, stderr_chunks), timeout)
+        except asyncio.TimeoutError:
+            await _terminate(process)
+            await _read_rest(process, stdout_chunks, stderr_chunks)
+            duration = time.monotonic() - start_time
+            _record(session, program, duration, None, timed_out=True)
+            if session.trace is not None:
+                session.trace.add_process(args, time.time() - duration, duration, None)
+            logger.warning(f"{program} timed out after {timeout}s")
+            raise subprocess.TimeoutExpired(args, timeout, output=b"".join(stdout_chunks),
+                                            stderr=b"".join(stderr_chunks) if process.stderr is not None else None)
+        except asyncio.CancelledError:
+            await _terminate(process)
+            _record(session, program, time.monotonic() - start_time, None, cancelled=True)
+            raise
+    finally:
+        _unregister(session, process.pid)
+
+    duration = time.monotonic() - start_time
+    if session.trace is not None:
+        session.trace.add_process(args, time.time() - duration, duration, process.returncode)
+    if session.cancelled.is_set():
+        _record(session, program, duration, process.returncode, cancelled=True)
+        raise ProcessCancelled(f"Session cancelled while running {program}")
+    _record(session, program, duration, process.returncode)
+
+    result = ProcessResult(args, process.returncode, b"".join(stdout_chunks).decode(errors="replace"),
+                           b"".join(stderr_chunks).decode(errors="replace") if process.stderr is not None else None,
+                           duration)
+    if check:
+        result.check_returncode()
+    return result
+
+
+def run(args: Sequence[Union[str, Path]], **kwargs) -> ProcessResult:
+    """Run a command from synchronous code, see `run_async`."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(run_async(args, **kwargs))
+    # Blocking inside of an event loop, run the command on a loop of its own
+    context = contextvars.copy_context()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(context.run, asyncio.run, run_async(args, **kwargs)).result()
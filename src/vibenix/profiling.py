@@ -0,0 +1,196 @@
+"""Profiling of the Python side of a packaging session, see `--profile`.
+
+`profile_session` runs a block under a sampling profiler and tracemalloc and
+writes three files to the directory of the session's `run.ccl`:
+
+- `profile.folded`: the sampled stacks in the collapsed format of
+  flamegraph.pl, also read by speedscope, weighted by CPU time in ms,
+- `profile.txt`: the functions with the most self and total CPU time, and the
+  vibenix functions among them,
+- `allocations.txt`: the peak traced memory and the sites with the most memory
+  still allocated at the end of the session.
+
+The sampler reads the stacks of all threads every few milliseconds and weighs
+each stack by the CPU time its thread used since the last sample, read from
+/proc on Linux, so threads waiting for the model or for Nix do not count.
+Elsewhere every sample counts as the sampling interval of wall time.
+tracemalloc slows down allocations, so profiled sessions run slower.
+"""
+
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from types import CodeType, FrameType
+from typing import Dict, Iterator, Optional, Tuple
+
+from vibenix.ui.logging_config import logger
+
+# Seconds between two samples
+SAMPLE_INTERVAL = 0.01
+
+# Functions and allocation sites listed in the reports
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 25
+
+PROFILE_STACKS = "profile.folded"
+PROFILE_REPORT = "profile.txt"
+ALLOCATIONS_REPORT = "allocations.txt"
+
+
+# Directories that modules are imported from
+_PACKAGE_ROOT = re.compile(r"(?:/site-packages|/src|/lib/python[\d.]+)/(.+)$")
+
+
+def _short_path(filename: str) -> str:
+    """The path of a module relative to its package root, if it is in one."""
+    match = _PACKAGE_ROOT.search(filename)
+    return match.group(1) if match else Path(filename).name
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads of the process on a thread of its own."""
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        # CPU seconds by stack, the thread name first and the innermost frame last
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        # Without /proc, samples are weighed by wall clock time
+        self.cpu_times = Path(f"/proc/self/task/{threading.get_native_id()}/schedstat").exists()
+        self._last_cpu_time: Dict[int, float] = {}
+        self._labels: Dict[CodeType, str] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="vibenix-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _thread_cpu_time(self, native_id: Optional[int]) -> Optional[float]:
+        try:
+            with open(f"/proc/self/task/{native_id}/schedstat") as f:
+                return int(f.read().split()[0]) / 1e9
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def _label(self, code: CodeType) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def _stack(self, thread_name: str, frame: Optional[FrameType]) -> Tuple[str, ...]:
+        labels = []
+        while frame is not None:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.append(thread_name)
+        return tuple(reversed(labels))
+
+    def _sample(self):
+        threads = {thread.ident: thread for thread in threading.enumerate()}
+        own_ident = threading.get_ident()
+        self.samples += 1
+        for ident, frame in sys._current_frames().items():
+            thread = threads.get(ident)
+            if ident == own_ident or thread is None:
+                continue
+            if self.cpu_times:
+                cpu_time = self._thread_cpu_time(thread.native_id)
+                if cpu_time is None:
+                    # The thread exited after it was listed
+                    continue
+                weight = cpu_time - self._last_cpu_time.get(ident, cpu_time)
+                self._last_cpu_time[ident] = cpu_time
+            else:
+                weight = self.interval
+            if weight > 0:
+                self.stacks[self._stack(thread.name, frame)] += weight
+
+    def write_stacks(self, stacks_file: Path):
+        """Write the stacks in the collapsed format of flamegraph.pl, in ms."""
+        with open(stacks_file, "w") as f:
+            for stack, seconds in self.stacks.most_common():
+                milliseconds = round(seconds * 1000)
+                if milliseconds > 0:
+                    f.write(";".join(label.replace(";", ",") for label in stack) + f" {milliseconds}\n")
+
+    def write_report(self, report_file: Path):
+        """Write the functions with the most self and total time."""
+        self_time: Counter = Counter()
+        total_time: Counter = Counter()
+        for stack, seconds in self.stacks.items():
+            self_time[stack[-1]] += seconds
+            for label in set(stack[1:]):
+                total_time[label] += seconds
+        total = sum(self.stacks.values())
+        kind = "CPU" if self.cpu_times else "wall clock"
+
+        def table(f, title: str, times: Counter):
+            f.write(f"\n{title}:\n")
+            f.write(f"{'%':>6}  {'seconds':>9}  function\n")
+            for label, seconds in times.most_common(TOP_FUNCTIONS):
+                f.write(f"{seconds / total if total else 0:>6.1%}  {seconds:>9.3f}  {label}\n")
+
+        with open(report_file, "w") as f:
+            f.write(f"{self.samples} samples every {self.interval * 1000:.0f} ms, "
+                    f"{total:.3f} s of {kind} time in total\n")
+            table(f, "Self time", self_time)
+            table(f, "Total time", total_time)
+            own_time = Counter({label: seconds for label, seconds in total_time.items()
+                                if "(vibenix/" in label})
+            table(f, "Total time of vibenix functions", own_time)
+
+
+def write_allocations(allocations_file: Path):
+    """Write the peak traced memory and the sites with the most memory still allocated."""
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    with open(allocations_file, "w") as f:
+        f.write(f"Peak traced memory: {peak / 2**20:.1f} MiB, allocated at the end: {current / 2**20:.1f} MiB\n\n")
+        f.write("Sites with the most memory allocated at the end of the session:\n")
+        f.write(f"{'KiB':>10}  {'blocks':>8}  site\n")
+        for statistic in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            frame = statistic.traceback[0]
+            f.write(f"{statistic.size / 1024:>10.1f}  {statistic.count:>8}  "
+                    f"{_short_path(frame.filename)}:{frame.lineno}\n")
+
+
+@contextmanager
+def profile_session(output_dir: Path) -> Iterator[SamplingProfiler]:
+    """Profile a block and write the reports to `output_dir`, even if the block fails."""
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    profiler = SamplingProfiler()
+    profiler.start()
+    start_time = time.monotonic()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        output_dir.mkdir(parents=True, exist_ok=True)
+        profiler.write_stacks(output_dir / PROFILE_STACKS)
+        profiler.write_report(output_dir / PROFILE_REPORT)
+        write_allocations(output_dir / ALLOCATIONS_REPORT)
+        if started_tracing:
+            tracemalloc.stop()
+        logger.info(f"Profile of {time.monotonic() - start_time:.1f} s written to {output_dir}")
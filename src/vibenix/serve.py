@@ -0,0 +1,404 @@
+"""Local HTTP/JSON service that packages the projects submitted to it.
+
+`vibenix serve` keeps its jobs in an SQLite queue and runs them in the warm
+worker pool of worker_pool.py, like `vibenix batch`. Its API:
+
+- `POST /jobs` with `{"repo_url": ..., "revision": ...}` queues a job and returns it,
+- `GET /jobs` lists the latest jobs, `GET /jobs/<id>` returns one,
+- `GET /jobs/<id>/events` streams the entries of the job's CCL log as JSON
+  lines, until the job is finished,
+- `GET /jobs/<id>/package.nix` returns the package of a finished job.
+
+A job is `queued`, `running`, `succeeded`, `failed` or `stopped` when its
+budget ran out, finished jobs have the result of `batch.run_request`. A job
+whose worker died is queued again, and ends with an `error` after
+`MAX_JOB_ERRORS` deaths. The queue survives restarts: jobs that were running
+when the service stopped are queued again and continue from their checkpoint.
+"""
+
+import argparse
+import json
+import re
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import CancelledError, Executor, Future
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict
+from functools import partial
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Iterator, List, Optional
+
+from vibenix.batch import PackagingRequest, init_worker, run_request
+from vibenix.ccl_reader import iter_entries
+from vibenix.process import ProcessCancelled
+from vibenix.usage import Budget
+from vibenix.ui.logging_config import logger
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+STOPPED = "stopped"
+ERROR = "error"
+FINISHED = {SUCCEEDED, FAILED, STOPPED, ERROR}
+
+# Worker deaths after which a job is not queued again
+MAX_JOB_ERRORS = 3
+
+QUEUE_FILE = "jobs.sqlite"
+JOBS_DIR = "jobs"
+
+# Jobs returned by `GET /jobs`
+MAX_LISTED_JOBS = 100
+
+# Seconds between two reads of a growing CCL log
+FOLLOW_INTERVAL = 0.2
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    repo_url TEXT NOT NULL,
+    revision TEXT,
+    status TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    started REAL,
+    finished REAL,
+    result TEXT,
+    errors INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+class JobQueue:
+    """Packaging jobs persisted in an SQLite database, usable from any thread."""
+
+    def __init__(self, db_file: Path):
+        self._db = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(_SCHEMA)
+
+    @staticmethod
+    def _job(row: Optional[sqlite3.Row]) -> Optional[dict]:
+        if row is None:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def requeue_running(self) -> int:
+        """Queue the jobs again that were running when the service stopped."""
+        with self._lock:
+            return self._db.execute("UPDATE jobs SET status = ?, started = NULL WHERE status = ?",
+                                    (QUEUED, RUNNING)).rowcount
+
+    def submit(self, repo_url: str, revision: Optional[str] = None) -> dict:
+        with self._lock:
+            cursor = self._db.execute("INSERT INTO jobs (repo_url, revision, status, submitted) VALUES (?, ?, ?, ?)",
+                                      (repo_url, revision, QUEUED, time.time()))
+            return self._job(self._db.execute("SELECT * FROM jobs WHERE id = ?", (cursor.lastrowid,)).fetchone())
+
+    def claim(self) -> Optional[dict]:
+        """Mark the oldest queued job as running and return it, None if no job is queued."""
+        with self._lock:
+            row = self._db.execute("SELECT id FROM jobs WHERE status = ? ORDER BY id LIMIT 1", (QUEUED,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute("UPDATE jobs SET status = ?, started = ? WHERE id = ?", (RUNNING, time.time(), row["id"]))
+            return self._job(self._db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+
+    def finish(self, job_id: int, result: dict) -> str:
+        """Record the result of a job and return its new status.
+
+        A job whose worker died is queued again, until it died `MAX_JOB_ERRORS` times.
+        """
+        with self._lock:
+            if result.get("status") == ERROR:
+                errors = self._db.execute("SELECT errors FROM jobs WHERE id = ?", (job_id,)).fetchone()["errors"] + 1
+                status = QUEUED if errors < MAX_JOB_ERRORS else ERROR
+                self._db.execute("UPDATE jobs SET status = ?, started = NULL, finished = ?, result = ?, errors = ? "
+                                 "WHERE id = ?", (status, time.time() if status == ERROR else None,
+                                                  json.dumps(result), errors, job_id))
+                return status
+            status = SUCCEEDED if result.get("success") else STOPPED if result.get("status") == STOPPED else FAILED
+            self._db.execute("UPDATE jobs SET status = ?, finished = ?, result = ? WHERE id = ?",
+                             (status, time.time(), json.dumps(result), job_id))
+            return status
+
+    def get(self, job_id: int) -> Optional[dict]:
+        with self._lock:
+            return self._job(self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def latest(self, limit: int = MAX_LISTED_JOBS) -> List[dict]:
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def follow_lines(path: Path, is_done: Callable[[], bool], interval: float = FOLLOW_INTERVAL) -> Iterator[str]:
+    """Yield the complete lines of a file that is still being written, until `is_done()` and all lines are read."""
+    while not path.exists():
+        if is_done():
+            return
+        time.sleep(interval)
+    done = False
+    with open(path) as f:
+        partial_line = ""
+        while True:
+            line = f.readline()
+            if line:
+                partial_line += line
+                if partial_line.endswith("\n"):
+                    yield partial_line
+                    partial_line = ""
+                continue
+            if done:
+                if partial_line:
+                    yield partial_line
+                return
+            # Lines written before the job finished are read once more
+            done = is_done()
+            if not done:
+                time.sleep(interval)
+
+
+class JobService:
+    """Runs the queued jobs, at most `workers` at a time, on a dispatcher thread.
+
+    A worker that dies breaks a process pool for good, `new_executor` creates the pool that replaces it.
+    """
+
+    def __init__(self, queue: JobQueue, output_dir: Path, executor: Executor, workers: int,
+                 budget: Optional[Budget] = None, run: Callable[..., dict] = run_request,
+                 new_executor: Optional[Callable[[], Executor]] = None):
+        self.queue = queue
+        self.output_dir = output_dir
+        self.executor = executor
+        self.budget = budget
+        self._new_executor = new_executor
+        self._run = run
+        self._slots = threading.Semaphore(workers)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._dispatch, name="dispatcher", daemon=True)
+
+    def job_dir(self, job_id: int) -> Path:
+        return self.output_dir / str(job_id)
+
+    def start(self):
+        requeued = self.queue.requeue_running()
+        if requeued:
+            logger.info(f"Queued {requeued} interrupted jobs again")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+
+    def submit(self, repo_url: str, revision: Optional[str] = None) -> dict:
+        job = self.queue.submit(repo_url, revision)
+        logger.info(f"Queued job {job['id']} for {repo_url}")
+        self._wake.set()
+        return job
+
+    def _dispatch(self):
+        while not self._stop.is_set():
+            if not self._slots.acquire(timeout=1.0):
+                continue
+            # Cleared before claiming, so a job submitted in between wakes up the dispatcher
+            self._wake.clear()
+            job = self.queue.claim()
+            if job is None:
+                self._slots.release()
+                self._wake.wait(timeout=1.0)
+                continue
+            request = PackagingRequest(issue_number=str(job["id"]), repo_url=job["repo_url"], revision=job["revision"])
+            logger.info(f"Starting job {job['id']} for {job['repo_url']}")
+            try:
+                future = self.executor.submit(self._run, request, self.output_dir, self.budget)
+            except BrokenProcessPool:
+                if self._new_executor is None:
+                    raise
+                logger.warning("Starting a new worker pool, a worker of the old one died")
+                self.executor.shutdown(wait=False)
+                self.executor = self._new_executor()
+                future = self.executor.submit(self._run, request, self.output_dir, self.budget)
+            future.add_done_callback(partial(self._finished, request))
+
+    def _finished(self, request: PackagingRequest, future: Future):
+        try:
+            try:
+                result = future.result()
+            except (ProcessCancelled, KeyboardInterrupt, CancelledError):
+                # Cancelled because the service is stopping, like a session in `vibenix batch` this is not a
+                # result: the job stays running and continues from its checkpoint on the next start
+                logger.info(f"Job {request.issue_number} was interrupted, it continues on the next start")
+                return
+            except BaseException as e:
+                if self._stop.is_set():
+                    # The workers were stopped with the service
+                    logger.info(f"Job {request.issue_number} was interrupted, it continues on the next start")
+                    return
+                # The worker process died, e.g. it was OOM-killed
+                result = {"issue_number": request.issue_number, "repo_url": request.repo_url,
+                          "success": False, "status": ERROR, "error": f"{type(e).__name__}: {e}"}
+            status = self.queue.finish(int(request.issue_number), result)
+            logger.info(f"{'✅' if result['success'] else '❌'} job {request.issue_number} {request.repo_url} "
+                        f"is {status}")
+        finally:
+            # A job that could not be finished must not take its worker slot with it
+            self._slots.release()
+            self._wake.set()
+
+
+_ROUTE = re.compile(r"^/jobs(?:/(\d+)(/events|/package\.nix)?)?/?$")
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """The HTTP API of a `JobService`, which is the `service` of the server."""
+
+    server_version = "vibenix"
+
+    @property
+    def service(self) -> JobService:
+        return self.server.service
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def _send(self, status: HTTPStatus, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: HTTPStatus, data):
+        self._send(status, json.dumps(data).encode() + b"\n", "application/json")
+
+    def _send_error(self, status: HTTPStatus, message: str):
+        self._send_json(status, {"error": message})
+
+    def do_GET(self):
+        route = _ROUTE.match(self.path.split("?", 1)[0])
+        if route is None:
+            return self._send_error(HTTPStatus.NOT_FOUND, f"no such resource: {self.path}")
+        job_id, resource = route.groups()
+        if job_id is None:
+            return self._send_json(HTTPStatus.OK, self.service.queue.latest())
+        job = self.service.queue.get(int(job_id))
+        if job is None:
+            return self._send_error(HTTPStatus.NOT_FOUND, f"no job {job_id}")
+        if resource is None:
+            return self._send_json(HTTPStatus.OK, job)
+        if resource == "/events":
+            return self._stream_events(job)
+        package_files = sorted(self.service.job_dir(job["id"]).glob("*/package.nix"))
+        if job["status"] != SUCCEEDED or not package_files:
+            return self._send_error(HTTPStatus.NOT_FOUND, f"job {job_id} has no package, it is {job['status']}")
+        self._send(HTTPStatus.OK, package_files[0].read_bytes(), "text/plain; charset=utf-8")
+
+    def _stream_events(self, job: dict):
+        """Send the entries of the CCL log of a job as JSON lines, while it is written."""
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/x-ndjson")
+        # The end of the stream is the end of the connection
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        lines = follow_lines(self.service.job_dir(job["id"]) / "run.ccl",
+                             lambda: self.service.queue.get(job["id"])["status"] in FINISHED)
+        try:
+            for entry in iter_entries(lines):
+                self.wfile.write(json.dumps(asdict(entry)).encode() + b"\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug(f"Client stopped following the events of job {job['id']}")
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send_error(HTTPStatus.NOT_FOUND, f"no such resource: {self.path}")
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except (ValueError, json.JSONDecodeError) as e:
+            return self._send_error(HTTPStatus.BAD_REQUEST, f"invalid JSON: {e}")
+        repo_url = body.get("repo_url") if isinstance(body, dict) else None
+        revision = body.get("revision") if isinstance(body, dict) else None
+        if not isinstance(repo_url, str) or not repo_url:
+            return self._send_error(HTTPStatus.BAD_REQUEST, "repo_url is required")
+        if revision is not None and not isinstance(revision, str):
+            return self._send_error(HTTPStatus.BAD_REQUEST, "revision must be a string")
+        self._send_json(HTTPStatus.CREATED, self.service.submit(repo_url, revision))
+
+
+class ServiceHTTPServer(ThreadingHTTPServer):
+    """HTTP server of a `JobService`, every request is handled on a thread of its own."""
+
+    daemon_threads = True
+
+    def __init__(self, address, service: JobService):
+        super().__init__(address, ServiceHandler)
+        self.service = service
+
+
+def main(argv: Optional[List[str]] = None):
+    """Entry point of `vibenix serve`."""
+    parser = argparse.ArgumentParser(
+        prog="vibenix serve",
+        description="Package the projects submitted to a local HTTP/JSON API",
+    )
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on (default: 8000)")
+    parser.add_argument("--data-dir", type=Path, default=Path("vibenix-service"), help="Directory for the job queue and one subdirectory per job")
+    parser.add_argument("--workers", type=int, default=2, help="Number of concurrent sessions (default: 2)")
+    parser.add_argument("--build-cores", type=int, default=None, help="Core budget shared by the builds of all sessions (default: all cores)")
+    parser.add_argument("--build-memory", type=int, default=None, help="Memory budget in MB shared by the builds of all sessions (default: all memory)")
+    parser.add_argument("--max-cost", type=float, default=None, metavar="USD", help="Stop each session once its model calls cost USD dollars")
+    parser.add_argument("--max-tokens", type=int, default=None, metavar="N", help="Stop each session once its model calls used N tokens")
+    parser.add_argument("--max-time", type=float, default=None, metavar="MINUTES", help="Stop each session after MINUTES of wall clock time")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    from vibenix.ui.logging_config import enable_console_logging
+    from vibenix.ui.model_config import load_saved_configuration
+    enable_console_logging()
+    if not load_saved_configuration():
+        logger.error("No saved model configuration found. Please run vibenix interactively first to configure.")
+        sys.exit(1)
+
+    args.data_dir.mkdir(parents=True, exist_ok=True)
+    queue = JobQueue(args.data_dir / QUEUE_FILE)
+
+    from vibenix.build_scheduler import start_shared_build_scheduler
+    from vibenix.worker_pool import create_worker_pool
+    manager, scheduler = start_shared_build_scheduler(cores=args.build_cores, memory_mb=args.build_memory,
+                                                     expected_builds=args.workers)
+    new_executor = partial(create_worker_pool, args.workers, initializer=init_worker, initargs=(scheduler,))
+    service = JobService(queue, args.data_dir / JOBS_DIR, new_executor(), args.workers,
+                         budget=Budget(max_cost=args.max_cost, max_tokens=args.max_tokens,
+                                       max_time=args.max_time * 60 if args.max_time else None),
+                         new_executor=new_executor)
+    server = ServiceHTTPServer((args.host, args.port), service)
+    service.start()
+    logger.info(f"Serving on http://{args.host}:{server.server_address[1]} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping, running jobs are queued again on the next start")
+    finally:
+        server.server_close()
+        service.stop()
+        service.executor.shutdown(wait=False, cancel_futures=True)
+        manager.shutdown()
@@ -0,0 +1,245 @@
+"""State of a packaging session.
+
+Everything that belongs to one packaging session lives on a `Session`: its
+flake, its error stack, its CCL logger, its UI adapter and its API cost.
+Several sessions can run in one process, e.g. to share warm indexes and
+HTTP connection pools, each on its own thread or asyncio task.
+
+The current session is tracked in a context variable, see `use_session`.
+Code that runs outside of any `use_session` block, like the single-session
+entry points, uses the process default session.
+"""
+
+import contextvars
+import os
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import deque
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Deque, Dict, Iterator, Optional, Set, TypeVar, TYPE_CHECKING
+
+from vibenix.usage import Budget, ModelCall, UsageLedger
+
+if TYPE_CHECKING:
+    from vibenix.cassette import Cassette
+    from vibenix.ccl_log import CCLLogger
+    from vibenix.errors import NixBuildResult
+    from vibenix.incremental import IncrementalBuilder
+    from vibenix.nix_backend import NixBackend
+    from vibenix.process import ProcessStats
+    from vibenix.trace import TraceRecorder
+    from vibenix.ui.conversation import UIAdapter
+
+T = TypeVar('T')
+
+TEMPLATE_DIR = Path(os.path.dirname(os.path.abspath(__file__)), 'template')
+
+# Build results only hold references into the log store,
+# but we still do not want the stack to grow without bound
+MAX_ERROR_STACK_SIZE = 64
+
+# Key of the session id in the metadata of model requests, see `Session.chat_model`
+SESSION_ID_METADATA_KEY = "vibenix_session_id"
+
+# Key of the name of the prompt in the metadata of model requests, see `use_prompt`
+PROMPT_METADATA_KEY = "vibenix_prompt"
+
+# Key of whether a request was routed to another model than the configured one
+ROUTED_METADATA_KEY = "vibenix_routed"
+
+
+@dataclass(eq=False)
+class Session:
+    """State of one packaging session."""
+    # time out build after 7 minutes
+    build_timeout: str = str(7*60)
+    # resume builds from the first changed phase during the agentic loop
+    incremental_builds: bool = False
+    # persistent ccache/sccache directory, see compiler_cache.py
+    compiler_cache_dir: Optional[Path] = None
+    # number of alternative fixes to build in parallel per iteration
+    fix_candidates: int = 1
+    # number of solutions kept by the beam search, 1 runs the sequential loop
+    beam_width: int = 1
+    # build all fix candidates of an iteration with a single nix build
+    batch_builds: bool = False
+    # profile the packaging flow with a sampling profiler and tracemalloc, see profiling.py
+    profile: bool = False
+
+    session_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    template_dir: Path = TEMPLATE_DIR
+    flake_dir: Path = field(init=False)
+    error_stack: Deque['NixBuildResult'] = field(default_factory=lambda: deque(maxlen=MAX_ERROR_STACK_SIZE), init=False)
+    incremental_builder: Optional['IncrementalBuilder'] = field(default=None, init=False)
+    ccl_logger: Optional['CCLLogger'] = field(default=None, init=False)
+    ui_adapter: Optional['UIAdapter'] = None
+    total_cost: float = field(default=0.0, init=False)
+    prompt_tokens: int = field(default=0, init=False)
+    completion_tokens: int = field(default=0, init=False)
+    # model calls per prompt, see usage.py
+    usage: UsageLedger = field(default_factory=UsageLedger, init=False, repr=False)
+    # ends the session early once exhausted
+    budget: Optional[Budget] = None
+    start_time: float = field(default_factory=time.monotonic, init=False)
+    # runs or simulates the Nix operations, see nix_backend.py
+    nix_backend: Optional['NixBackend'] = None
+    # records or replays the model exchanges, see cassette.py
+    cassette: Optional['Cassette'] = None
+    # collects the timeline of the session for --trace, see trace.py
+    trace: Optional['TraceRecorder'] = None
+    # external commands, see process.py
+    cancelled: threading.Event = field(default_factory=threading.Event, init=False, repr=False)
+    process_groups: Set[int] = field(default_factory=set, init=False, repr=False)
+    process_stats: Dict[str, 'ProcessStats'] = field(default_factory=dict, init=False, repr=False)
+    # guards the state that is updated from several threads
+    lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+    _flake_dir_obj: tempfile.TemporaryDirectory = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._flake_dir_obj = tempfile.TemporaryDirectory(prefix="vibenix-session-")
+        self.flake_dir = Path(self._flake_dir_obj.name)
+        _sessions[self.session_id] = self
+
+    def add_cost(self, cost: float):
+        """Add the cost of a model request, requests of one session may finish on several threads."""
+        with self.lock:
+            self.total_cost += cost
+
+    def add_usage(self, prompt_tokens: int, completion_tokens: int):
+        """Add the token usage of a model request."""
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def record_model_call(self, call: ModelCall):
+        """Add a model call to the cost, the token usage, the ledger and the CCL log of the session."""
+        self.add_cost(call.cost)
+        self.add_usage(call.prompt_tokens, call.completion_tokens)
+        self.usage.record(call)
+        if self.ccl_logger is not None:
+            self.ccl_logger.log_model_call(call)
+
+    def budget_exceeded(self) -> Optional[str]:
+        """Why the budget of the session is exhausted, or None if it is not."""
+        if self.budget is None:
+            return None
+        return self.budget.exceeded(self.total_cost, self.prompt_tokens + self.completion_tokens,
+                                    time.monotonic() - self.start_time)
+
+    def cancel(self):
+        """Cancel the session, killing its running external commands and refusing new ones."""
+        from vibenix.process import kill_process_group
+        self.cancelled.set()
+        for pgid in list(self.process_groups):
+            kill_process_group(pgid)
+
+    def chat_model(self, prompt: Optional[str] = None):
+        """The configured chat model, tagging its requests with this session and the name of the prompt.
+
+        litellm runs its callbacks on its own threads, where the current session
+        is unknown, so requests carry the session id in their metadata instead.
+        Prompts routed to another model in the configuration, see
+        `model_for_prompt`, use that model.
+        Returns None for backends that do not support request metadata.
+        """
+        from magentic.settings import Backend, get_settings
+        from vibenix.ui.model_config import model_for_prompt
+        settings = get_settings()
+        if settings.backend != Backend.LITELLM:
+            return None
+        from magentic.chat_model.litellm_chat_model import LitellmChatModel
+        routed_model = model_for_prompt(prompt)
+        return LitellmChatModel(
+            model=routed_model or settings.litellm_model,
+            # The API base belongs to the provider of the configured model
+            api_base=None if routed_model else settings.litellm_api_base,
+            max_tokens=settings.litellm_max_tokens,
+            temperature=settings.litellm_temperature,
+            metadata={SESSION_ID_METADATA_KEY: self.session_id, PROMPT_METADATA_KEY: prompt,
+                      ROUTED_METADATA_KEY: routed_model is not None},
+        )
+
+    def close(self):
+        """Remove the flake of the session."""
+        _sessions.pop(self.session_id, None)
+        self._flake_dir_obj.cleanup()
+
+
+# Sessions by id, for attributing model requests
+_sessions: 'weakref.WeakValueDictionary[str, Session]' = weakref.WeakValueDictionary()
+
+_current_session: contextvars.ContextVar[Optional[Session]] = contextvars.ContextVar("vibenix_session", default=None)
+
+# Session used outside of `use_session` blocks
+_default_session: Optional[Session] = None
+_default_session_lock = threading.Lock()
+
+
+def init_session(session: Optional[Session] = None) -> Session:
+    """Initialize the process default session."""
+    global _default_session
+    _default_session = session if session is not None else Session()
+    return _default_session
+
+
+def get_session() -> Session:
+    """Get the current session, falling back to the process default session."""
+    global _default_session
+    session = _current_session.get()
+    if session is not None:
+        return session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = Session()
+        return _default_session
+
+
+def find_session(session_id: Optional[str]) -> Optional[Session]:
+    """Find a live session by its id."""
+    if session_id is None:
+        return None
+    return _sessions.get(session_id)
+
+
+@contextmanager
+def use_session(session: Session) -> Iterator[Session]:
+    """Make `session` the current session of this thread or asyncio task, and route its model requests."""
+    token = _current_session.set(session)
+    try:
+        chat_model = session.chat_model()
+        if chat_model is None:
+            yield session
+        else:
+            with chat_model:
+                yield session
+    finally:
+        _current_session.reset(token)
+
+
+@contextmanager
+def use_prompt(name: str) -> Iterator[None]:
+    """Tag the model requests made in this block, or by the decorated function, with the name of their prompt."""
+    chat_model = get_session().chat_model(prompt=name)
+    if chat_model is None:
+        yield
+    else:
+        with chat_model:
+            yield
+
+
+def run_in_session(session: Session, func: Callable[..., T], *args, **kwargs) -> T:
+    """Call `func` in `session`, meant as the target of threads that run a session."""
+    with use_session(session):
+        return func(*args, **kwargs)
+
+
+def submit_in_session(executor: Executor, func: Callable[..., T], *args, **kwargs) -> 'Future[T]':
+    """Submit `func` to `executor` to run in the current session, executor threads do not inherit it."""
+    context = contextvars.copy_context()
+    return executor.submit(context.run, func, *args, **kwargs)
@@ -0,0 +1,199 @@
+"""Aggregate the CCL logs of many packaging sessions into tables.
+
+    vibenix stats batch-output/                          # every run.ccl below a directory
+    vibenix stats --csv stats/ --parquet stats/ */run.ccl
+
+Every log is streamed once through `summarize_session`, so memory does not
+grow with the size of the logs. Sessions are grouped per project and per
+template, with the success rate, percentiles of the wall time, iterations and
+stage times, the model cost and the frequency of every tool call. Writing
+Parquet tables needs pyarrow, from the `stats` extra.
+"""
+
+import argparse
+import csv
+import math
+import sys
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from vibenix.ccl_reader import STAGES, SessionSummary, summarize_session
+from vibenix.ui.logging_config import logger
+
+PERCENTILES = [50, 90, 99]
+
+# Metrics with percentiles in the tables, in column order
+TIMED_METRICS = ["wall_time", "iterations"] + STAGES
+
+
+def percentile(sorted_values: Sequence[float], q: float) -> Optional[float]:
+    """The q-th percentile of sorted values, interpolated linearly between the closest ranks."""
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * q / 100
+    lower, upper = math.floor(rank), math.ceil(rank)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+@dataclass
+class GroupStats:
+    """Running totals of the sessions of one project or template."""
+    runs: int = 0
+    finished: int = 0
+    successes: int = 0
+    cost: float = 0.0
+    # One value per session and metric, the logs themselves are not kept
+    values: Dict[str, List[float]] = field(default_factory=dict)
+    tool_calls: Counter = field(default_factory=Counter)
+
+    def add(self, summary: SessionSummary):
+        self.runs += 1
+        if summary.success is not None:
+            self.finished += 1
+            self.successes += summary.success
+        self.cost += summary.cost or 0.0
+        metrics = {"wall_time": summary.wall_time, "iterations": summary.iterations, **summary.stage_times}
+        for metric, value in metrics.items():
+            if value is not None:
+                self.values.setdefault(metric, []).append(float(value))
+        self.tool_calls.update(summary.tool_calls)
+
+    def row(self) -> dict:
+        row = {
+            "runs": self.runs,
+            "finished": self.finished,
+            "success_rate": self.successes / self.finished if self.finished else None,
+            "cost": self.cost,
+            "cost_per_run": self.cost / self.runs,
+            "tool_calls_per_run": sum(self.tool_calls.values()) / self.runs,
+        }
+        for metric in TIMED_METRICS:
+            values = sorted(self.values.get(metric, []))
+            for q in PERCENTILES:
+                row[f"{metric}_p{q}"] = percentile(values, q)
+        return row
+
+
+class StatsAggregator:
+    """Groups session summaries per project and per template."""
+
+    def __init__(self):
+        self.projects: Dict[str, GroupStats] = {}
+        self.templates: Dict[str, GroupStats] = {}
+        self.total = GroupStats()
+
+    def add(self, summary: SessionSummary):
+        self.total.add(summary)
+        self.projects.setdefault(summary.project_url or "unknown", GroupStats()).add(summary)
+        self.templates.setdefault(summary.template or "unknown", GroupStats()).add(summary)
+
+    def table(self, by: str) -> List[dict]:
+        """One row per project or template, the most frequent first."""
+        groups = self.projects if by == "project" else self.templates
+        return [{by: name, **stats.row()}
+                for name, stats in sorted(groups.items(), key=lambda item: (-item[1].runs, item[0]))]
+
+    def tool_call_table(self) -> List[dict]:
+        """How often each template calls each tool, the most frequent first."""
+        rows = []
+        for template, stats in sorted(self.templates.items()):
+            for function, calls in stats.tool_calls.most_common():
+                rows.append({"template": template, "function": function, "calls": calls,
+                             "calls_per_run": calls / stats.runs})
+        return rows
+
+
+def find_logs(paths: Sequence[Path]) -> Iterator[Path]:
+    """CCL log files, directories are searched for `*.ccl` files recursively."""
+    for path in paths:
+        if path.is_dir():
+            yield from sorted(path.rglob("*.ccl"))
+        else:
+            yield path
+
+
+def aggregate(log_files: Iterator[Path]) -> StatsAggregator:
+    aggregator = StatsAggregator()
+    for log_file in log_files:
+        try:
+            aggregator.add(summarize_session(log_file))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping {log_file}: {e}")
+    return aggregator
+
+
+def write_csv(rows: List[dict], table_file: Path):
+    with open(table_file, "w", newline="") as f:
+        if rows:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def write_parquet(rows: List[dict], table_file: Path):
+    import pyarrow
+    import pyarrow.parquet
+    pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), table_file)
+
+
+def _format(value) -> str:
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.2f}"
+    return str(value)
+
+
+def print_table(rows: List[dict], columns: List[str]):
+    if not rows:
+        return
+    widths = [max(len(column), *(len(_format(row[column])) for row in rows)) for column in columns]
+    print("  ".join(column.ljust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(_format(row[column]).ljust(width) for column, width in zip(columns, widths)))
+
+
+def main(argv: Optional[List[str]] = None):
+    """Entry point of `vibenix stats`."""
+    parser = argparse.ArgumentParser(
+        prog="vibenix stats",
+        description="Aggregate the CCL logs of many packaging sessions per project and per template",
+    )
+    parser.add_argument("paths", nargs="+", type=Path, help="CCL log files, or directories to search for *.ccl files")
+    parser.add_argument("--by", choices=["template", "project"], default="template", help="Table to print (default: template)")
+    parser.add_argument("--csv", type=Path, default=None, metavar="DIR", help="Write the project, template and tool call tables as CSV files to DIR")
+    parser.add_argument("--parquet", type=Path, default=None, metavar="DIR", help="Write the tables as Parquet files to DIR (requires pyarrow)")
+    args = parser.parse_args(argv)
+
+    if args.parquet:
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            parser.error("--parquet requires pyarrow, install vibenix with the 'stats' extra")
+
+    aggregator = aggregate(find_logs(args.paths))
+    if not aggregator.total.runs:
+        logger.error("No CCL logs found")
+        sys.exit(1)
+
+    tables = {
+        "projects": aggregator.table("project"),
+        "templates": aggregator.table("template"),
+        "tool_calls": aggregator.tool_call_table(),
+    }
+    for output_dir, suffix, write in [(args.csv, "csv", write_csv), (args.parquet, "parquet", write_parquet)]:
+        if output_dir:
+            output_dir.mkdir(parents=True, exist_ok=True)
+            for name, rows in tables.items():
+                write(rows, output_dir / f"{name}.{suffix}")
+
+    columns = ["runs", "success_rate", "wall_time_p50", "wall_time_p90", "iterations_p50", "cost_per_run"]
+    print_table(tables[f"{args.by}s"], [args.by] + columns)
+    print()
+    print_table(tables["tool_calls"], ["template", "function", "calls", "calls_per_run"])
+    total = aggregator.total.row()
+    print()
+    print(f"{total['runs']} sessions, {total['finished']} finished, "
+          f"success rate {_format(total['success_rate'])}, total cost ${total['cost']:.6f}")
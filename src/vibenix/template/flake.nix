@@ -8,8 +8,17 @@
   outputs = { self, nixpkgs }:
   let
     pkgs = import nixpkgs { system = "x86_64-linux"; };
-    ciStdenv = pkgs.stdenv // {
-      mkDerivation = args: pkgs.stdenv.mkDerivation (args // {
+    lib = pkgs.lib;
+
+    # Written by vibenix when a persistent compiler cache is enabled,
+    # the directory has to be exposed to the sandbox with extra-sandbox-paths
+    compilerCache =
+      if builtins.pathExists ./compiler-cache.nix
+      then import ./compiler-cache.nix
+      else null;
+
+    mkCiStdenv = stdenv: stdenv // {
+      mkDerivation = args: stdenv.mkDerivation (args // {
         preBuild = ''
           ${args.preBuild or ""}
           # CI/Non-interactive environment
@@ -29,12 +38,57 @@
         '';
       });
     };
+    ciStdenv = mkCiStdenv pkgs.stdenv;
+
+    # C/C++ compilation through ccache
+    cachedStdenv = mkCiStdenv (pkgs.ccacheStdenv.override {
+      extraConfig = ''
+        export CCACHE_DIR="${compilerCache.dir}/ccache"
+        export CCACHE_UMASK=000
+        export CCACHE_COMPRESS=1
+        export CCACHE_SLOPPINESS=random_seed,time_macros
+        export CCACHE_BASEDIR="$NIX_BUILD_TOP"
+        export CCACHE_NOHASHDIR=1
+        export CCACHE_STATSLOG="${compilerCache.dir}/stats/$(basename "$out").ccache"
+      '';
+    });
+
+    # Rust compilation through sccache
+    withSccache = args: args // {
+      nativeBuildInputs = (args.nativeBuildInputs or [ ]) ++ [ pkgs.sccache ];
+      preBuild = ''
+        export RUSTC_WRAPPER=${pkgs.sccache}/bin/sccache
+        export SCCACHE_DIR="${compilerCache.dir}/sccache"
+        export SCCACHE_BASEDIRS="$NIX_BUILD_TOP"
+        ${args.preBuild or ""}
+      '';
+      postBuild = ''
+        ${args.postBuild or ""}
+        sccache --show-stats || true
+        sccache --show-stats --stats-format=json > "${compilerCache.dir}/stats/$(basename "$out").sccache.json" || true
+      '';
+    };
+    cachedRustPlatform = pkgs.rustPlatform // {
+      buildRustPackage = args: pkgs.rustPlatform.buildRustPackage (
+        if builtins.isFunction args
+        then finalAttrs: withSccache (args finalAttrs)
+        else withSccache args
+      );
+    };
+
+    packageArgs = builtins.functionArgs (import ./package.nix);
+
+    mkPackage = cached: pkgs.callPackage ./package.nix ({
+      stdenv = if cached then cachedStdenv else ciStdenv;
+    } // lib.optionalAttrs (cached && packageArgs ? rustPlatform) {
+      rustPlatform = cachedRustPlatform;
+    });
   in
    {
 
-    packages.x86_64-linux.default = pkgs.callPackage ./package.nix {
-      stdenv = ciStdenv;
-    };
+    packages.x86_64-linux.default = mkPackage (compilerCache != null);
+    # Always built without the compiler cache, to verify the final package
+    packages.x86_64-linux.uncached = mkPackage false;
     packages.x86_64-linux.nixpkgs-src = nixpkgs.outPath;
 
   };
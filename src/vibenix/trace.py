@@ -0,0 +1,142 @@
+"""Export the timeline of a packaging session in the Chrome Trace Event Format.
+
+The JSON written by `TraceRecorder.write` opens in Perfetto (ui.perfetto.dev)
+and chrome://tracing. It has one group of tracks each for:
+
+- threads: the spans of every thread of the session, like the stages on the
+  coordinator thread and the builds of fix candidates on worker threads,
+- model calls: every model request, split into the wait for the first token
+  and the streaming of the rest of the response,
+- tool calls: the functions called by the model,
+- subprocesses: every external command, see process.py.
+
+Overlapping model calls, tool calls and subprocesses are spread over as many
+tracks as needed, so gaps in concurrency and serial bottlenecks show up as
+empty tracks.
+"""
+
+import json
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+# Track groups, with their process ids in the trace
+THREADS = 1
+MODEL_CALLS = 2
+TOOL_CALLS = 3
+SUBPROCESSES = 4
+
+_GROUP_NAMES = {
+    THREADS: "threads",
+    MODEL_CALLS: "model calls",
+    TOOL_CALLS: "tool calls",
+    SUBPROCESSES: "subprocesses",
+}
+
+# Spans that are shown in a track group of their own instead of on their thread,
+# the `model` span of a prompt with its retries stays on its thread
+MODEL_SPANS = {"model-request"}
+TOOL_SPANS = {"tool"}
+
+# Longest command line shown for a subprocess
+MAX_COMMAND_LENGTH = 500
+
+
+@dataclass
+class TraceEvent:
+    """A timed slice on a track, times in seconds since the epoch."""
+    group: int
+    name: str
+    start: float
+    duration: float
+    args: Dict[str, Any]
+    # Thread of thread slices, other groups are laid out in lanes when written
+    thread: Optional[int] = None
+
+
+class TraceRecorder:
+    """Collects the slices of a session, which can be recorded from any thread."""
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.events: List[TraceEvent] = []
+        self.thread_names: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def _add(self, event: TraceEvent):
+        with self._lock:
+            self.events.append(event)
+
+    def add_span(self, span, duration: float):
+        """Add a finished span of ccl_log.py on its track."""
+        args = {key: value for key, value in span.attributes.items() if value is not None}
+        if span.name in MODEL_SPANS:
+            self._add(TraceEvent(MODEL_CALLS, args.get("prompt", span.name), span.start, duration, args))
+        elif span.name in TOOL_SPANS:
+            self._add(TraceEvent(TOOL_CALLS, args.get("function", span.name), span.start, duration, args))
+        else:
+            thread = threading.current_thread()
+            with self._lock:
+                self.thread_names.setdefault(thread.ident, thread.name)
+            self._add(TraceEvent(THREADS, span.name, span.start, duration, args, thread=thread.ident))
+
+    def add_process(self, args: Sequence[str], start: float, duration: float, returncode: Optional[int]):
+        """Add a finished external command."""
+        command = " ".join(args)
+        if len(command) > MAX_COMMAND_LENGTH:
+            command = command[:MAX_COMMAND_LENGTH] + "..."
+        self._add(TraceEvent(SUBPROCESSES, Path(args[0]).name, start, duration,
+                             {"command": command, "exit_code": returncode}))
+
+    def _slice(self, event: TraceEvent, name: str, start: float, duration: float, tid: int, args: dict) -> dict:
+        return {
+            "name": name,
+            "cat": _GROUP_NAMES[event.group],
+            "ph": "X",
+            "ts": round((start - self.start_time) * 1e6),
+            "dur": round(duration * 1e6),
+            "pid": event.group,
+            "tid": tid,
+            "args": args,
+        }
+
+    def trace_events(self) -> List[dict]:
+        """The slices and track names in the Chrome Trace Event Format."""
+        with self._lock:
+            events = sorted(self.events, key=lambda event: (event.start, -event.duration))
+            thread_names = dict(self.thread_names)
+        trace_events = [{"name": "process_name", "ph": "M", "pid": group, "tid": 0, "args": {"name": name}}
+                        for group, name in _GROUP_NAMES.items()]
+        thread_ids = {ident: tid for tid, ident in enumerate(thread_names, 1)}
+        for ident, tid in thread_ids.items():
+            trace_events.append({"name": "thread_name", "ph": "M", "pid": THREADS, "tid": tid,
+                                 "args": {"name": thread_names[ident]}})
+
+        # End times of the lanes of each group, a slice goes to the first lane that is free
+        lanes: Dict[int, List[float]] = {}
+        for event in events:
+            if event.thread is not None:
+                tid = thread_ids[event.thread]
+            else:
+                ends = lanes.setdefault(event.group, [])
+                tid = next((lane for lane, end in enumerate(ends, 1) if end <= event.start), len(ends) + 1)
+                if tid > len(ends):
+                    ends.append(0.0)
+                    trace_events.append({"name": "thread_name", "ph": "M", "pid": event.group, "tid": tid,
+                                         "args": {"name": f"{_GROUP_NAMES[event.group]} {tid}"}})
+                ends[tid - 1] = event.start + event.duration
+            trace_events.append(self._slice(event, event.name, event.start, event.duration, tid, event.args))
+            time_to_first_token = event.args.get("time_to_first_token")
+            if event.group == MODEL_CALLS and time_to_first_token is not None:
+                first_token = min(float(time_to_first_token), event.duration)
+                trace_events.append(self._slice(event, "waiting for first token", event.start, first_token, tid, {}))
+                trace_events.append(self._slice(event, "streaming", event.start + first_token,
+                                                event.duration - first_token, tid, {}))
+        return trace_events
+
+    def write(self, trace_file: Path):
+        """Write the trace as JSON."""
+        with open(trace_file, "w") as f:
+            json.dump({"traceEvents": self.trace_events(), "displayTimeUnit": "ms"}, f)
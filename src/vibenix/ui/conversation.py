@@ -1,13 +1,18 @@
 """Coordinator pattern for vibenix - separates business logic from UI."""
 
+import time
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from typing import Callable, Optional, TypeVar
-from functools import wraps
+from functools import partial, wraps
 from enum import Enum
 from dataclasses import dataclass
 from datetime import datetime
 from magentic import StreamedStr, Chat, FunctionCall, ToolResultMessage
 
+from vibenix.ccl_log import span
+from vibenix.session import get_session, use_prompt
+
 # Type variable for function return types
 T = TypeVar('T')
 
@@ -118,22 +123,17 @@ class TerminalUIAdapter(UIAdapter):
         logger.info(f"⏳ {message}")
 
 
-# Global UI adapter instance
-_ui_adapter: Optional[UIAdapter] = None
-
-
 def set_ui_adapter(adapter: UIAdapter):
-    """Set the global UI adapter."""
-    global _ui_adapter
-    _ui_adapter = adapter
+    """Set the UI adapter of the current session."""
+    get_session().ui_adapter = adapter
 
 
 def get_ui_adapter() -> UIAdapter:
-    """Get the current UI adapter, defaulting to terminal."""
-    global _ui_adapter
-    if _ui_adapter is None:
-        _ui_adapter = TerminalUIAdapter()
-    return _ui_adapter
+    """Get the UI adapter of the current session, defaulting to terminal."""
+    session = get_session()
+    if session.ui_adapter is None:
+        session.ui_adapter = TerminalUIAdapter()
+    return session.ui_adapter
 
 
 def ask_user(prompt_text: str):
@@ -169,6 +169,26 @@ def _calculate_retry_delay(attempt: int, base_delay: int = 5, max_delay: int = 6
     return min(delay, max_delay)
 
 
+@contextmanager
+def _model_span(name: str, **attributes):
+    """A span of model requests, with the tokens the session used meanwhile.
+
+    Token usage is reported by litellm once a response is complete, so with
+    requests running concurrently in one session the counts are approximate.
+    """
+    session = get_session()
+    prompt_tokens, completion_tokens = session.prompt_tokens, session.completion_tokens
+    with span(name, **attributes) as model_span:
+        yield model_span
+        model_span.set(prompt_tokens=session.prompt_tokens - prompt_tokens,
+                       completion_tokens=session.completion_tokens - completion_tokens)
+
+
+def _set_time_to_first_token(request_span):
+    """Record that the first chunk of the response of a `model-request` span arrived."""
+    request_span.set(time_to_first_token=round(time.time() - request_span.start, 3))
+
+
 def ask_model(prompt_text: str):
     """Decorator for functions that need model input. Should only be used on stub functions.
     
@@ -191,19 +211,25 @@ def ask_model(prompt_text: str):
             adapter.show_message(Message(Actor.COORDINATOR, prompt_text))
             
             def _model_call_and_stream():
-                # Call the prompt-decorated function to get StreamedStr
-                streamed_result = prompt_decorated_func(*args, **kwargs)
-                
-                if streamed_result is None:
-                    raise ValueError(f"Model function {func.__name__} returned None - this indicates a problem with the prompt or model configuration")
-                
-                # Handle the streaming in the adapter and return final string
-                # This is where the actual API call and streaming happens
-                return adapter.handle_model_streaming(streamed_result)
+                # Every attempt is a request of its own, timed from when it is sent
+                with span("model-request", prompt=func.__name__) as request_span:
+                    # Call the prompt-decorated function to get StreamedStr
+                    streamed_result = prompt_decorated_func(*args, **kwargs)
+
+                    if streamed_result is None:
+                        raise ValueError(f"Model function {func.__name__} returned None - this indicates a problem with the prompt or model configuration")
+
+                    # magentic returns the stream once the first chunk of the response arrived
+                    _set_time_to_first_token(request_span)
+
+                    # Handle the streaming in the adapter and return final string
+                    # This is where the actual API call and streaming happens
+                    return adapter.handle_model_streaming(streamed_result)
             
             try:
                 # Use the retry wrapper for the entire model call including streaming
-                return _retry_with_rate_limit(_model_call_and_stream)
+                with _model_span("model", prompt=func.__name__), use_prompt(func.__name__):
+                    return _retry_with_rate_limit(_model_call_and_stream)
                 
             except Exception as e:
                 # Log the error with traceback
@@ -251,9 +277,12 @@ def ask_model_enum(prompt_text: str):
             adapter.show_message(Message(Actor.COORDINATOR, prompt_text))
             
             def _model_call():
-                # Call the prompt-decorated function to get result
-                result = prompt_decorated_func(*args, **kwargs)
-                
+                with span("model-request", prompt=func.__name__) as request_span:
+                    # Call the prompt-decorated function to get result
+                    result = prompt_decorated_func(*args, **kwargs)
+                    # magentic parses the enum from the complete response, which is when it returns
+                    _set_time_to_first_token(request_span)
+
                 if result is None:
                     raise ValueError(f"Model function {func.__name__} returned None - this indicates a problem with the prompt or model configuration")
                 
@@ -274,7 +303,8 @@ def ask_model_enum(prompt_text: str):
             
             try:
                 # Use the retry wrapper for the model call
-                return _retry_with_rate_limit(_model_call)
+                with _model_span("model", prompt=func.__name__), use_prompt(func.__name__):
+                    return _retry_with_rate_limit(_model_call)
                 
             except Exception as e:
                 # Log the error with traceback
@@ -397,37 +427,49 @@ def _retry_with_rate_limit(func, *args, max_retries=20, base_delay=5, **kwargs):
 
 
 def handle_model_chat(chat: Chat) -> str:
-    """Handle a model chat session with function calls and streaming responses.
-    
+    """Submit a model chat and handle its function calls and streaming responses.
+
+    Each request, from its submit to the end of its streamed response, is a
+    `model-request` span with its time to first token. The tools the model
+    called run between the requests.
+
     Args:
-        chat: The Chat instance to handle
-        
+        chat: The Chat instance to submit
+
     Returns:
         The final string response from the model
     """
-    def _chat_processing():
-        output = None
-        ends_with_function_call = True
-        adapter = get_ui_adapter()
-        current_chat = chat
+    adapter = get_ui_adapter()
 
-        while ends_with_function_call:
-            ends_with_function_call = False
+    def _request(current_chat: Chat):
+        with span("model-request") as request_span:
+            current_chat = current_chat.submit()
+            # magentic returns the response once its first chunk arrived
+            _set_time_to_first_token(request_span)
+            output = None
+            function_calls = []
             for item in current_chat.last_message.content:
                 if isinstance(item, StreamedStr):
                     adapter.handle_model_streaming(item)
                     output = item
-                    ends_with_function_call = False
                 elif isinstance(item, FunctionCall):
+                    function_calls.append(item)
+        return current_chat, output, function_calls
+
+    def _chat_processing():
+        current_chat, output, function_calls = _retry_with_rate_limit(partial(_request, chat))
+        while function_calls:
+            for item in function_calls:
+                with span("tool", function=item.function.__name__):
                     function_call = item()
-                    adapter.show_message(Message(Actor.MODEL, function_call))
-                    current_chat = current_chat.add_message(ToolResultMessage(function_call, item._unique_id))
-                    ends_with_function_call = True
-            
-            if ends_with_function_call:
-                current_chat = _retry_with_rate_limit(current_chat.submit)
+                adapter.show_message(Message(Actor.MODEL, function_call))
+                current_chat = current_chat.add_message(ToolResultMessage(function_call, item._unique_id))
+            current_chat, streamed, function_calls = _retry_with_rate_limit(partial(_request, current_chat))
+            if streamed is not None:
+                output = streamed
 
         return str(output)
-    
-    # Use retry wrapper for the entire chat processing
-    return _chat_processing()
+
+    # Requests are retried one by one, the whole exchange with its tool calls is one span
+    with _model_span("model-chat"):
+        return _chat_processing()
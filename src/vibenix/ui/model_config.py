@@ -50,6 +50,58 @@ PROVIDERS = [
 ]
 
 
+# Prompts that classify or make small edits, routed to the `fast_model` of the configuration
+FAST_PROMPTS = ["pick_template", "evaluate_progress", "evaluate_code", "fix_hash_mismatch"]
+
+# Keys of the configuration that route prompts to other models than the default one
+ROUTING_KEYS = ["fast_model", "prompt_models"]
+
+# Model of each routed prompt, read from the configuration on first use
+_prompt_models: Optional[Dict[str, str]] = None
+
+
+def prompt_models_from_config(config_data: dict) -> Dict[str, str]:
+    """The model of each prompt that does not use the default model.
+
+    `fast_model` routes all of `FAST_PROMPTS`, `prompt_models` maps prompt names
+    to models and takes precedence.
+    """
+    prompt_models = {}
+    fast_model = config_data.get("fast_model")
+    if fast_model:
+        prompt_models.update({prompt: fast_model for prompt in FAST_PROMPTS})
+    prompt_models.update(config_data.get("prompt_models") or {})
+    return prompt_models
+
+
+def model_for_prompt(prompt: Optional[str]) -> Optional[str]:
+    """The model a prompt is routed to, None for the default model."""
+    global _prompt_models
+    if _prompt_models is None:
+        _prompt_models = prompt_models_from_config(_read_config())
+    return _prompt_models.get(prompt) if prompt else None
+
+
+def _read_config() -> dict:
+    config_path = os.path.expanduser("~/.vibenix/config.json")
+    if not os.path.exists(config_path):
+        return {}
+    import json
+    with open(config_path) as f:
+        return json.load(f)
+
+
+def _load_api_key(provider_name: Optional[str]):
+    """Load the API key of a provider from secure storage into its environment variable."""
+    provider = next((p for p in PROVIDERS if p.name == provider_name), None)
+    if provider and provider.requires_api_key and not os.environ.get(provider.env_var):
+        from vibenix.secure_keys import get_api_key
+        api_key = get_api_key(provider.env_var)
+        if api_key:
+            os.environ[provider.env_var] = api_key
+            logger.info(f"Loaded API key for {provider.display_name} from secure storage")
+
+
 # Model configuration is now handled through UI-specific dialogs
 # Use the appropriate UI implementation to configure models
 
@@ -133,6 +185,13 @@ def save_configuration(provider: Provider, model: str, ollama_host: Optional[str
         "model": model,
         "backend": "litellm"
     }
+
+    # Keep the prompt routing, which is only configured in the file
+    try:
+        previous_config = _read_config()
+    except Exception:
+        previous_config = {}
+    config_data.update({key: previous_config[key] for key in ROUTING_KEYS if key in previous_config})
     
     # Always save ollama_host if provided, regardless of current provider
     if ollama_host:
@@ -158,14 +217,10 @@ def save_configuration(provider: Provider, model: str, ollama_host: Optional[str
 
 def load_saved_configuration() -> Optional[Tuple[str, str, Optional[str]]]:
     """Load previously saved configuration, returns (provider_name, model, ollama_host)."""
+    global _prompt_models
     try:
-        import json
-        config_path = os.path.expanduser("~/.vibenix/config.json")
-        
-        if os.path.exists(config_path):
-            with open(config_path) as f:
-                config_data = json.load(f)
-            
+        config_data = _read_config()
+        if config_data:
             # Find the provider
             provider_name = config_data.get("provider")
             model = config_data.get("model")
@@ -177,13 +232,21 @@ def load_saved_configuration() -> Optional[Tuple[str, str, Optional[str]]]:
                 os.environ["MAGENTIC_LITELLM_MODEL"] = model
                 
                 # Load API keys from secure storage if needed
-                provider = next((p for p in PROVIDERS if p.name == provider_name), None)
-                if provider and provider.requires_api_key:
-                    from vibenix.secure_keys import get_api_key
-                    api_key = get_api_key(provider.env_var)
-                    if api_key:
-                        os.environ[provider.env_var] = api_key
-                        logger.info(f"Loaded API key for {provider.display_name} from secure storage")
+                _load_api_key(provider_name)
+
+                # Routed prompts can use models of other providers
+                _prompt_models = prompt_models_from_config(config_data)
+                for routed_model in sorted(set(_prompt_models.values())):
+                    try:
+                        _, routed_provider, _, _ = litellm.get_llm_provider(routed_model)
+                    except Exception as e:
+                        logger.warning(f"Unknown provider of routed model {routed_model}: {e}")
+                        continue
+                    _load_api_key(routed_provider)
+                    if routed_provider == "ollama" and ollama_host:
+                        os.environ["OLLAMA_API_BASE"] = ollama_host
+                for prompt, routed_model in sorted(_prompt_models.items()):
+                    logger.info(f"Routing {prompt} to {routed_model}")
                 
                 # Set OLLAMA_API_BASE only if using Ollama
                 if provider_name == "ollama" and ollama_host:
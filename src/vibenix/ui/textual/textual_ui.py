@@ -13,7 +13,6 @@ import asyncio
 from datetime import datetime
 
 # Import existing vibenix functionality
-from vibenix import config
 from vibenix.packaging_flow.model_prompts import (
     set_up_project,
     summarize_github
@@ -21,7 +20,6 @@ from vibenix.packaging_flow.model_prompts import (
 from vibenix.parsing import scrape_and_process, extract_updated_code
 from vibenix.flake import init_flake
 from vibenix.nix import invoke_build
-from vibenix import config
 from vibenix.errors import NixError
 from vibenix.ui.logging_config import logger, log_capture
 import os
@@ -443,9 +441,6 @@ class VibenixChatApp(App):
     
     def on_mount(self) -> None:
         """Initialize the chat with a welcome message."""
-        # Initialize vibenix config
-        config.init()
-        
         # Set UI mode
         from vibenix.main import set_ui_mode
         set_ui_mode(True)
@@ -0,0 +1,88 @@
+"""Usage of the model by a session, and budgets that end a session early.
+
+Every model request is recorded as a `ModelCall` with the prompt it was made
+for, see `use_prompt` in session.py, its tokens, its latency and its cost.
+Calls are logged to the CCL log one by one and summed up per prompt, so the
+expensive and the slow prompts can be told apart.
+
+A `Budget` limits the cost, the tokens and the wall clock time of a session.
+The fix loop and the refinement check it between iterations and end the
+session with the best solution so far once it is exhausted, so a session is
+never cut off in the middle of a build.
+"""
+
+import threading
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+
+@dataclass
+class ModelCall:
+    """One model request and its response."""
+    prompt: str
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    # Prompt tokens served from the provider's prompt cache
+    cached_tokens: int
+    # None for responses that were not streamed
+    time_to_first_token: Optional[float]
+    latency: float
+    cost: float
+    # Whether the prompt was routed to another model than the configured one
+    routed: bool = False
+
+
+@dataclass
+class PromptUsage:
+    """The summed up model calls of one prompt."""
+    # Model of the latest call
+    model: str = ""
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    cost: float = 0.0
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+
+    def add(self, call: ModelCall):
+        self.model = call.model
+        self.calls += 1
+        self.prompt_tokens += call.prompt_tokens
+        self.completion_tokens += call.completion_tokens
+        self.cached_tokens += call.cached_tokens
+        self.cost += call.cost
+        self.total_latency += call.latency
+        self.max_latency = max(self.max_latency, call.latency)
+
+
+class UsageLedger:
+    """The model calls of a session, summed up per prompt."""
+
+    def __init__(self):
+        self.by_prompt: Dict[str, PromptUsage] = {}
+        self._lock = threading.Lock()
+
+    def record(self, call: ModelCall):
+        with self._lock:
+            self.by_prompt.setdefault(call.prompt, PromptUsage()).add(call)
+
+
+@dataclass
+class Budget:
+    """Limits of a session, None is unlimited."""
+    max_cost: Optional[float] = None
+    max_tokens: Optional[int] = None
+    # Seconds of wall clock time
+    max_time: Optional[float] = None
+
+    def exceeded(self, cost: float, tokens: int, elapsed: float) -> Optional[str]:
+        """Why the budget is exhausted, or None if it is not."""
+        if self.max_cost is not None and cost >= self.max_cost:
+            return f"cost budget of ${self.max_cost:.2f} exhausted (${cost:.4f} spent)"
+        if self.max_tokens is not None and tokens >= self.max_tokens:
+            return f"token budget of {self.max_tokens} exhausted ({tokens} used)"
+        if self.max_time is not None and elapsed >= self.max_time:
+            return f"time budget of {self.max_time:.0f}s exhausted ({elapsed:.0f}s elapsed)"
+        return None
@@ -0,0 +1,68 @@
+"""A pool of packaging workers forked from a warm fork server.
+
+A session in a fresh interpreter first imports litellm, magentic and magika,
+which takes seconds. `create_worker_pool` starts a fork server that imports
+them and loads the shared read-only data once, see `warm_up`, and forks a new
+worker from it for every job. Jobs start without that overhead and without
+any state left over from earlier jobs, and the preloaded modules and data are
+shared copy-on-write between all workers.
+
+Workers are forked from the fork server rather than from the process that
+submits the jobs, because that one runs threads, and forking a process with
+threads can deadlock the child. For the same reason the fork server does not
+load Magika's model, whose ONNX runtime starts a thread pool; every worker
+loads it on first use.
+"""
+
+import gc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+from vibenix.ui.logging_config import logger
+
+# Imported by the fork server before it forks the first worker, calls `warm_up`
+PRELOAD_MODULES = ["vibenix.worker_preload"]
+
+# Modules every packaging session needs
+WARM_MODULES = [
+    "litellm",
+    "magentic",
+    "magika",
+    "git",
+    "bs4",
+    "requests",
+    "vibenix.packaging_flow.run",
+    "vibenix.function_calls_source",
+    "vibenix.function_calls_build_log",
+]
+
+
+def warm_up():
+    """Import the modules of a packaging session and load the shared read-only data."""
+    import importlib
+    for module in WARM_MODULES:
+        importlib.import_module(module)
+
+    from vibenix.function_calls import noogle_function_names
+    try:
+        noogle_function_names()
+    except (RuntimeError, OSError) as e:
+        # search_nix_functions reports this to the model
+        logger.warning(f"Not preloading the Noogle function names: {e}")
+
+    # Objects that exist now are never collected, so the collector does not
+    # write to their pages in the workers, which would copy them
+    gc.freeze()
+
+
+def create_worker_pool(workers: int, initializer: Optional[Callable] = None, initargs: tuple = ()) -> ProcessPoolExecutor:
+    """A process pool that runs every job in a new worker forked from the warm fork server.
+
+    `initializer` runs in every worker before its job.
+    """
+    context = multiprocessing.get_context("forkserver")
+    # The fork server is started on the first job, with the environment of that moment
+    context.set_forkserver_preload(PRELOAD_MODULES)
+    return ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initializer,
+                               initargs=initargs, max_tasks_per_child=1)
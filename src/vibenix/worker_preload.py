@@ -0,0 +1,9 @@
+"""Warms up the fork server of worker_pool.py, which imports this module once it starts.
+
+Importing this module imports all modules of a packaging session and freezes
+the garbage collector, so it is only imported by the fork server.
+"""
+
+from vibenix.worker_pool import warm_up
+
+warm_up()
@@ -23,4 +23,14 @@ def model_config():
         "provider": provider_name,
         "model": model,
         "ollama_host": ollama_host
-    }
\ No newline at end of file
+    }
+
+@pytest.fixture
+def session():
+    """Run the test in a fresh packaging session."""
+    from vibenix.session import Session, use_session
+
+    test_session = Session()
+    with use_session(test_session):
+        yield test_session
+    test_session.close()
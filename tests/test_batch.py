@@ -0,0 +1,108 @@
+"""Tests for the batch packaging runner."""
+
+import json
+
+import pytest
+
+from vibenix.batch import (ERROR, FAILED, STOPPED, SUCCEEDED, PackagingRequest, pending_requests, read_requests,
+                           load_results, order_by_predicted_cost, run_request, _read_session_end,
+                           write_results_table)
+from vibenix.packaging_flow import run
+from vibenix.process import ProcessCancelled
+
+
+def test_read_requests_from_csv_and_fetchers(tmp_path):
+    csv_file = tmp_path / "requests.csv"
+    csv_file.write_text("issue_number,repo_url\n1,https://github.com/a/a\n2,\n3,https://github.com/c/c\n")
+    fetchers = tmp_path / "nurl_fetches"
+    fetchers.mkdir()
+    (fetchers / "3.nix").write_text("# Issue 3\n# URL: https://github.com/c/other\nfetchFromGitHub {}\n")
+    (fetchers / "4.nix").write_text("# Issue 4\n# URL: https://github.com/d/d\nfetchFromGitHub {}\n")
+    (fetchers / "5.nix").write_text("fetchFromGitHub {}\n")
+
+    requests = read_requests([csv_file, fetchers])
+    assert requests == [
+        PackagingRequest(issue_number="1", repo_url="https://github.com/a/a"),
+        PackagingRequest(issue_number="3", repo_url="https://github.com/c/c"),
+        PackagingRequest(issue_number="4", repo_url="https://github.com/d/d", fetcher=str(fetchers / "4.nix")),
+    ]
+
+
+def test_order_by_predicted_cost():
+    requests = [PackagingRequest(issue_number=str(i), repo_url=f"https://github.com/{i}/{i}") for i in range(4)]
+    history = {
+        "0": {"repo_url": "https://github.com/0/0", "elapsed": 10.0},
+        "1": {"repo_url": "https://github.com/1/1", "elapsed": 300.0},
+        "2": {"repo_url": "https://github.com/2/2", "elapsed": 100.0},
+    }
+    ordered = [request.issue_number for request in order_by_predicted_cost(requests, history)]
+    # Request 3 has no history and is predicted to take the median time
+    assert ordered == ["1", "2", "3", "0"]
+
+
+def test_results_checkpoint_and_table(tmp_path):
+    results_file = tmp_path / "results.jsonl"
+    results_file.write_text(
+        json.dumps({"issue_number": "1", "repo_url": "u", "success": False, "error": "killed"}) + "\n"
+        + json.dumps({"issue_number": "1", "repo_url": "u", "success": True, "cost": 0.5}) + "\n"
+    )
+    results = load_results(results_file)
+    assert results["1"]["success"]
+
+    write_results_table(results, tmp_path / "results.csv")
+    lines = (tmp_path / "results.csv").read_text().splitlines()
+    assert lines[0] == "issue_number,repo_url,success,status,package_name,iterations,cost,elapsed,error"
+    assert lines[1] == "1,u,True,,,,0.5,,"
+
+
+def test_read_session_end(tmp_path):
+    ccl_file = tmp_path / "run.ccl"
+    ccl_file.write_text(
+        "session-start =\n  elapsed = 00:00:00.001\n"
+        "session-end =\n  elapsed = 00:10:00.000\n  success = true\n  total_iterations = 7\n  total_cost = 0.123456\n"
+    )
+    values = _read_session_end(ccl_file)
+    assert values["total_iterations"] == "7"
+    assert values["total_cost"] == "0.123456"
+
+
+def test_pending_requests_retry_errors_and_optionally_failures(tmp_path):
+    statuses = {"1": SUCCEEDED, "2": FAILED, "3": STOPPED, "4": ERROR}
+    requests = [PackagingRequest(issue_number=str(i), repo_url=f"https://github.com/{i}/{i}") for i in range(1, 6)]
+    results = {issue: {"issue_number": issue, "success": status == SUCCEEDED, "status": status}
+               for issue, status in statuses.items()}
+    # Results of older batches have no status
+    results["5"] = {"issue_number": "5", "success": False, "error": "packaging failed"}
+    for issue in results:
+        (tmp_path / issue).mkdir()
+        (tmp_path / issue / "checkpoint.json").write_text("{}")
+
+    assert [request.issue_number for request in pending_requests(requests, results, tmp_path)] == ["4"]
+    assert (tmp_path / "2" / "checkpoint.json").exists()
+
+    retried = pending_requests(requests, results, tmp_path, retry_failed=True)
+    assert [request.issue_number for request in retried] == ["2", "3", "4", "5"]
+    # Failed sessions start from scratch, stopped and crashed ones continue from their checkpoint
+    assert not (tmp_path / "2" / "checkpoint.json").exists()
+    assert not (tmp_path / "5" / "checkpoint.json").exists()
+    assert (tmp_path / "3" / "checkpoint.json").exists()
+    assert (tmp_path / "4" / "checkpoint.json").exists()
+
+
+def test_cancelled_sessions_are_no_result_but_other_exits_are_errors(tmp_path, monkeypatch):
+    request = PackagingRequest(issue_number="1", repo_url="https://github.com/a/a")
+
+    def package_project(exception):
+        def package(**kwargs):
+            raise exception
+        return package
+
+    monkeypatch.setattr(run, "package_project", package_project(ProcessCancelled("batch stopped")))
+    with pytest.raises(ProcessCancelled):
+        run_request(request, tmp_path)
+
+    monkeypatch.setattr(run, "package_project", package_project(SystemExit(1)))
+    result = run_request(request, tmp_path)
+    assert result["status"] == ERROR
+    assert not result["success"]
+    assert result["error"] == "SystemExit: 1"
@@ -0,0 +1,70 @@
+"""Tests for the beam search over solution candidates."""
+
+import pytest
+
+from vibenix import log_store
+from vibenix.ccl_log import init_logger, close_logger
+from vibenix.errors import NixBuildResult, NixError, NixErrorKind
+from vibenix.packaging_flow import beam
+from vibenix.packaging_flow.candidates import Solution
+
+
+def failure(lines: int, derivation_path: str = None) -> NixBuildResult:
+    log = "\n".join(f"line {i}" for i in range(lines))
+    return NixBuildResult(success=False, is_src_attr_only=False, derivation_path=derivation_path,
+                          error=NixError(type=NixErrorKind.BUILD_ERROR, error_message=log))
+
+
+# What building each version of the code results in
+OUTCOMES = {
+    "a": failure(50),
+    "b": failure(20),
+    "b2": failure(20, derivation_path="/nix/store/b.drv"),
+    "b3": failure(20, derivation_path="/nix/store/b.drv"),
+    "a1": failure(10),
+    "b1": NixBuildResult(success=True, is_src_attr_only=False),
+}
+
+
+@pytest.fixture
+def search(session, tmp_path, monkeypatch):
+    previous_store = log_store._log_store
+    log_store.init_log_store(tmp_path / "logs")
+    init_logger(tmp_path / "run.ccl")
+    monkeypatch.setattr(beam, "update_flake", lambda code: None)
+    monkeypatch.setattr(beam, "coordinator_message", lambda message: None)
+    monkeypatch.setattr(beam, "coordinator_progress", lambda message: None)
+    monkeypatch.setattr(beam, "propose_and_build", lambda proposers: [
+        Solution(code=code, result=OUTCOMES[code]) for code in dict.fromkeys(p() for p in proposers)
+    ])
+    yield
+    close_logger()
+    log_store._log_store = previous_store
+
+
+def test_alternative_branch_survives_regression(search):
+    # The initial solution "x" is expanded into "a" and "b", "a" looks better,
+    # but only the worse branch "b" leads to a successful build
+    children = {"x": ["a", "b"], "a": ["a1", "a1"], "b": ["b1", "b1"]}
+    proposed_for = []
+
+    def propose_fix(parent, other_attempts):
+        proposed_for.append(parent.code)
+        return children[parent.code][len(other_attempts)]
+
+    initial = Solution(code="x", result=failure(5))
+    solution, iterations = beam.beam_search(initial, propose_fix, width=2, branching=2,
+                                            max_iterations=10, max_rounds_without_progress=3)
+    assert solution.code == "b1"
+    assert solution.result.success
+    assert iterations == 2
+    assert proposed_for == ["x", "x", "a", "a", "b", "b"]
+
+
+def test_duplicate_derivations_are_dropped(session, search):
+    proposals = iter(["b2", "b3"])
+    initial = Solution(code="x", result=failure(5))
+    solution, iterations = beam.beam_search(initial, lambda parent, attempts: next(proposals, "b3"), width=3,
+                                            branching=2, max_iterations=1, max_rounds_without_progress=3)
+    assert solution.code == "b2"
+    assert [result.derivation_path for result in session.error_stack] == ["/nix/store/b.drv"]
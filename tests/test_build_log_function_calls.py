@@ -0,0 +1,66 @@
+"""Tests for the build log function calls."""
+
+import pytest
+
+from vibenix import log_store
+from vibenix.ccl_log import init_logger, close_logger
+from vibenix.errors import NixBuildResult, NixError, NixErrorKind
+from vibenix.function_calls_build_log import create_build_log_function_calls
+
+
+@pytest.fixture
+def build_logs(session, tmp_path):
+    """Put two failed builds on the error stack and return the build log functions."""
+    previous_store = log_store._log_store
+    log_store.init_log_store(tmp_path / "logs")
+    init_logger(tmp_path / "run.ccl")
+
+    older = "\n".join(f"older line {i}" for i in range(1, 101))
+    newer = "\n".join(
+        ["configure: checking for zlib.h... no", "configure: WARNING: zlib.h missing"]
+        + [f"compiling file{i}.c" for i in range(1000)]
+        + ["error: build failed"]
+    )
+    session.error_stack.extend([
+        NixBuildResult(success=False, is_src_attr_only=False,
+                       error=NixError(type=NixErrorKind.BUILD_ERROR, error_message=older)),
+        NixBuildResult(success=True, is_src_attr_only=True),
+        NixBuildResult(success=False, is_src_attr_only=False,
+                       error=NixError(type=NixErrorKind.BUILD_ERROR, error_message=newer)),
+    ])
+
+    yield {f.__name__: f for f in create_build_log_function_calls()}
+
+    close_logger()
+    log_store._log_store = previous_store
+
+
+def test_list_build_logs(build_logs):
+    result = build_logs["list_build_logs"]()
+    assert "build 0: BUILD_ERROR (package), 1003 lines" in result
+    assert "build 1: BUILD_ERROR (package), 100 lines" in result
+    assert "build 2" not in result
+
+
+def test_search_finds_early_lines_with_line_numbers(build_logs):
+    result = build_logs["search_build_log"]("zlib", context_lines=0)
+    assert "     1: configure: checking for zlib.h... no" in result
+    assert "     2: configure: WARNING: zlib.h missing" in result
+
+
+def test_search_previous_build(build_logs):
+    result = build_logs["search_build_log"]("older line 50$", build=1, context_lines=1)
+    assert "    49- older line 49" in result
+    assert "    50: older line 50" in result
+    assert "    51- older line 51" in result
+
+
+def test_search_no_matches_and_invalid_input(build_logs):
+    assert "No matches found" in build_logs["search_build_log"]("does not occur")
+    assert "Invalid regular expression" in build_logs["search_build_log"]("(")
+    assert "does not exist" in build_logs["search_build_log"]("x", build=5)
+
+
+def test_read_build_log_window(build_logs):
+    result = build_logs["read_build_log"](1002, number_lines_to_read=5)
+    assert result.splitlines() == ["  1002: compiling file999.c", "  1003: error: build failed"]
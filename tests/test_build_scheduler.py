@@ -0,0 +1,142 @@
+"""Tests for the build scheduler."""
+
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+from vibenix import build_scheduler
+from vibenix.build_scheduler import BuildScheduler, scheduled_build, start_shared_build_scheduler
+from vibenix.ccl_log import init_logger, close_logger
+
+
+def test_lone_build_gets_all_cores():
+    scheduler = BuildScheduler(cores=8, memory_mb=64 * 1024)
+    slot = scheduler.acquire()
+    assert slot.cores == 8
+    assert slot.nix_options() == ["--max-jobs", "1", "--cores", "8"]
+
+
+def test_batch_splits_cores_between_jobs():
+    scheduler = BuildScheduler(cores=8, memory_mb=64 * 1024)
+    slot = scheduler.acquire(jobs=3)
+    assert slot.nix_options() == ["--max-jobs", "3", "--cores", "2"]
+
+
+def test_memory_limits_cores():
+    scheduler = BuildScheduler(cores=8, memory_mb=4096, memory_per_core_mb=1024)
+    assert scheduler.acquire().cores == 4
+
+
+def test_builds_queue_when_saturated():
+    scheduler = BuildScheduler(cores=2, memory_mb=64 * 1024)
+    first = scheduler.acquire()
+    assert first.cores == 2
+
+    granted = []
+    waiter = threading.Thread(target=lambda: granted.append(scheduler.acquire()))
+    waiter.start()
+    time.sleep(0.1)
+    assert not granted
+    assert scheduler.stats()["queued"] == 1
+
+    scheduler.release(first.slot_id, run_time=1.0)
+    waiter.join(timeout=5)
+    assert granted and granted[0].wait_time > 0
+    stats = scheduler.stats()
+    assert stats["builds"] == 1
+    assert stats["total_run_time"] == 1.0
+
+
+def test_concurrent_builds_share_the_cores():
+    scheduler = BuildScheduler(cores=8, memory_mb=64 * 1024, expected_builds=2)
+    barrier = threading.Barrier(2)
+    slots = []
+
+    def build():
+        barrier.wait()
+        slots.append(scheduler.acquire())
+        # Both builds hold their slots at the same time
+        barrier.wait(timeout=5)
+
+    builds = [threading.Thread(target=build) for _ in range(2)]
+    for thread in builds:
+        thread.start()
+    for thread in builds:
+        thread.join(timeout=5)
+    assert [slot.cores for slot in slots] == [4, 4]
+    assert scheduler.stats()["running"] == 2
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    init_logger(tmp_path / "run.ccl")
+    yield build_scheduler.init_build_scheduler(BuildScheduler(cores=4, memory_mb=64 * 1024))
+    build_scheduler._scheduler = None
+    close_logger()
+
+
+def test_scheduled_build_logs_times(scheduler, tmp_path):
+    with scheduled_build() as options:
+        assert options == ["--max-jobs", "1", "--cores", "4"]
+    assert scheduler.stats()["builds"] == 1
+    log = (tmp_path / "run.ccl").read_text()
+    assert "build_schedule =" in log
+    assert "cores = 4" in log
+
+
+def test_unscheduled_build_has_no_options():
+    assert build_scheduler.get_build_scheduler() is None
+    with scheduled_build() as options:
+        assert options == []
+
+
+def test_shared_scheduler():
+    manager, shared = start_shared_build_scheduler(cores=4, memory_mb=64 * 1024)
+    try:
+        slot = shared.acquire()
+        assert slot.cores == 4
+        shared.release(slot.slot_id, 0.5)
+        assert shared.stats()["builds"] == 1
+    finally:
+        manager.shutdown()
+
+
+def _exited_pid() -> int:
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return process.pid
+
+
+def test_builds_of_processes_that_died_are_reclaimed(monkeypatch):
+    monkeypatch.setattr(build_scheduler, "REAP_INTERVAL", 0.05)
+    scheduler = BuildScheduler(cores=2, memory_mb=64 * 1024)
+    # A worker was killed while it held a slot
+    scheduler.acquire(pid=_exited_pid())
+    assert scheduler.acquire(pid=os.getpid()).cores == 2
+    assert scheduler.stats()["running"] == 1
+
+
+def test_queued_builds_of_processes_that_died_do_not_block_the_queue(monkeypatch):
+    monkeypatch.setattr(build_scheduler, "REAP_INTERVAL", 0.05)
+    scheduler = BuildScheduler(cores=2, memory_mb=64 * 1024)
+    first = scheduler.acquire(pid=os.getpid())
+
+    # The build of a worker that was killed while it waited at the head of the queue
+    errors = []
+    dead_pid = _exited_pid()
+    dead = threading.Thread(target=lambda: errors.append(pytest.raises(ProcessLookupError, scheduler.acquire,
+                                                                       pid=dead_pid)))
+    dead.start()
+    granted = []
+    waiter = threading.Thread(target=lambda: granted.append(scheduler.acquire(pid=os.getpid())))
+    waiter.start()
+
+    scheduler.release(first.slot_id)
+    waiter.join(timeout=5)
+    dead.join(timeout=5)
+    assert granted and granted[0].cores == 2
+    assert len(errors) == 1
+    assert scheduler.stats()["queued"] == 0
@@ -0,0 +1,86 @@
+"""Tests for speculative fix candidates."""
+
+import pytest
+
+from vibenix import log_store
+from vibenix.errors import NixBuildResult, NixError, NixErrorKind, last_build_phase
+from vibenix.packaging_flow import candidates
+from vibenix.packaging_flow.candidates import progress_score, propose_and_build_candidates
+
+
+@pytest.fixture(autouse=True)
+def store(tmp_path):
+    previous_store = log_store._log_store
+    log_store.init_log_store(tmp_path / "logs")
+    yield
+    log_store._log_store = previous_store
+
+
+def failure(kind: NixErrorKind, lines: int, src_only: bool = False) -> NixBuildResult:
+    log = "\n".join(f"line {i}" for i in range(lines))
+    return NixBuildResult(success=False, is_src_attr_only=src_only, error=NixError(type=kind, error_message=log))
+
+
+def test_progress_score_ordering():
+    ordered = [
+        failure(NixErrorKind.EVAL_ERROR, 500, src_only=True),
+        failure(NixErrorKind.EVAL_ERROR, 10),
+        failure(NixErrorKind.HASH_MISMATCH, 10),
+        failure(NixErrorKind.BUILD_ERROR, 10),
+        failure(NixErrorKind.BUILD_ERROR, 200),
+        NixBuildResult(success=True, is_src_attr_only=False),
+    ]
+    scores = [progress_score(result) for result in ordered]
+    assert scores == sorted(scores)
+    assert len(set(scores)) == len(scores)
+
+
+def test_later_phase_failure_outranks_longer_earlier_failure():
+    # A configure script that fails after hundreds of checks
+    configure_failure = "\n".join(["Running phase: unpackPhase", "Running phase: configurePhase"]
+                                  + [f"checking for feature {i}... yes" for i in range(500)]
+                                  + ["configure: error: zlib not found"])
+    install_failure = "\n".join(["Running phase: unpackPhase", "Running phase: configurePhase",
+                                 "Running phase: buildPhase", "Running phase: installPhase",
+                                 "install: cannot stat 'hello': No such file or directory"])
+    configure = NixBuildResult(success=False, is_src_attr_only=False,
+                               error=NixError(type=NixErrorKind.BUILD_ERROR, error_message=configure_failure))
+    install = NixBuildResult(success=False, is_src_attr_only=False,
+                             error=NixError(type=NixErrorKind.BUILD_ERROR, error_message=install_failure))
+    assert configure.error.line_count > install.error.line_count
+    assert progress_score(install) > progress_score(configure)
+
+
+def test_last_build_phase():
+    # Output of nix build, with the prefix of the derivation, and of an older stdenv
+    assert last_build_phase("hello> Running phase: unpackPhase\nhello> Running phase: buildPhase\n"
+                            "hello> make: *** Error 1") == "buildPhase"
+    assert last_build_phase("unpacking sources\npatching sources\nconfiguring\nrunning tests\n") == "checkPhase"
+    # Custom phases do not count as progress on their own
+    assert last_build_phase("Running phase: configurePhase\nRunning phase: myCustomPhase\n") == "configurePhase"
+    assert last_build_phase("error: attribute 'hello' missing") is None
+
+
+def test_candidates_see_previous_proposals_and_duplicates_build_once(session, monkeypatch, tmp_path):
+    monkeypatch.setattr(candidates, "copy_flake", lambda: tmp_path)
+    monkeypatch.setattr(candidates.shutil, "rmtree", lambda *args, **kwargs: None)
+    monkeypatch.setattr(candidates, "coordinator_progress", lambda message: None)
+    built = []
+
+    def build_solution(code, flake_dir):
+        built.append(code)
+        return failure(NixErrorKind.BUILD_ERROR, len(code))
+    monkeypatch.setattr(candidates, "build_solution", build_solution)
+
+    seen = []
+    proposals = iter(["fix a", "fix a", "fix bb"])
+
+    def propose_fix(other_attempts):
+        seen.append(other_attempts)
+        return next(proposals)
+
+    solutions = propose_and_build_candidates(propose_fix, 3)
+    assert seen == [[], ["fix a"], ["fix a"]]
+    assert sorted(built) == ["fix a", "fix bb"]
+    assert [solution.code for solution in solutions] == ["fix a", "fix bb"]
+    assert max(solutions, key=lambda s: progress_score(s.result)).code == "fix bb"
@@ -0,0 +1,71 @@
+"""Tests for recording and replaying model exchanges."""
+
+import json
+
+import litellm
+from magentic import prompt
+from magentic.chat_model.litellm_chat_model import LitellmChatModel
+
+from vibenix.cassette import RecordingCassette, ReplayingCassette, ReplaySpeed, use_cassette
+from vibenix.session import PROMPT_METADATA_KEY, SESSION_ID_METADATA_KEY
+
+MODEL = "gpt-4o-mini"
+
+
+def _ask(session, question, prompt_name=None, **kwargs):
+    stream = litellm.completion(model=MODEL, messages=[{"role": "user", "content": question}], stream=True,
+                                metadata={SESSION_ID_METADATA_KEY: session.session_id,
+                                          PROMPT_METADATA_KEY: prompt_name}, **kwargs)
+    return "".join(chunk.choices[0].delta.content or "" for chunk in stream)
+
+
+def test_replay_serves_recorded_responses(session, tmp_path):
+    cassette_file = tmp_path / "cassette.jsonl"
+    recorder = RecordingCassette(cassette_file)
+    use_cassette(session, recorder)
+    assert _ask(session, "first", mock_response="one") == "one"
+    assert _ask(session, "second", mock_response="two") == "two"
+    recorder.close()
+
+    exchanges = [json.loads(line) for line in cassette_file.read_text().splitlines()]
+    assert [exchange["request"]["messages"][0]["content"] for exchange in exchanges] == ["first", "second"]
+
+    replayer = ReplayingCassette(cassette_file, ReplaySpeed.ASAP)
+    use_cassette(session, replayer)
+    # Matched by content, not by order
+    assert _ask(session, "second", prompt_name="replayed") == "two"
+    assert _ask(session, "first", prompt_name="replayed") == "one"
+    assert replayer.remaining == 0
+    # Replayed calls bypass litellm's callbacks, so the cassette records them in the ledger
+    usage = session.usage.by_prompt["replayed"]
+    assert usage.calls == 2
+    assert usage.prompt_tokens > 0 and usage.completion_tokens > 0
+
+
+def test_replay_falls_back_to_recording_order(session, tmp_path):
+    cassette_file = tmp_path / "cassette.jsonl"
+    recorder = RecordingCassette(cassette_file)
+    use_cassette(session, recorder)
+    _ask(session, "in /tmp/abc", mock_response="one")
+    _ask(session, "in /tmp/def", mock_response="two")
+    recorder.close()
+
+    use_cassette(session, ReplayingCassette(cassette_file, ReplaySpeed.ASAP))
+    assert _ask(session, "in /tmp/xyz") == "one"
+    assert _ask(session, "in /tmp/uvw") == "two"
+
+
+def test_replay_through_chat_model(session, tmp_path):
+    cassette_file = tmp_path / "cassette.jsonl"
+    recorder = RecordingCassette(cassette_file)
+    use_cassette(session, recorder)
+    _ask(session, "Say hello to Nix.", mock_response="Hello, Nix!")
+    recorder.close()
+
+    use_cassette(session, ReplayingCassette(cassette_file, ReplaySpeed.REALTIME))
+
+    @prompt("Say hello to {name}.")
+    def say_hello(name: str) -> str: ...
+
+    with LitellmChatModel(MODEL, metadata={SESSION_ID_METADATA_KEY: session.session_id}):
+        assert say_hello("Nix") == "Hello, Nix!"
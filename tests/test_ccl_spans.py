@@ -0,0 +1,121 @@
+"""Tests for the timing spans in the CCL log."""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from magentic import FunctionCall, StreamedStr
+
+from vibenix.ccl_log import close_logger, init_logger, span
+from vibenix.nix import invoke_build
+from vibenix.nix_backend import SimulatedNixBackend
+from vibenix.session import submit_in_session
+from vibenix.ui.conversation import handle_model_chat
+
+
+def _spans(log: str):
+    """The fields of every logged span, in the order they finished."""
+    spans = []
+    span_indent = None
+    for line in log.splitlines():
+        indent = len(line) - len(line.lstrip())
+        if line.strip() == "span =":
+            spans.append({})
+            span_indent = indent
+        elif span_indent is not None and indent > span_indent:
+            key, _, value = line.strip().partition(" = ")
+            spans[-1][key] = value
+        else:
+            span_indent = None
+    return spans
+
+
+def test_nested_spans_and_breakdown(session, tmp_path):
+    log_file = tmp_path / "run.ccl"
+    logger = init_logger(log_file)
+    with span("outer", stage="setup") as outer:
+        with span("inner"):
+            pass
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            def work():
+                with span("worker"):
+                    pass
+            for future in [submit_in_session(executor, work) for _ in range(2)]:
+                future.result()
+        outer.set(exit_code=0)
+    logger.log_session_end(True, 1)
+    close_logger()
+
+    log = log_file.read_text()
+    spans = {entry["name"]: entry for entry in _spans(log)}
+    assert spans["outer"]["stage"] == "setup"
+    assert spans["outer"]["exit_code"] == "0"
+    assert spans["inner"]["parent"] == spans["outer"]["id"]
+    assert spans["worker"]["parent"] == spans["outer"]["id"]
+
+    breakdown = log[log.index("  breakdown =\n"):]
+    assert "    worker =\n      count = 2\n" in breakdown
+    assert "    outer =\n      count = 1\n" in breakdown
+
+
+def test_build_spans(session, tmp_path):
+    flake_dir = tmp_path / "flake"
+    flake_dir.mkdir()
+    (flake_dir / "package.nix").write_text("{ }")
+    session.nix_backend = SimulatedNixBackend([], time_scale=0)
+    log_file = tmp_path / "run.ccl"
+    init_logger(log_file)
+    invoke_build(False, flake_dir=flake_dir)
+    close_logger()
+
+    spans = _spans(log_file.read_text())
+    assert [entry["name"] for entry in spans] == ["evaluate", "nix-build", "log-fetch", "build"]
+    build = spans[-1]
+    assert build["success"] == "False"
+    assert build["error"] == "BUILD_ERROR"
+    assert all(entry["parent"] == build["id"] for entry in spans[:-1])
+    assert spans[1]["exit_code"] == "1"
+
+
+def _slowly(chunks):
+    for chunk in chunks:
+        time.sleep(0.05)
+        yield chunk
+
+
+class FakeChat:
+    """Answers every submit with the next of its responses, after a delay."""
+
+    def __init__(self, responses, tool_results=()):
+        self.responses = responses
+        self.tool_results = list(tool_results)
+
+    def add_message(self, message):
+        return FakeChat(self.responses, self.tool_results + [message.content])
+
+    def submit(self):
+        time.sleep(0.05)
+        chat = FakeChat(self.responses[1:], self.tool_results)
+        chat.last_message = SimpleNamespace(content=self.responses[0](self.tool_results))
+        return chat
+
+
+def test_chat_requests_are_spans_with_their_streaming(session, tmp_path):
+    def read_build_log() -> str:
+        return "configure: zlib missing"
+
+    chat = FakeChat([
+        lambda tool_results: [StreamedStr(_slowly(["Let me ", "look"])), FunctionCall(read_build_log)],
+        lambda tool_results: [StreamedStr(_slowly(["Add zlib, ", tool_results[0]]))],
+    ])
+    log_file = tmp_path / "run.ccl"
+    init_logger(log_file)
+    assert handle_model_chat(chat) == "Add zlib, configure: zlib missing"
+    close_logger()
+
+    spans = _spans(log_file.read_text())
+    assert [entry["name"] for entry in spans] == ["model-request", "tool", "model-request", "model-chat"]
+    for request in (spans[0], spans[2]):
+        # The first token arrived after the submit, the streaming of the response is part of the request
+        assert 0.05 <= float(request["time_to_first_token"]) <= float(request["duration"]) - 0.1
+        assert request["parent"] == spans[-1]["id"]
@@ -0,0 +1,92 @@
+"""Tests for session checkpoints."""
+
+from vibenix import log_store
+from vibenix.ccl_log import close_logger, init_logger
+from vibenix.ccl_reader import read_sections
+from vibenix.errors import NixBuildResult, NixError, NixErrorKind
+from vibenix.packaging_flow import run
+from vibenix.packaging_flow.candidates import Solution
+from vibenix.packaging_flow.checkpoint import SessionCheckpoint, load_checkpoint, save_checkpoint
+from vibenix.usage import Budget
+
+PACKAGE = "{ stdenv }: stdenv.mkDerivation { pname = \"hello\"; }"
+
+
+def test_checkpoint_round_trip_keeps_log_references(tmp_path):
+    previous_store = log_store._log_store
+    log_store.init_log_store(tmp_path / "logs")
+    try:
+        log = "\n".join(["configure: zlib missing"] + [f"line {i}" for i in range(20)])
+        failed = NixBuildResult(success=False, is_src_attr_only=False, derivation_path="/nix/store/a.drv",
+                                error=NixError(type=NixErrorKind.BUILD_ERROR, error_message=log))
+        solution = Solution(code="{ }", result=failed)
+        checkpoint = SessionCheckpoint(
+            project_url="https://github.com/example/project",
+            summary="A project",
+            release_data={"tag_name": "v1.0"},
+            template_type="generic",
+            store_path="/nix/store/source",
+            best=solution,
+            candidate=solution,
+            error_stack=[failed],
+            iteration=3,
+            consecutive_rebuilds_without_progress=1,
+            total_cost=0.25,
+        )
+        path = tmp_path / "out" / "checkpoint.json"
+        save_checkpoint(checkpoint, path)
+
+        loaded = load_checkpoint(path)
+        assert loaded == checkpoint
+        assert loaded.candidate.result.error.error_message == log
+        # Only the tail of the log is stored in the checkpoint, the full log stays in the log store
+        assert "zlib missing" not in path.read_text()
+        assert [p.name for p in path.parent.iterdir()] == ["checkpoint.json"]
+    finally:
+        log_store._log_store = previous_store
+
+
+def test_missing_or_broken_checkpoint_is_ignored(tmp_path):
+    assert load_checkpoint(tmp_path / "checkpoint.json") is None
+    (tmp_path / "checkpoint.json").write_text("{\"iteration\": ")
+    assert load_checkpoint(tmp_path / "checkpoint.json") is None
+
+
+def _failed_checkpoint(**values) -> SessionCheckpoint:
+    failed = NixBuildResult(success=False, is_src_attr_only=False,
+                            error=NixError(type=NixErrorKind.BUILD_ERROR, error_message="make: *** Error 1"))
+    solution = Solution(code=PACKAGE, result=failed)
+    return SessionCheckpoint(project_url="https://github.com/example/hello", summary="A project",
+                             template_type="generic", store_path=None, best=solution, candidate=solution, **values)
+
+
+def test_resumed_session_counts_the_budget_spent_before(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(run, "coordinator_message", lambda message: None)
+    session.budget = Budget(max_tokens=1000, max_time=600)
+    checkpoint = _failed_checkpoint(iteration=2, total_cost=0.5, prompt_tokens=400, completion_tokens=100,
+                                    elapsed_time=300.0)
+    ccl_logger = init_logger(tmp_path / "run.ccl")
+    try:
+        run.resume_session(ccl_logger, checkpoint)
+    finally:
+        close_logger()
+    assert session.budget_exceeded() is None
+    session.add_usage(400, 100)
+    assert session.budget_exceeded().startswith("token budget of 1000 exhausted")
+    session.budget = Budget(max_time=600)
+    session.start_time -= 300
+    assert session.budget_exceeded().startswith("time budget of 600s exhausted")
+
+
+def test_stopped_session_saves_its_best_solution(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(run, "coordinator_error", lambda message: None)
+    monkeypatch.setattr(run, "coordinator_message", lambda message: None)
+    best = _failed_checkpoint().best
+    init_logger(tmp_path / "run.ccl")
+    reason = "cost budget of $1.00 exhausted ($1.0100 spent)"
+    assert run.finish_stopped_session(best, reason, 4, "https://github.com/example/hello", str(tmp_path)) is None
+
+    assert (tmp_path / "hello" / "package.nix").read_text() == PACKAGE
+    session_end = read_sections(tmp_path / "run.ccl")["session-end"]
+    assert session_end["success"] == "false"
+    assert session_end["stopped"] == reason
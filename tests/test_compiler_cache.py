@@ -0,0 +1,50 @@
+"""Tests for the persistent compiler cache configuration."""
+
+import json
+
+import pytest
+
+from vibenix import compiler_cache
+
+
+@pytest.fixture
+def cache_dir(session, tmp_path):
+    compiler_cache.init_compiler_cache(tmp_path / "cache")
+    return tmp_path / "cache"
+
+
+def test_disabled_by_default(session, tmp_path):
+    compiler_cache.write_flake_config(tmp_path)
+    assert not (tmp_path / compiler_cache.FLAKE_FILE).exists()
+    assert compiler_cache.nix_options() == []
+    assert compiler_cache.verification_attr() == "default"
+
+
+def test_enabled(cache_dir, tmp_path):
+    assert (cache_dir / "ccache").is_dir()
+    assert (cache_dir / "sccache").is_dir()
+
+    compiler_cache.write_flake_config(tmp_path)
+    assert (tmp_path / compiler_cache.FLAKE_FILE).read_text() == f'{{ dir = "{cache_dir}"; }}\n'
+    assert compiler_cache.nix_options() == ["--option", "extra-sandbox-paths", str(cache_dir)]
+    assert compiler_cache.verification_attr() == compiler_cache.UNCACHED_ATTR
+
+
+def test_stats_of_each_build_are_read_from_its_own_file(cache_dir, tmp_path):
+    derivations = {}
+    for name in ("hello", "world"):
+        derivations[name] = tmp_path / f"{name}.drv"
+        derivations[name].write_text(f'Derive([("out","/nix/store/0123-{name}-1.0","","")],[],[],"x86_64-linux")')
+    stats = {"stats": {"cache_hits": {"counts": {"Rust": 40, "C/C++": 2}, "adv_counts": {}},
+                       "cache_misses": {"counts": {"Rust": 3}, "adv_counts": {}}}}
+    sccache_file = cache_dir / compiler_cache.STATS_DIR / "0123-hello-1.0.sccache.json"
+    sccache_file.write_text(json.dumps(stats))
+
+    assert compiler_cache.read_stats(str(derivations["hello"])) == {"hits": 42, "misses": 3}
+    # A build running at the same time does not see them
+    assert compiler_cache.read_stats(str(derivations["world"])) is None
+    assert compiler_cache.read_stats(str(tmp_path / "missing.drv")) is None
+
+    compiler_cache.zero_stats(str(derivations["hello"]))
+    assert not sccache_file.exists()
+    assert compiler_cache.read_stats(str(derivations["hello"])) is None
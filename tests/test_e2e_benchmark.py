@@ -0,0 +1,57 @@
+"""Tests for the baseline comparison of the end-to-end benchmark."""
+
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "benchmarks" / "e2e"))
+
+from e2e_benchmark import NIX_CORPUS, compare_search, compare_to_baseline, read_corpus, recorded_sources
+
+
+def test_regressions_beyond_thresholds():
+    baseline = {
+        "thresholds": {"iterations": 0.0, "prompt_tokens": 0.1},
+        "projects": {"1": {"success": True, "iterations": 4, "prompt_tokens": 1000, "wall_time": 10.0}},
+    }
+    within = {"1": {"success": True, "iterations": 4, "prompt_tokens": 1100, "wall_time": 13.0}}
+    assert compare_to_baseline(within, baseline) == []
+
+    regressed = {"1": {"success": False, "iterations": 5, "prompt_tokens": 1101, "wall_time": 14.0}}
+    regressions = compare_to_baseline(regressed, baseline)
+    assert len(regressions) == 4
+    assert regressions[0] == "1: no longer succeeds"
+
+
+def test_corpus_is_frozen():
+    projects = read_corpus()
+    assert projects
+    assert len({project["issue_number"] for project in projects}) == len(projects)
+
+
+def test_recorded_sources(tmp_path):
+    def entry(operation, key, stdout, returncode=0):
+        return json.dumps({"operation": operation, "key": key, "duration": 0.1, "returncode": returncode,
+                           "stdout": stdout, "stderr": "", "timed_out": False})
+
+    (tmp_path / NIX_CORPUS).write_text("\n".join([
+        entry("prefetch", "https://github.com/user/hello", '{"hash": "sha256-abc"}'),
+        entry("source_store_path", "sha256-abc", "/nix/store/aaaa-source"),
+        entry("nixpkgs_source", "nixpkgs", "/nix/store/bbbb-source\n"),
+        entry("nixpkgs_source", "other", "", returncode=1),
+        entry("log", "/nix/store/cccc-hello.drv", "/nix/store/dddd-not-a-source"),
+    ]) + "\n")
+    assert recorded_sources(tmp_path) == ["/nix/store/aaaa-source", "/nix/store/bbbb-source"]
+
+
+def test_compare_search():
+    sequential = {"1": {"time_to_success": 600.0, "cost": 0.5}, "2": {"time_to_success": None, "cost": 1.0},
+                  "3": {"time_to_success": 100.0, "cost": 0.1}}
+    beam = {"1": {"time_to_success": 200.0, "cost": 1.5}, "2": {"time_to_success": 300.0, "cost": 2.0}}
+    comparison = compare_search(sequential, beam)
+    assert list(comparison) == ["1", "2"]
+    assert comparison["1"]["speedup"] == 3.0
+    assert comparison["1"]["search_cost"] == 1.5
+    # The beam succeeded where the sequential loop failed
+    assert comparison["2"]["speedup"] is None
+    assert comparison["2"]["search_time_to_success"] == 300.0
@@ -0,0 +1,127 @@
+"""Tests for phase-resumable incremental builds."""
+
+from unittest.mock import patch
+
+import pytest
+
+from vibenix import log_store
+from vibenix.incremental import IncrementalBuilder, phase_fingerprints
+
+PHASES = ["unpackPhase", "buildPhase", "installPhase"]
+
+
+def fake_dev_env(post_install: str = "true", build_flags: str = "") -> dict:
+    """A minimal stand-in for the output of `nix print-dev-env --json`."""
+    return {
+        "variables": {
+            "PATH": {"type": "exported", "value": "/usr/bin:/bin"},
+            "SHELL": {"type": "exported", "value": "/bin/bash"},
+            "outputs": {"type": "exported", "value": "out"},
+            "out": {"type": "exported", "value": "/nix/store/00000000000000000000000000000000-test"},
+            "buildFlags": {"type": "var", "value": build_flags},
+            "postInstall": {"type": "var", "value": post_install},
+        },
+        "bashFunctions": {
+            "definePhases": f"    phases='{' '.join(PHASES)}'\n",
+            "runPhase": (
+                "    echo \"Running phase: $1\"\n"
+                "    case $1 in\n"
+                "        unpackPhase) mkdir source; cd source ;;\n"
+                "        buildPhase) echo \"compiling $buildFlags\"; echo object > main.o ;;\n"
+                "        installPhase) mkdir -p $out; cp main.o $out/; eval \"$postInstall\" ;;\n"
+                "    esac\n"
+            ),
+        },
+    }
+
+
+@pytest.fixture
+def builder(session, tmp_path):
+    previous_store = log_store._log_store
+    log_store.init_log_store(tmp_path / "logs")
+    session.build_timeout = "60"
+    builder = IncrementalBuilder(tmp_path / "work")
+    yield builder
+    builder.cleanup()
+    log_store._log_store = previous_store
+
+
+def build(builder, dev_env):
+    with patch.object(builder, "_get_dev_env", return_value=(dev_env, None)):
+        result = builder.build("flake#default")
+    ran = (builder.work_dir / "completed").read_text().split()
+    return result, ran
+
+
+def test_fingerprints_only_change_from_affected_phase():
+    before = phase_fingerprints(fake_dev_env(), PHASES)
+    after = phase_fingerprints(fake_dev_env(post_install="echo changed"), PHASES)
+    assert before[:2] == after[:2]
+    assert before[2] != after[2]
+
+    rebuilt = phase_fingerprints(fake_dev_env(build_flags="-O2"), PHASES)
+    assert rebuilt[0] == before[0]
+    assert rebuilt[1:] != before[1:]
+
+
+def test_fingerprints_ignore_output_paths():
+    dev_env = fake_dev_env()
+    dev_env["variables"]["out"]["value"] = "/nix/store/11111111111111111111111111111111-test"
+    assert phase_fingerprints(dev_env, PHASES) == phase_fingerprints(fake_dev_env(), PHASES)
+
+
+@pytest.mark.parametrize("copy_on_write", [True, False])
+def test_resume_from_first_changed_phase(builder, copy_on_write):
+    builder._copy_on_write = copy_on_write
+    result, ran = build(builder, fake_dev_env())
+    assert result.success
+    assert ran == PHASES
+
+    result, ran = build(builder, fake_dev_env(post_install="echo changed"))
+    assert result.success
+    assert ran == ["installPhase"]
+    assert (builder.top / "outputs" / "out" / "main.o").exists()
+    trees = sorted(path.parent.name for path in builder.snapshots_dir.glob("*/tree"))
+    assert trees == (["0-unpackPhase", "1-buildPhase"] if copy_on_write else ["1-buildPhase"])
+
+    # Without copy-on-write, the tree after unpackPhase is gone
+    result, ran = build(builder, fake_dev_env(build_flags="-O2"))
+    assert result.success
+    assert ran == (["buildPhase", "installPhase"] if copy_on_write else PHASES)
+
+
+def test_multi_line_variables_are_restored(builder):
+    dev_env = fake_dev_env(post_install="cat > $out/notes <<< \"$notes\"")
+    dev_env["bashFunctions"]["runPhase"] += (
+        "    [[ $1 == buildPhase ]] && notes=$'first\\ndeclare -r injected=1\\nlast' || true\n")
+    result, ran = build(builder, dev_env)
+    assert result.success
+
+    dev_env["variables"]["postInstall"]["value"] = "cat > $out/notes <<< \"$notes\"; echo changed"
+    result, ran = build(builder, dev_env)
+    assert result.success
+    assert ran == ["installPhase"]
+    assert (builder.top / "outputs" / "out" / "notes").read_text() == "first\ndeclare -r injected=1\nlast\n"
+
+
+def test_failed_phase_is_rerun(builder):
+    result, ran = build(builder, fake_dev_env(post_install="echo 'install failed' >&2; false"))
+    assert not result.success
+    assert "install failed" in result.error.error_message
+    assert ran == ["unpackPhase", "buildPhase"]
+
+    result, ran = build(builder, fake_dev_env())
+    assert result.success
+    assert ran == ["installPhase"]
+
+
+def test_timed_out_build_keeps_the_log_of_its_phases(builder, session):
+    session.build_timeout = "1"
+    dev_env = fake_dev_env()
+    dev_env["bashFunctions"]["runPhase"] += "    [[ $1 == buildPhase ]] && sleep 30 || true\n"
+    result, ran = build(builder, dev_env)
+    assert not result.success
+    log = result.error.error_message
+    assert "Running phase: unpackPhase" in log and "compiling" in log
+    assert log.endswith("error: build timed out after 1 seconds")
+    assert ran == ["unpackPhase"]
@@ -0,0 +1,59 @@
+"""Tests for the build directories kept for failed builds."""
+
+from vibenix.errors import NixBuildResult, NixError, NixErrorKind
+from vibenix.nix import _find_kept_build_dir, cleanup_kept_build, cleanup_kept_builds
+from vibenix.packaging_flow import run
+
+
+def _kept_build(tmp_path, name: str) -> NixBuildResult:
+    build_dir = tmp_path / name
+    (build_dir / "source").mkdir(parents=True)
+    (build_dir / "source" / "config.log").write_text("checking for zlib... no\n")
+    return NixBuildResult(success=False, is_src_attr_only=False, kept_build_dir=str(build_dir),
+                          error=NixError(type=NixErrorKind.BUILD_ERROR, error_message="make: *** Error 1"))
+
+
+def test_find_kept_build_dir_keeps_only_the_last_one(tmp_path):
+    dependency_dir = tmp_path / "nix-build-dep.drv-0"
+    dependency_dir.mkdir()
+    stderr = (f"note: keeping build directory '{dependency_dir}'\n"
+              "error: builder for '/nix/store/dep.drv' failed\n"
+              f"note: keeping build directory '{tmp_path}/nix-build-hello.drv-0'\n")
+    assert _find_kept_build_dir(stderr) == f"{tmp_path}/nix-build-hello.drv-0"
+    # The directory of the failed dependency is of no use to the model
+    assert not dependency_dir.exists()
+    assert _find_kept_build_dir("error: builder failed\n") is None
+
+
+def test_cleanup_kept_build(tmp_path):
+    result = _kept_build(tmp_path, "nix-build-hello.drv-0")
+    cleanup_kept_build(result)
+    assert not (tmp_path / "nix-build-hello.drv-0").exists()
+    assert result.kept_build_dir is None
+    # Cleaning up twice, or a directory that is already gone, is fine
+    cleanup_kept_build(result)
+    result.kept_build_dir = str(tmp_path / "missing")
+    cleanup_kept_build(result)
+
+
+def test_best_build_directory_is_kept_until_it_is_replaced(session, tmp_path, monkeypatch):
+    monkeypatch.setattr(run, "coordinator_message", lambda message: None)
+    best = _kept_build(tmp_path, "best")
+    other = _kept_build(tmp_path, "other")
+    session.error_stack.extend([best, other])
+
+    # Several fixes of the best build can browse its directory
+    for _ in range(2):
+        with run.kept_build_functions(best) as build_functions:
+            assert build_functions
+        assert (tmp_path / "best").is_dir()
+
+    cleanup_kept_builds(keep=best)
+    assert (tmp_path / "best").is_dir()
+    assert not (tmp_path / "other").exists()
+    assert other.kept_build_dir is None
+
+    cleanup_kept_builds()
+    assert not (tmp_path / "best").exists()
+    with run.kept_build_functions(best) as build_functions:
+        assert build_functions == []
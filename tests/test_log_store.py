@@ -0,0 +1,82 @@
+"""Tests for the content-addressed build log store."""
+
+import os
+import time
+
+import pytest
+
+from vibenix import log_store
+from vibenix.log_store import LogStore, init_log_store
+from vibenix.errors import NixError, NixErrorKind
+
+
+@pytest.fixture
+def store(tmp_path):
+    """Use a temporary directory as the global log store."""
+    previous = log_store._log_store
+    yield init_log_store(tmp_path)
+    log_store._log_store = previous
+
+
+class TestLogStore:
+    """Tests for LogStore."""
+
+    def test_put_and_get_roundtrip(self, tmp_path):
+        store = LogStore(tmp_path)
+        text = "line 1\nline 2\nerror: something failed\n"
+        key = store.put(text)
+        assert store.get(key) == text
+        assert key in store
+
+    def test_put_is_content_addressed(self, tmp_path):
+        store = LogStore(tmp_path)
+        assert store.put("same log") == store.put("same log")
+        assert store.put("same log") != store.put("other log")
+        assert len(list(tmp_path.rglob("*.zst"))) == 2
+
+    def test_store_is_shared_between_instances(self, tmp_path):
+        key = LogStore(tmp_path).put("shared log")
+        assert LogStore(tmp_path).get(key) == "shared log"
+
+    def test_get_unknown_key(self, tmp_path):
+        with pytest.raises(KeyError):
+            LogStore(tmp_path).get("0" * 64)
+
+    def test_collect_garbage_removes_old_and_least_recently_used_logs(self, tmp_path):
+        store = LogStore(tmp_path, cache_size=0)
+        keys = [store.put(f"log {i}\n" * 1000) for i in range(4)]
+        now = time.time()
+        for age, key in zip([40, 30, 20, 10], keys):
+            os.utime(store._path_for(key), (now - age, now - age))
+        # Reading or storing a log again marks it as used
+        store.get(keys[0])
+        store.put("log 1\n" * 1000)
+
+        assert store.collect_garbage(max_age=15) == 1
+        assert [key in store for key in keys] == [True, True, False, True]
+
+        size = sum(store._path_for(key).stat().st_size for key in keys[:2])
+        assert store.collect_garbage(max_size=size) == 1
+        assert [key in store for key in keys] == [True, True, False, False]
+        assert store.collect_garbage() == 0
+
+
+class TestNixErrorLogReference:
+    """Tests for NixError keeping only a reference to its log."""
+
+    def test_error_message_is_stored(self, store):
+        log = "\n".join(f"line {i}" for i in range(1000))
+        error = NixError(type=NixErrorKind.BUILD_ERROR, error_message=log)
+        assert error.log_ref in store
+        assert error.line_count == 1000
+        assert error.summary.endswith("line 999")
+        assert error.error_message == log
+        assert "error_message" not in error.model_dump()
+
+    def test_truncated_keeps_tail(self, store):
+        log = "\n".join(f"line {i}" for i in range(300))
+        error = NixError(type=NixErrorKind.BUILD_ERROR, error_message=log)
+        truncated = error.truncated(10)
+        assert truncated.startswith("... (290 lines omitted) ...")
+        assert truncated.endswith("line 299")
+        assert error.truncated(300) == log
@@ -0,0 +1,67 @@
+"""Tests for routing prompts to the models of the configuration."""
+
+import json
+
+import pytest
+
+from vibenix.session import PROMPT_METADATA_KEY, ROUTED_METADATA_KEY
+from vibenix.ui import model_config
+from vibenix.ui.model_config import FAST_PROMPTS, PROVIDERS, prompt_models_from_config, save_configuration
+
+
+@pytest.fixture
+def litellm_model(monkeypatch):
+    monkeypatch.setenv("MAGENTIC_BACKEND", "litellm")
+    monkeypatch.setenv("MAGENTIC_LITELLM_MODEL", "claude-sonnet-4-20250514")
+    monkeypatch.setenv("MAGENTIC_LITELLM_API_BASE", "http://localhost:4000")
+
+
+def test_fast_model_routes_fast_prompts_and_overrides_win():
+    prompt_models = prompt_models_from_config({
+        "model": "claude-sonnet-4-20250514",
+        "fast_model": "claude-3-5-haiku-20241022",
+        "prompt_models": {"evaluate_code": "gpt-4o-mini", "fix_build_error": "o3"},
+    })
+    assert set(prompt_models) == set(FAST_PROMPTS) | {"fix_build_error"}
+    assert prompt_models["pick_template"] == "claude-3-5-haiku-20241022"
+    assert prompt_models["evaluate_code"] == "gpt-4o-mini"
+    assert prompt_models["fix_build_error"] == "o3"
+    assert prompt_models_from_config({"model": "claude-sonnet-4-20250514"}) == {}
+
+
+def test_chat_model_uses_the_model_of_the_prompt(session, litellm_model, monkeypatch):
+    monkeypatch.setattr(model_config, "_prompt_models", {"pick_template": "claude-3-5-haiku-20241022"})
+
+    routed = session.chat_model(prompt="pick_template")
+    assert routed.model == "claude-3-5-haiku-20241022"
+    assert routed.api_base is None
+    assert routed.metadata[PROMPT_METADATA_KEY] == "pick_template"
+    assert routed.metadata[ROUTED_METADATA_KEY] is True
+
+    default = session.chat_model(prompt="fix_build_error")
+    assert default.model == "claude-sonnet-4-20250514"
+    assert default.api_base == "http://localhost:4000"
+    assert default.metadata[ROUTED_METADATA_KEY] is False
+
+
+def test_saving_the_model_keeps_the_routes(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(model_config, "_prompt_models", None)
+    config_file = tmp_path / ".vibenix" / "config.json"
+    config_file.parent.mkdir()
+    config_file.write_text(json.dumps({
+        "provider": "anthropic",
+        "model": "claude-sonnet-4-20250514",
+        "backend": "litellm",
+        "fast_model": "claude-3-5-haiku-20241022",
+    }))
+
+    openai = next(provider for provider in PROVIDERS if provider.name == "openai")
+    save_configuration(openai, "gpt-4o")
+
+    config_data = json.loads(config_file.read_text())
+    assert config_data["model"] == "gpt-4o"
+    assert config_data["fast_model"] == "claude-3-5-haiku-20241022"
+    # Worker processes read the routes on first use
+    assert model_config.model_for_prompt("evaluate_progress") == "claude-3-5-haiku-20241022"
+    assert model_config.model_for_prompt("refine_code") is None
@@ -0,0 +1,146 @@
+"""Tests for recording and simulating the Nix operations of a session."""
+
+import json
+import subprocess
+
+import pytest
+
+from vibenix import function_calls, process
+from vibenix.ccl_log import close_logger, init_logger
+from vibenix.errors import NixErrorKind
+from vibenix.nix import invoke_build, invoke_batch_build
+from vibenix.parsing import fill_src_attributes
+from vibenix.nix_backend import NixBackend, RecordingNixBackend, SimulatedNixBackend
+from vibenix.process import ProcessResult
+
+DERIVATION = "/nix/store/0123456789abcdef0123456789abcdef-hello-1.0.drv"
+
+
+class FakeNixBackend(NixBackend):
+    """Evaluates everything to the same derivation, whose build fails."""
+
+    def __init__(self):
+        self.calls = []
+
+    def _result(self, operation, returncode=0, stdout="", stderr=""):
+        self.calls.append(operation)
+        return ProcessResult([operation], returncode, stdout, stderr, 0.0)
+
+    def evaluate(self, target_attr, timeout=None):
+        return self._result("evaluate", stdout=DERIVATION + "\n")
+
+    def build(self, installables, options=(), keep_going=False, keep_failed=False):
+        return self._result("build", returncode=1, stderr="error: builder failed")
+
+    def outputs_valid(self, installable):
+        self.calls.append("outputs_valid")
+        return False
+
+    def log(self, installable):
+        return self._result("log", stdout="make: *** [Makefile:12: all] Error 1\n")
+
+    def prefetch(self, url, revision=None):
+        return self._result("prefetch", stdout="fetchFromGitHub { }")
+
+    def source_store_path(self, source_hash):
+        self.calls.append("source_store_path")
+        return "/nix/store/source"
+
+    def nixpkgs_source(self, template_dir):
+        return self._result("nixpkgs_source", stdout="/nix/store/nixpkgs\n")
+
+
+@pytest.fixture
+def flake_dir(tmp_path):
+    flake = tmp_path / "flake"
+    flake.mkdir()
+    (flake / "package.nix").write_text("{ stdenv }: stdenv.mkDerivation { pname = \"hello\"; }\n")
+    return flake
+
+
+def test_simulation_replays_recorded_build(session, tmp_path, flake_dir):
+    corpus = tmp_path / "corpus.jsonl"
+    fake = FakeNixBackend()
+    session.nix_backend = RecordingNixBackend(corpus, fake)
+    recorded = invoke_build(False, flake_dir=flake_dir)
+    assert fake.calls == ["evaluate", "build", "log"]
+    assert [json.loads(line)["operation"] for line in corpus.read_text().splitlines()] == ["evaluate", "build", "log"]
+
+    session.nix_backend = SimulatedNixBackend([corpus], time_scale=0)
+    replayed = invoke_build(False, flake_dir=flake_dir)
+    assert fake.calls == ["evaluate", "build", "log"]
+    assert replayed.error.type == recorded.error.type == NixErrorKind.BUILD_ERROR
+    assert replayed.error.error_message == recorded.error.error_message
+    assert replayed.derivation_path == DERIVATION
+    assert session.nix_backend.misses == 0
+
+
+def test_simulation_fails_unknown_code(session, tmp_path, flake_dir):
+    session.nix_backend = SimulatedNixBackend([], time_scale=0)
+    result = invoke_build(False, flake_dir=flake_dir)
+    assert not result.success
+    assert result.error.type == NixErrorKind.BUILD_ERROR
+    assert result.derivation_path.endswith("-simulated.drv")
+
+    # Different code evaluates to a different derivation
+    (flake_dir / "package.nix").write_text("{ stdenv }: stdenv.mkDerivation { pname = \"other\"; }\n")
+    assert invoke_build(False, flake_dir=flake_dir).derivation_path != result.derivation_path
+
+
+def test_simulation_replays_timeouts(session, tmp_path, flake_dir):
+    corpus = tmp_path / "corpus.jsonl"
+    session.nix_backend = RecordingNixBackend(corpus, FakeNixBackend())
+    invoke_build(False, flake_dir=flake_dir)
+    entries = [json.loads(line) for line in corpus.read_text().splitlines()]
+    entries[0]["duration"] = 3600
+    corpus.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+
+    session.nix_backend = SimulatedNixBackend([corpus], time_scale=0)
+    result = invoke_build(False, flake_dir=flake_dir)
+    assert result.error.type == NixErrorKind.EVAL_ERROR
+    assert "timed out" in result.error.error_message
+
+
+class SlowNixBackend(FakeNixBackend):
+    """Times out on every query."""
+
+    def outputs_valid(self, installable):
+        raise subprocess.TimeoutExpired(["nix", "path-info"], 60)
+
+    def log(self, installable):
+        raise subprocess.TimeoutExpired(["nix", "log"], 60)
+
+    def source_store_path(self, source_hash):
+        raise subprocess.TimeoutExpired(["nix-store"], 60)
+
+
+def test_query_timeouts_fail_the_build_not_the_session(session, flake_dir, tmp_path):
+    session.nix_backend = SlowNixBackend()
+    result = invoke_build(False, flake_dir=flake_dir)
+    assert result.error.type == NixErrorKind.BUILD_ERROR
+    assert result.error.error_message == "error: builder failed"
+
+    other_flake = tmp_path / "other"
+    other_flake.mkdir()
+    (other_flake / "package.nix").write_text((flake_dir / "package.nix").read_text())
+    results = invoke_batch_build([flake_dir, other_flake])
+    assert [result.error.error_message for result in results] == ["error: builder failed"] * 2
+
+    fetcher = 'fetchFromGitHub {\n  owner = "user";\n  repo = "hello";\n  rev = "v1.0";\n  hash = "sha256-AAAA";\n}'
+    code, store_path = fill_src_attributes("{ pname = ...; version = ...; src = fetchFromGitHub { }; }", fetcher)
+    assert 'pname = "hello"' in code
+    assert store_path is None
+
+
+def test_tool_timeout_is_reported_to_the_model(session, monkeypatch, tmp_path):
+    init_logger(tmp_path / "run.ccl")
+    def run(args, **kwargs):
+        if args[0] == "jq":
+            raise subprocess.TimeoutExpired(args, kwargs["timeout"])
+        return process.ProcessResult(args, 0, '{"legacyPackages.x86_64-linux.hello": {}}', "", 0.0)
+
+    monkeypatch.setattr(process, "run", run)
+    try:
+        assert "timed out" in function_calls.search_nixpkgs_for_package("hello")
+    finally:
+        close_logger()
@@ -0,0 +1,90 @@
+"""Tests for the subprocess layer."""
+
+import asyncio
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+from vibenix import process
+from vibenix.process import ProcessCancelled
+
+
+def wait_until_gone(pid_file, timeout=10):
+    """Wait for the process whose pid is in `pid_file` to exit, return whether it did."""
+    deadline = time.monotonic() + timeout
+    while not pid_file.exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    pid = int(pid_file.read_text())
+    while time.monotonic() < deadline:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def background_sleep(pid_file):
+    """A shell that leaves a grandchild running, which only dies if the whole process group is killed."""
+    return ["sh", "-c", f"sleep 60 & echo $! > {pid_file}; wait"]
+
+
+def test_run_captures_output_and_records_stats(session):
+    result = process.run(["sh", "-c", "echo out; echo err >&2; exit 3"])
+    assert (result.returncode, result.stdout, result.stderr) == (3, "out\n", "err\n")
+    assert result.duration >= 0
+    assert process.run(["cat"], input="piped").stdout == "piped"
+    # More than fits into a pipe, so the input is written while the output is read
+    assert process.run(["cat"], input="x" * 1_000_000).stdout == "x" * 1_000_000
+    assert process.run(["sh", "-c", "echo a; echo b >&2"], merge_stderr=True).stdout == "a\nb\n"
+
+    stats = session.process_stats
+    assert (stats["sh"].calls, stats["sh"].failures) == (2, 1)
+    assert stats["cat"].calls == 2
+
+
+def test_check_raises_called_process_error(session):
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        process.run(["sh", "-c", "echo failed >&2; exit 1"], check=True)
+    assert error.value.stderr == "failed\n"
+
+
+def test_timeout_kills_process_group(session, tmp_path):
+    pid_file = tmp_path / "pid"
+    with pytest.raises(subprocess.TimeoutExpired) as error:
+        process.run(["sh", "-c", f"echo started; echo warning >&2; {background_sleep(pid_file)[-1]}"], timeout=0.5)
+    assert wait_until_gone(pid_file)
+    # The output until the timeout is kept
+    assert (error.value.output, error.value.stderr) == (b"started\n", b"warning\n")
+    assert session.process_stats["sh"].timeouts == 1
+    assert not session.process_groups
+
+
+def test_cancelled_session_kills_running_commands(session, tmp_path):
+    pid_file = tmp_path / "pid"
+    threading.Timer(0.5, session.cancel).start()
+    with pytest.raises(ProcessCancelled):
+        process.run(background_sleep(pid_file))
+    assert wait_until_gone(pid_file)
+    with pytest.raises(ProcessCancelled):
+        process.run(["true"])
+
+
+def test_cancelled_task_kills_process_group(session, tmp_path):
+    pid_file = tmp_path / "pid"
+
+    async def main():
+        task = asyncio.create_task(process.run_async(background_sleep(pid_file)))
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        # Blocking calls work inside of an event loop as well
+        return process.run(["echo", "still works"]).stdout
+
+    assert asyncio.run(main()) == "still works\n"
+    assert wait_until_gone(pid_file)
+    assert session.process_stats["sh"].cancelled == 1
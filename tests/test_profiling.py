@@ -0,0 +1,31 @@
+"""Tests for the profiling mode of a session."""
+
+import threading
+
+from vibenix.profiling import ALLOCATIONS_REPORT, PROFILE_REPORT, PROFILE_STACKS, profile_session
+
+
+def _busy_work(stop: threading.Event):
+    values = []
+    while not stop.is_set():
+        values.append(sum(i * i for i in range(1000)))
+
+
+def test_profile_session(tmp_path):
+    stop = threading.Event()
+    with profile_session(tmp_path) as profiler:
+        worker = threading.Thread(target=_busy_work, args=(stop,), name="busy")
+        worker.start()
+        allocated = [bytearray(1024) for _ in range(1000)]
+        stop.wait(0.3)
+        stop.set()
+        worker.join()
+
+    assert profiler.samples > 0
+    stacks = (tmp_path / PROFILE_STACKS).read_text().splitlines()
+    assert any(line.startswith("busy;") and "_busy_work (" in line for line in stacks)
+    assert "_busy_work" in (tmp_path / PROFILE_REPORT).read_text()
+    allocations = (tmp_path / ALLOCATIONS_REPORT).read_text()
+    assert allocations.startswith("Peak traced memory:")
+    assert "test_profiling.py" in allocations
+    assert len(allocated) == 1000
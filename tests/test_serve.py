@@ -0,0 +1,189 @@
+"""Tests for the HTTP job service."""
+
+import json
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import pytest
+
+from vibenix.batch import PackagingRequest
+from vibenix.process import ProcessCancelled
+from vibenix.serve import (ERROR, FAILED, MAX_JOB_ERRORS, QUEUED, RUNNING, SUCCEEDED, JobQueue, JobService,
+                           ServiceHTTPServer)
+
+PACKAGE = "{ stdenv }: stdenv.mkDerivation { pname = \"hello\"; }\n"
+
+
+def test_queue_persists_jobs_and_requeues_running_ones(tmp_path):
+    queue = JobQueue(tmp_path / "jobs.sqlite")
+    first = queue.submit("https://github.com/user/first")
+    second = queue.submit("https://github.com/user/second", "v1.0")
+    assert first["status"] == QUEUED and second["revision"] == "v1.0"
+    assert queue.claim()["id"] == first["id"]
+    queue.finish(first["id"], {"success": True, "iterations": 2})
+    assert queue.claim()["id"] == second["id"]
+    assert queue.claim() is None
+    queue.close()
+
+    # The service stopped while the second job was running
+    queue = JobQueue(tmp_path / "jobs.sqlite")
+    assert queue.get(first["id"])["status"] == SUCCEEDED
+    assert queue.get(first["id"])["result"] == {"success": True, "iterations": 2}
+    assert queue.get(second["id"])["status"] == RUNNING
+    assert queue.requeue_running() == 1
+    assert queue.claim()["id"] == second["id"]
+    assert [job["id"] for job in queue.latest()] == [second["id"], first["id"]]
+    queue.close()
+
+
+class FakeSessions:
+    """Runs sessions that write a CCL log, and a package for projects named `good`."""
+
+    def __init__(self):
+        self.release = threading.Event()
+
+    def __call__(self, request: PackagingRequest, output_dir: Path, budget=None) -> dict:
+        request_dir = output_dir / request.issue_number
+        request_dir.mkdir(parents=True)
+        with open(request_dir / "run.ccl", "w", buffering=1) as log:
+            log.write("session-start =\n  elapsed = 00:00:00.000\n")
+            self.release.wait(timeout=10)
+            success = request.repo_url.endswith("/good")
+            if success:
+                (request_dir / "hello").mkdir()
+                (request_dir / "hello" / "package.nix").write_text(PACKAGE)
+            log.write(f"session-end =\n  success = {str(success).lower()}\n")
+        return {"issue_number": request.issue_number, "repo_url": request.repo_url, "success": success,
+                "error": None if success else "packaging failed"}
+
+
+@pytest.fixture
+def service(tmp_path):
+    sessions = FakeSessions()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        service = JobService(JobQueue(tmp_path / "jobs.sqlite"), tmp_path / "jobs", executor, workers=2,
+                             run=sessions)
+        server = ServiceHTTPServer(("127.0.0.1", 0), service)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        service.start()
+        server_thread.start()
+        service.url = f"http://127.0.0.1:{server.server_address[1]}"
+        service.sessions = sessions
+        yield service
+        sessions.release.set()
+        server.shutdown()
+        server.server_close()
+        service.stop()
+
+
+def _request(url: str, data: dict = None):
+    body = json.dumps(data).encode() if data is not None else None
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status, response.read().decode()
+
+
+def _wait_for(service, job_id: int, statuses) -> dict:
+    for _ in range(200):
+        job = service.queue.get(job_id)
+        if job["status"] in statuses:
+            return job
+        threading.Event().wait(0.05)
+    raise AssertionError(f"job {job_id} is still {job['status']}")
+
+
+def test_submit_poll_follow_and_fetch_package(service):
+    status, body = _request(f"{service.url}/jobs", {"repo_url": "https://github.com/user/good"})
+    assert status == 201
+    good = json.loads(body)
+    _, body = _request(f"{service.url}/jobs", {"repo_url": "https://github.com/user/bad"})
+    bad = json.loads(body)
+    _wait_for(service, bad["id"], {RUNNING})
+
+    # Following the events of a running job ends when it finishes
+    events = []
+    follower = threading.Thread(target=lambda: events.extend(
+        json.loads(line) for line in _request(f"{service.url}/jobs/{good['id']}/events")[1].splitlines()))
+    follower.start()
+    service.sessions.release.set()
+    follower.join(timeout=10)
+    assert {"path": ["session-end"], "key": "success", "value": "true"} in events
+    assert events[0] == {"path": [], "key": "session-start", "value": None}
+
+    assert _wait_for(service, good["id"], {SUCCEEDED})["result"]["success"]
+    assert _wait_for(service, bad["id"], {FAILED})["result"]["error"] == "packaging failed"
+    _, body = _request(f"{service.url}/jobs/{good['id']}")
+    assert json.loads(body)["status"] == SUCCEEDED
+    _, body = _request(f"{service.url}/jobs")
+    assert [job["id"] for job in json.loads(body)] == [bad["id"], good["id"]]
+    assert _request(f"{service.url}/jobs/{good['id']}/package.nix") == (200, PACKAGE)
+
+    with pytest.raises(urllib.error.HTTPError) as error:
+        _request(f"{service.url}/jobs/{bad['id']}/package.nix")
+    assert error.value.code == 404
+
+
+def test_invalid_requests_are_rejected(service):
+    with pytest.raises(urllib.error.HTTPError) as error:
+        _request(f"{service.url}/jobs", {"revision": "v1.0"})
+    assert error.value.code == 400
+    with pytest.raises(urllib.error.HTTPError) as error:
+        _request(f"{service.url}/jobs/42")
+    assert error.value.code == 404
+    assert service.queue.latest() == []
+
+
+def test_cancelled_jobs_free_their_worker_and_continue_on_the_next_start(tmp_path):
+    started = []
+
+    def cancelled_session(request: PackagingRequest, output_dir: Path, budget=None) -> dict:
+        started.append(request.issue_number)
+        raise ProcessCancelled("service stopped")
+
+    queue = JobQueue(tmp_path / "jobs.sqlite")
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        service = JobService(queue, tmp_path / "jobs", executor, workers=1, run=cancelled_session)
+        service.start()
+        jobs = [service.submit(f"https://github.com/user/project{number}") for number in range(2)]
+        # The second job only starts if the first one gave its worker slot back
+        for _ in range(200):
+            if len(started) == 2:
+                break
+            threading.Event().wait(0.05)
+        service.stop()
+    assert started == [str(job["id"]) for job in jobs]
+    assert [queue.get(job["id"])["status"] for job in jobs] == [RUNNING, RUNNING]
+    assert queue.get(jobs[0]["id"])["result"] is None
+    assert queue.requeue_running() == 2
+
+
+def test_jobs_whose_worker_died_are_queued_again_until_they_error(tmp_path):
+    runs = {}
+
+    def crashing_session(request: PackagingRequest, output_dir: Path, budget=None) -> dict:
+        runs[request.repo_url] = runs.get(request.repo_url, 0) + 1
+        if request.repo_url.endswith("/oom") or runs[request.repo_url] == 1:
+            raise BrokenProcessPool("a worker died")
+        return {"issue_number": request.issue_number, "repo_url": request.repo_url, "success": True}
+
+    class BrokenExecutor(ThreadPoolExecutor):
+        def submit(self, *args, **kwargs):
+            raise BrokenProcessPool("a worker died")
+
+    service = JobService(JobQueue(tmp_path / "jobs.sqlite"), tmp_path / "jobs", BrokenExecutor(), workers=1,
+                         run=crashing_session, new_executor=lambda: ThreadPoolExecutor(max_workers=1))
+    service.start()
+    oom = service.submit("https://github.com/user/oom")
+    flaky = service.submit("https://github.com/user/flaky")
+    oom = _wait_for(service, oom["id"], {ERROR})
+    flaky = _wait_for(service, flaky["id"], {SUCCEEDED})
+    service.stop()
+    service.executor.shutdown()
+
+    assert runs == {"https://github.com/user/oom": MAX_JOB_ERRORS, "https://github.com/user/flaky": 2}
+    assert oom["errors"] == MAX_JOB_ERRORS and oom["result"]["error"] == "BrokenProcessPool: a worker died"
+    assert flaky["errors"] == 1 and flaky["result"]["success"]
@@ -0,0 +1,94 @@
+"""Tests for running several packaging sessions in one process."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from litellm import ModelResponse, Usage
+
+from vibenix.ccl_log import init_logger, get_logger, close_logger
+from vibenix.errors import NixBuildResult
+from vibenix.packaging_flow.model_prompts import EndStreamLogger
+from vibenix.session import PROMPT_METADATA_KEY, SESSION_ID_METADATA_KEY, Session, get_session, run_in_session, submit_in_session, use_session
+from vibenix.ui.conversation import TerminalUIAdapter, get_ui_adapter, set_ui_adapter
+from vibenix.usage import Budget
+
+
+def test_concurrent_sessions_do_not_share_state(tmp_path):
+    sessions = [Session(), Session()]
+    barrier = threading.Barrier(len(sessions))
+    seen = {}
+
+    def run(name: str):
+        adapter = TerminalUIAdapter()
+        set_ui_adapter(adapter)
+        init_logger(tmp_path / f"{name}.ccl")
+        # Both sessions are running at this point
+        barrier.wait()
+        get_logger().log_session_start(name)
+        get_session().error_stack.append(NixBuildResult(success=True, is_src_attr_only=False))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            in_worker = submit_in_session(executor, get_session).result()
+        seen[name] = (get_session(), get_ui_adapter() is adapter, in_worker)
+        close_logger()
+
+    threads = [threading.Thread(target=run_in_session, args=(session, run, f"session{i}"))
+               for i, session in enumerate(sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for i, session in enumerate(sessions):
+        current, own_adapter, in_worker = seen[f"session{i}"]
+        assert current is session
+        assert in_worker is session
+        assert own_adapter
+        assert len(session.error_stack) == 1
+        assert session.ccl_logger is None
+        assert f"session{i}" in (tmp_path / f"session{i}.ccl").read_text()
+        assert f"session{1 - i}" not in (tmp_path / f"session{i}.ccl").read_text()
+    assert sessions[0].flake_dir != sessions[1].flake_dir
+    for session in sessions:
+        session.close()
+        assert not session.flake_dir.exists()
+
+
+def _success_event(cost_logger, metadata, cost, prompt_tokens=100, completion_tokens=20):
+    start_time = datetime(2025, 1, 1, 12, 0, 0)
+    response = ModelResponse(model="vibenix-test-model", usage=Usage(
+        prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens))
+    kwargs = {"litellm_params": {"metadata": metadata}, "model": "vibenix-test-model", "stream": True,
+              "response_cost": cost, "completion_start_time": start_time + timedelta(seconds=0.5)}
+    cost_logger.log_success_event(kwargs, response, start_time, start_time + timedelta(seconds=2))
+
+
+def test_costs_are_attributed_by_request_metadata():
+    cost_logger = EndStreamLogger()
+    first, second = Session(), Session()
+    # Callbacks run on litellm threads, outside of the session that made the request
+    _success_event(cost_logger, {SESSION_ID_METADATA_KEY: first.session_id, PROMPT_METADATA_KEY: "fix_build_error"}, 1.5)
+    _success_event(cost_logger, {SESSION_ID_METADATA_KEY: second.session_id}, 0.25)
+    with use_session(second):
+        _success_event(cost_logger, {}, 0.25)
+
+    assert first.total_cost == 1.5
+    assert second.total_cost == 0.5
+    assert cost_logger.total_cost == 2.0
+    assert (first.prompt_tokens, first.completion_tokens) == (100, 20)
+    usage = first.usage.by_prompt["fix_build_error"]
+    assert (usage.calls, usage.cost, usage.total_latency) == (1, 1.5, 2.0)
+    assert second.usage.by_prompt["unknown"].calls == 2
+    first.close()
+    second.close()
+
+
+def test_budget_is_exceeded():
+    session = Session(budget=Budget(max_cost=1.0, max_tokens=1000))
+    assert session.budget_exceeded() is None
+    session.add_usage(900, 100)
+    assert session.budget_exceeded().startswith("token budget of 1000 exhausted")
+    session.close()
+    assert Budget(max_cost=1.0).exceeded(1.25, 0, 0.0) == "cost budget of $1.00 exhausted ($1.2500 spent)"
+    assert Budget(max_time=60).exceeded(0.0, 0, 59.0) is None
@@ -0,0 +1,40 @@
+"""Tests that starting vibenix does not load the heavy libraries before a mode is chosen."""
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+SRC_DIR = Path(__file__).parent.parent / "src"
+
+# Libraries that take most of the start-up time when they are imported
+HEAVY_MODULES = ["litellm", "magentic", "textual", "magika", "bs4", "git", "diskcache", "requests"]
+
+
+def _loaded_heavy_modules(code: str) -> list:
+    """The heavy modules that are imported after running `code` in a fresh interpreter."""
+    script = f"""
+import json, sys
+try:
+{chr(10).join("    " + line for line in code.splitlines())}
+except SystemExit:
+    pass
+print(json.dumps(sorted(name for name in {HEAVY_MODULES!r} if name in sys.modules)))
+"""
+    result = subprocess.run([sys.executable, "-c", script], cwd=SRC_DIR, capture_output=True, text=True,
+                            check=True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+@pytest.mark.parametrize("code", [
+    "import vibenix.main",
+    "import vibenix.batch",
+    "import vibenix.stats",
+    "import vibenix.serve",
+    "import vibenix.parsing",
+    "import sys, vibenix.main\nsys.argv = ['vibenix', '--help']\nvibenix.main.main()",
+])
+def test_startup_does_not_import_heavy_modules(code):
+    assert _loaded_heavy_modules(code) == []
@@ -0,0 +1,105 @@
+"""Tests for the CCL log reader and the aggregation of `vibenix stats`."""
+
+import csv
+
+from vibenix.ccl_log import close_logger, init_logger, span
+from vibenix.ccl_reader import read_sections, stage_times, summarize_session
+from vibenix.stats import main, percentile
+
+
+def _write_log(ccl_file, elapsed, success, iterations, cost, template="generic", project="https://github.com/user/repo"):
+    ccl_file.write_text(
+        "start_time = 2025-01-01T00:00:00\n"
+        "\n"
+        "session-start =\n"
+        "  elapsed = 00:00:01.000\n"
+        f"  project_url = {project}\n"
+        "template-selected =\n"
+        "  event = selected\n"
+        "  elapsed = 00:00:04.500\n"
+        f"  name = {template}\n"
+        "initial-build =\n"
+        "  result = build_error\n"
+        "  elapsed = 00:01:04.500\n"
+        "iteration =\n"
+        "  = 1 =\n"
+        "    function_call =\n"
+        "      elapsed = 00:01:10.000\n"
+        "      name = search_nixpkgs_for_package\n"
+        "      query = zlib\n"
+        "    elapsed = 00:02:00.000\n"
+        "session-end =\n"
+        f"  elapsed = {elapsed}\n"
+        f"  success = {success}\n"
+        f"  total_iterations = {iterations}\n"
+        f"  total_cost = {cost}\n"
+    )
+
+
+def test_stage_times_from_ccl(tmp_path):
+    ccl_file = tmp_path / "run.ccl"
+    _write_log(ccl_file, "01:01:04.500", "true", 3, 0.5)
+    sections = read_sections(ccl_file)
+    assert sections["session-end"]["total_iterations"] == "3"
+    assert stage_times(sections) == {"analysis_time": 3.5, "initial_build_time": 60.0, "fix_loop_time": 3600.0}
+
+    summary = summarize_session(ccl_file)
+    assert summary.success is True
+    assert summary.template == "generic"
+    assert summary.wall_time == 3664.5
+    assert summary.tool_calls == {"search_nixpkgs_for_package": 1}
+
+
+def test_tool_calls_from_spans(session, tmp_path):
+    ccl_file = tmp_path / "run.ccl"
+    logger = init_logger(ccl_file)
+    logger.log_session_start("https://github.com/user/repo")
+    logger.log_before_iterations()
+    logger.log_iteration_start(1)
+    with span("model", prompt="fix_build_error"):
+        for function in ["read_build_log", "read_build_log", "search_nix_functions"]:
+            with span("tool", function=function):
+                logger.log_function_call(function)
+    logger.log_session_end(False, 1)
+    close_logger()
+
+    summary = summarize_session(ccl_file)
+    assert summary.success is False
+    assert summary.iterations == 1
+    assert summary.tool_calls == {"read_build_log": 2, "search_nix_functions": 1}
+
+
+def test_percentile():
+    assert percentile([], 50) is None
+    assert percentile([4.0], 90) == 4.0
+    assert percentile([1.0, 2.0, 3.0, 4.0], 50) == 2.5
+    assert percentile([1.0, 2.0, 3.0, 4.0], 100) == 4.0
+
+
+def test_stats_tables(tmp_path, capsys):
+    logs = tmp_path / "batch-output"
+    for index, (template, success, elapsed) in enumerate([
+        ("generic", "true", "00:10:00.000"),
+        ("generic", "false", "00:30:00.000"),
+        ("python", "true", "00:05:00.000"),
+    ]):
+        (logs / str(index)).mkdir(parents=True)
+        _write_log(logs / str(index) / "run.ccl", elapsed, success, index + 1, 0.25, template=template,
+                   project=f"https://github.com/user/repo{index}")
+    (logs / "unfinished.ccl").write_text("start_time = 2025-01-01T00:00:00\n")
+
+    main([str(logs), "--csv", str(tmp_path / "stats")])
+    assert "4 sessions, 3 finished" in capsys.readouterr().out
+
+    with open(tmp_path / "stats" / "templates.csv", newline="") as f:
+        templates = {row["template"]: row for row in csv.DictReader(f)}
+    assert templates["generic"]["runs"] == "2"
+    assert float(templates["generic"]["success_rate"]) == 0.5
+    assert float(templates["generic"]["wall_time_p50"]) == 1200.0
+    assert float(templates["generic"]["cost"]) == 0.5
+    assert templates["unknown"]["success_rate"] == ""
+    with open(tmp_path / "stats" / "tool_calls.csv", newline="") as f:
+        tool_calls = list(csv.DictReader(f))
+    assert {"template": "generic", "function": "search_nixpkgs_for_package", "calls": "2",
+            "calls_per_run": "1.0"} in tool_calls
+    assert (tmp_path / "stats" / "projects.csv").exists()
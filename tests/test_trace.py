@@ -0,0 +1,44 @@
+"""Tests for the Chrome trace export of a session."""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from vibenix import process
+from vibenix.ccl_log import span
+from vibenix.session import submit_in_session
+from vibenix.trace import MODEL_CALLS, SUBPROCESSES, THREADS, TOOL_CALLS, TraceRecorder
+
+
+def _slices(trace, pid):
+    return [event for event in trace["traceEvents"] if event["ph"] == "X" and event["pid"] == pid]
+
+
+def test_trace_tracks(session, tmp_path):
+    session.trace = TraceRecorder()
+    with span("refine"):
+        with span("model", prompt="fix_build_error"):
+            with span("model-request", prompt="fix_build_error") as request_span:
+                request_span.set(time_to_first_token=0.0)
+        with span("tool", function="read_build_log"):
+            pass
+        process.run(["true"])
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [submit_in_session(executor, process.run, ["sleep", "0.2"]) for _ in range(2)]
+            for future in futures:
+                future.result()
+    trace_file = tmp_path / "trace.json"
+    session.trace.write(trace_file)
+    trace = json.loads(trace_file.read_text())
+
+    assert [event["name"] for event in _slices(trace, THREADS)] == ["refine", "model"]
+    assert [event["name"] for event in _slices(trace, MODEL_CALLS)] == [
+        "fix_build_error", "waiting for first token", "streaming"]
+    assert [event["args"]["function"] for event in _slices(trace, TOOL_CALLS)] == ["read_build_log"]
+
+    subprocesses = _slices(trace, SUBPROCESSES)
+    assert [event["name"] for event in subprocesses] == ["true", "sleep", "sleep"]
+    assert subprocesses[0]["args"]["exit_code"] == 0
+    # The concurrent commands overlap, so they are laid out on separate tracks
+    assert subprocesses[1]["tid"] != subprocesses[2]["tid"]
+    track_names = {event["args"]["name"] for event in trace["traceEvents"] if event["name"] == "thread_name"}
+    assert "subprocesses 2" in track_names
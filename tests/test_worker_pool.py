@@ -0,0 +1,30 @@
+"""Tests for the pool of workers forked from a warm fork server."""
+
+import gc
+import os
+import sys
+
+from vibenix.worker_pool import create_worker_pool
+
+# Jobs that ran in the worker process before
+_previous_jobs = []
+
+
+def _job(number: int):
+    warm = "vibenix.packaging_flow.run" in sys.modules and "magentic" in sys.modules
+    _previous_jobs.append(number)
+    return os.getpid(), warm, list(_previous_jobs), gc.get_freeze_count() > 0
+
+
+def test_every_job_runs_in_a_new_warm_worker():
+    with create_worker_pool(2) as pool:
+        results = list(pool.map(_job, range(4)))
+
+    pids = [pid for pid, _, _, _ in results]
+    assert len(set(pids)) == 4
+    assert os.getpid() not in pids
+    # The modules were imported by the fork server, before the job started
+    assert all(warm for _, warm, _, _ in results)
+    # Workers do not see the state of earlier jobs
+    assert [previous_jobs for _, _, previous_jobs, _ in results] == [[0], [1], [2], [3]]
+    assert all(frozen for _, _, _, frozen in results)